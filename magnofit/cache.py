@@ -0,0 +1,200 @@
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+
+from . import io
+from .termination import TerminationReason
+
+
+_CODE_VERSION = None
+
+
+def code_version():
+    """Hash of the magnofit sources, so cached results are invalidated by any code change."""
+    global _CODE_VERSION
+    if _CODE_VERSION is None:
+        digest = hashlib.sha256()
+        package = pathlib.Path(__file__).parent
+        for path in sorted(package.rglob("*.py")):
+            digest.update(path.relative_to(package).as_posix().encode())
+            digest.update(path.read_bytes())
+        _CODE_VERSION = digest.hexdigest()
+    return _CODE_VERSION
+
+
+def _canonical(value):
+    # JSON-serialisable form of a simulation input which is equal for equal inputs
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        # repr round-trips exactly
+        return repr(float(value))
+    if isinstance(value, np.ndarray):
+        return [_canonical(v) for v in value.tolist()]
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, np.random.Generator):
+        return {"rng": _canonical(value.bit_generator.state)}
+    if dataclasses.is_dataclass(value):
+        # The name of a galaxy does not affect its outflow
+        fields = {
+            f.name: _canonical(getattr(value, f.name))
+            for f in dataclasses.fields(value)
+            if f.name != "name"
+        }
+        return {"class": _class_name(value), "fields": fields}
+    # Mass profiles, luminosity fades and early exit predicates
+    return {"class": _class_name(value), "params": _canonical(vars(value))}
+
+
+def _class_name(value):
+    return f"{type(value).__module__}.{type(value).__qualname__}"
+
+
+class ResultCache:
+    """On-disk cache of run_outflow_simulation results.
+
+    Entries are keyed by a hash of the galaxy parameters (including the mass
+    profiles and the luminosity fade), the simulation arguments, including the
+    state of the rng, and the magnofit sources, so an entry is only reused for a
+    run that would produce the same result. Rejected runs (None) are cached too.
+    When the entries exceed max_bytes, the least recently used are removed.
+
+    Caches can be passed to worker processes; entries are written atomically, so
+    several processes may share one directory.
+    """
+
+    suffix = ".npz"
+    # Eviction removes entries down to this fraction of max_bytes, so that not
+    # every write has to scan the directory
+    eviction_fraction = 0.9
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Estimated size of the directory, updated on writes and rescanned on eviction
+        self._size = None
+
+    def key(self, galaxy, **kwargs):
+        description = {
+            "galaxy": _canonical(galaxy),
+            "arguments": _canonical(kwargs),
+            "code_version": code_version(),
+        }
+        encoded = json.dumps(description, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def run(self, simulate, galaxy, return_reason=False, **kwargs):
+        """Return simulate(galaxy, **kwargs) from the cache, running and storing it if needed.
+
+        simulate must accept return_reason=True and output="numpy", as
+        run_outflow_simulation does. The rng in kwargs, if any, is left in the
+        same state as after a real run. Tables and OutflowArrays (output in
+        kwargs) are read from the same entries.
+        """
+        output = kwargs.pop("output", "table")
+        rng = kwargs.get("rng")
+        key = self.key(galaxy, **kwargs)
+
+        entry = self._load(key)
+        if entry is None:
+            result, reason = simulate(galaxy, return_reason=True, output="numpy", **kwargs)
+            self._store(key, result, reason, rng)
+        else:
+            result, reason, rng_state = entry
+            if rng is not None:
+                rng.bit_generator.state = rng_state
+
+        if result is not None and output == "table":
+            result = result.to_astropy()
+        return (result, reason) if return_reason else result
+
+    def __len__(self):
+        return sum(1 for _ in self._entries())
+
+    def __contains__(self, key):
+        return self._path(key).exists()
+
+    def clear(self):
+        for path in self._entries():
+            path.unlink(missing_ok=True)
+        self._size = 0
+
+    def _path(self, key):
+        return self.directory / (key + self.suffix)
+
+    def _entries(self):
+        return self.directory.glob("*" + self.suffix)
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                meta = json.loads(str(entry["meta"]))
+                outflow_array = entry["outflow"] if "outflow" in entry.files else None
+            # Mark the entry as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, evicted by another process or truncated
+            return None
+
+        result = None
+        if outflow_array is not None:
+            result = io.OutflowArray(outflow_array, meta["table_meta"])
+        return result, TerminationReason[meta["reason"]], meta["rng_state"]
+
+    def _store(self, key, result, reason, rng):
+        meta = {
+            "reason": reason.name,
+            "rng_state": rng.bit_generator.state if rng is not None else None,
+            "table_meta": dict(result.meta) if result is not None else {},
+        }
+        arrays = {"meta": np.array(json.dumps(meta))}
+        if result is not None:
+            arrays["outflow"] = result.as_array()
+
+        # Written to a temporary file first, so readers never see a partial entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, self._path(key))
+
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += self._path(key).stat().st_size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _scan_size(self):
+        return sum(path.stat().st_size for path in self._entries())
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(key=lambda entry: entry[0])
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.eviction_fraction * self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            size -= entry_size
+        self._size = size
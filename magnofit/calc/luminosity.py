@@ -1,5 +1,10 @@
 import numpy as np
 
+# All fade models accept scalars or arrays for time_eff, time_start, duration and timestep,
+# and a galaxy whose parameters may themselves be arrays (e.g. a batch of galaxies).
+# Branches are evaluated for every element and selected with np.where; floating point
+# warnings from the branches that are not selected are therefore silenced.
+
 
 class Luminosity:
     def luminosity_coefficient(self, time_eff, galaxy):
@@ -17,11 +22,9 @@ class Luminosity:
 
 class LuminosityFadeNone(Luminosity):
     def luminosity_coefficient(self, time_eff, galaxy):
-        coef = 0.0
-        if time_eff <= galaxy.quasar_lum_variation_timescale:
-            coef = galaxy.eddington_ratio
+        coef = np.where(time_eff <= galaxy.quasar_lum_variation_timescale, galaxy.eddington_ratio, 0.0)
 
-        return coef
+        return coef[()]
 
     def luminosity_mean_coefficient(self, time_start, duration, timestep, galaxy):
         return galaxy.eddington_ratio * duration / timestep
@@ -32,23 +35,28 @@ class LuminosityFadeNone(Luminosity):
 
 class LuminosityFadeExponential(Luminosity):
     def luminosity_coefficient(self, time_eff, galaxy):
-        if time_eff <= galaxy.quasar_lum_variation_timescale:
-            coef = galaxy.eddington_ratio
-        else:
-            coef = galaxy.eddington_ratio * np.exp(-(time_eff - galaxy.quasar_lum_variation_timescale) / galaxy.drop_timescale)
+        variation_timescale = galaxy.quasar_lum_variation_timescale
+        with np.errstate(over="ignore"):
+            fading = galaxy.eddington_ratio * np.exp(-(time_eff - variation_timescale) / galaxy.drop_timescale)
 
-        return coef
+        coef = np.where(time_eff <= variation_timescale, galaxy.eddington_ratio, fading)
+
+        return coef[()]
 
     def luminosity_mean_coefficient(self, time_start, duration, timestep, galaxy):
-        if time_start + duration <= galaxy.quasar_lum_variation_timescale:
-            coef = galaxy.eddington_ratio
-        else:
-            if time_start <= galaxy.quasar_lum_variation_timescale:
-                coef = galaxy.eddington_ratio * (galaxy.quasar_lum_variation_timescale - time_start) / timestep + galaxy.eddington_ratio * galaxy.drop_timescale / timestep * (1 - np.exp ((galaxy.quasar_lum_variation_timescale - duration - time_start) / galaxy.drop_timescale))
-            else:
-                coef = galaxy.eddington_ratio * galaxy.drop_timescale / timestep * np.exp((galaxy.quasar_lum_variation_timescale - time_start) / galaxy.drop_timescale) * (1 - np.exp (- duration / galaxy.drop_timescale))
+        variation_timescale = galaxy.quasar_lum_variation_timescale
+        with np.errstate(over="ignore", invalid="ignore"):
+            # The timestep starts before the fading does
+            straddling = galaxy.eddington_ratio * (variation_timescale - time_start) / timestep + galaxy.eddington_ratio * galaxy.drop_timescale / timestep * (1 - np.exp ((variation_timescale - duration - time_start) / galaxy.drop_timescale))
+            fading = galaxy.eddington_ratio * galaxy.drop_timescale / timestep * np.exp((variation_timescale - time_start) / galaxy.drop_timescale) * (1 - np.exp (- duration / galaxy.drop_timescale))
 
-        return coef
+        coef = np.where(
+            time_start + duration <= variation_timescale,
+            galaxy.eddington_ratio,
+            np.where(time_start <= variation_timescale, straddling, fading),
+        )
+
+        return coef[()]
 
     def quasar_luminosity_variation_timescale(self, galaxy):
         return galaxy.quasar_activity_duration + galaxy.drop_timescale * np.log(galaxy.eddington_ratio_shutdown/galaxy.eddington_ratio)
@@ -56,29 +64,37 @@ class LuminosityFadeExponential(Luminosity):
 
 class LuminosityFadePowerLaw(Luminosity):
     def luminosity_coefficient(self, time_eff, galaxy):
-        if time_eff <= galaxy.quasar_lum_variation_timescale:
-            coef = galaxy.eddington_ratio
-        else:
-            coef =  galaxy.eddington_ratio * (time_eff / galaxy.quasar_lum_variation_timescale) ** (-1. * galaxy.alpha_drop)
+        variation_timescale = galaxy.quasar_lum_variation_timescale
+        with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+            fading = galaxy.eddington_ratio * (np.asarray(time_eff) / variation_timescale) ** (-1. * galaxy.alpha_drop)
 
-        return coef
+        coef = np.where(time_eff <= variation_timescale, galaxy.eddington_ratio, fading)
 
-    def luminosity_mean_coefficient(self, time_start, duration, timestep, galaxy):
-        if time_start + duration <= galaxy.quasar_lum_variation_timescale:
-            coef = galaxy.eddington_ratio
-        else:
-            if galaxy.alpha_drop == -1: #special case, integral becomes logarithmic
-                if time_start <= galaxy.quasar_lum_variation_timescale:
-                    coef = galaxy.eddington_ratio * (galaxy.quasar_lum_variation_timescale - time_start) / timestep + galaxy.eddington_ratio * galaxy.quasar_lum_variation_timescale / timestep * np.log((time_start + duration) / galaxy.quasar_lum_variation_timescale)
-                else:
-                    galaxy.eddington_ratio * galaxy.quasar_lum_variation_timescale / timestep * np.log((time_start + duration) / time_start)
-            else:
-                if time_start <= galaxy.quasar_lum_variation_timescale:
-                    coef = galaxy.eddington_ratio * (galaxy.quasar_lum_variation_timescale - time_start) / timestep + galaxy.eddington_ratio * galaxy.quasar_lum_variation_timescale ** galaxy.alpha_drop / (timestep * (1. - galaxy.alpha_drop)) * (galaxy.quasar_lum_variation_timescale ** (1. - galaxy.alpha_drop) - (time_start + duration) ** (1. - galaxy.alpha_drop))
-                else:
-                    coef = galaxy.eddington_ratio * galaxy.quasar_lum_variation_timescale ** galaxy.alpha_drop / (timestep * (1. - galaxy.alpha_drop)) * (time_start ** (1. - galaxy.alpha_drop) - (time_start + duration) ** (1. - galaxy.alpha_drop))
+        return coef[()]
 
-        return coef
+    def luminosity_mean_coefficient(self, time_start, duration, timestep, galaxy):
+        variation_timescale = galaxy.quasar_lum_variation_timescale
+        time_start = np.asarray(time_start)
+        with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+            #special case alpha_drop == -1, integral becomes logarithmic
+            log_straddling = galaxy.eddington_ratio * (variation_timescale - time_start) / timestep + galaxy.eddington_ratio * variation_timescale / timestep * np.log((time_start + duration) / variation_timescale)
+            log_fading = galaxy.eddington_ratio * variation_timescale / timestep * np.log((time_start + duration) / time_start)
+
+            straddling = galaxy.eddington_ratio * (variation_timescale - time_start) / timestep + galaxy.eddington_ratio * variation_timescale ** galaxy.alpha_drop / (timestep * (1. - galaxy.alpha_drop)) * (variation_timescale ** (1. - galaxy.alpha_drop) - (time_start + duration) ** (1. - galaxy.alpha_drop))
+            fading = galaxy.eddington_ratio * variation_timescale ** galaxy.alpha_drop / (timestep * (1. - galaxy.alpha_drop)) * (time_start ** (1. - galaxy.alpha_drop) - (time_start + duration) ** (1. - galaxy.alpha_drop))
+
+        started = time_start <= variation_timescale
+        coef = np.where(
+            time_start + duration <= variation_timescale,
+            galaxy.eddington_ratio,
+            np.where(
+                np.equal(galaxy.alpha_drop, -1),
+                np.where(started, log_straddling, log_fading),
+                np.where(started, straddling, fading),
+            ),
+        )
+
+        return coef[()]
 
     def quasar_luminosity_variation_timescale(self, galaxy):
         return galaxy.quasar_activity_duration / (1 + (galaxy.eddington_ratio_shutdown/galaxy.eddington_ratio) ** (-1. / galaxy.alpha_drop))
@@ -90,7 +106,8 @@ class LuminosityFadeKing(Luminosity):
         return coef
 
     def luminosity_mean_coefficient(self, time_start, duration, timestep, galaxy):
-        return galaxy.eddington_ratio * 16 * galaxy.quasar_lum_variation_timescale / (3 * timestep) * ((1 + time_start / galaxy.quasar_lum_variation_timescale) ** (-3./16.) - (1 + (time_start + duration) / galaxy.quasar_lum_variation_timescale) ** (-3./16.))
+        variation_timescale = galaxy.quasar_lum_variation_timescale
+        return galaxy.eddington_ratio * 16 * variation_timescale / (3 * timestep) * ((1 + time_start / variation_timescale) ** (-3./16.) - (1 + (time_start + duration) / variation_timescale) ** (-3./16.))
 
 
     def quasar_luminosity_variation_timescale(self, galaxy):
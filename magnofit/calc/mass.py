@@ -1,8 +1,31 @@
 import numpy as np
 
 
+def clamp_fractions(mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer):
+    '''
+    Beyond the edge of a truncated component (mass_fraction > 1) all of its mass is enclosed,
+    so the fraction is fixed at 1 and its derivatives and densities vanish.
+    Works on scalars and, element by element, on arrays.
+    '''
+    outside = mass_fraction > 1.
+    if np.ndim(outside) == 0:
+        if outside:
+            return 1., 0., 0., 1.e-10, 1.e-10
+        return mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
+
+    return (
+        np.where(outside, 1., mass_fraction),
+        np.where(outside, 0., dot_mass_fraction),
+        np.where(outside, 0., dotdot_mass_fraction),
+        np.where(outside, 1.e-10, rho_contact),
+        np.where(outside, 1.e-10, rho_outer),
+    )
+
+
 class Mass:
     def calculate(self, radius, dot_radius, dotdot_radius, total_mass, scale_length, concentration, gas_fraction):
+        #All arguments may be scalars or broadcastable arrays (e.g. a radius grid or a batch of galaxies)
+
         #Scale the radius to the size of the component:
         scaled_radius = radius/scale_length
         scaled_dot_radius = dot_radius/scale_length
@@ -29,7 +52,7 @@ class Mass:
 
         return mass_potential, dot_mass_potential, mass_gas, dot_mass_gas, dotdot_mass_gas, rho_gas_contact, rho_gas_outer
 
-    def calculate_fractions(scaled_radius, scaled_dot_radius, scaled_dotdot_radius, concentration):
+    def calculate_fractions(self, scaled_radius, scaled_dot_radius, scaled_dotdot_radius, concentration):
         raise NotImplementedError()
 
 
@@ -38,10 +61,10 @@ class MassNFW(Mass):
         '''
         Parameters
         ----------
-        scaled_radius : float; ratio of outflow radius to scale_length
-        scaled_dot_radius : float; ratio of outflow velocity to scale_length
-        scaled_dotdot_radius : float; ratio of outflow acceleration to scale_length
-        concentration : float; concentration (= R_vir / scale_length) of the NFW profile
+        scaled_radius : float or ndarray; ratio of outflow radius to scale_length
+        scaled_dot_radius : float or ndarray; ratio of outflow velocity to scale_length
+        scaled_dotdot_radius : float or ndarray; ratio of outflow acceleration to scale_length
+        concentration : float or ndarray; concentration (= R_vir / scale_length) of the NFW profile
 
         Returns: mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
 
@@ -59,14 +82,7 @@ class MassNFW(Mass):
 
         rho_outer = ((1. + bigger_radius) ** 2) / (3. * bigger_radius) / concentration_term
 
-        if mass_fraction > 1.:
-            mass_fraction = 1.
-            dot_mass_fraction = 0.
-            dotdot_mass_fraction = 0.
-            rho_contact = 1.e-10
-            rho_outer = 1.e-10
-
-        return mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
+        return clamp_fractions(mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer)
 
 
 class MassIsothermal(Mass):
@@ -75,9 +91,9 @@ class MassIsothermal(Mass):
 
         Parameters
         ----------
-        scaled_radius : float; ratio of outflow radius to scale_length
-        scaled_dot_radius : float; ratio of outflow velocity to scale_length
-        scaled_dotdot_radius : float; ratio of outflow acceleration to scale_length
+        scaled_radius : float or ndarray; ratio of outflow radius to scale_length
+        scaled_dot_radius : float or ndarray; ratio of outflow velocity to scale_length
+        scaled_dotdot_radius : float or ndarray; ratio of outflow acceleration to scale_length
         concentration : dummy parameter, not required for this profile
 
         Returns: mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
@@ -91,15 +107,7 @@ class MassIsothermal(Mass):
         rho_contact = 1./3.
         rho_outer = 1./3. * (3./4.) ** 3
 
-        if mass_fraction > 1.:
-            mass_fraction = 1.
-            dot_mass_fraction = 0.
-            dotdot_mass_fraction = 0.
-            rho_contact = 1.e-10
-            rho_outer = 1.e-10
-
-
-        return mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
+        return clamp_fractions(mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer)
 
 
 class MassHernquist(Mass):
@@ -108,9 +116,9 @@ class MassHernquist(Mass):
 
         Parameters
         ----------
-        scaled_radius : float; ratio of outflow radius to scale_length
-        scaled_dot_radius : float; ratio of outflow velocity to scale_length
-        scaled_dotdot_radius : float; ratio of outflow acceleration to scale_length
+        scaled_radius : float or ndarray; ratio of outflow radius to scale_length
+        scaled_dot_radius : float or ndarray; ratio of outflow velocity to scale_length
+        scaled_dotdot_radius : float or ndarray; ratio of outflow acceleration to scale_length
         concentration : dummy parameter, not required for this profile
 
         Returns: mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
@@ -134,9 +142,9 @@ class MassJaffe(Mass):
 
         Parameters
         ----------
-        scaled_radius : float; ratio of outflow radius to scale_length
-        scaled_dot_radius : float; ratio of outflow velocity to scale_length
-        scaled_dotdot_radius : float; ratio of outflow acceleration to scale_length
+        scaled_radius : float or ndarray; ratio of outflow radius to scale_length
+        scaled_dot_radius : float or ndarray; ratio of outflow velocity to scale_length
+        scaled_dotdot_radius : float or ndarray; ratio of outflow acceleration to scale_length
         concentration : dummy parameter, not required for this profile
 
         Returns: mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
@@ -165,11 +173,4 @@ class MassAlpha(Mass):
         rho_contact = 1./3.
         rho_outer = 1./3. * (3./4.) ** 3
 
-        if mass_fraction > 1.:
-            mass_fraction = 1.
-            dot_mass_fraction = 0.
-            dotdot_mass_fraction = 0.
-            rho_contact = 1.e-10
-            rho_outer = 1.e-10
-
-        return mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer
+        return clamp_fractions(mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer)
@@ -1,3 +1,5 @@
+import numpy as np
+
 from .. import constants as const
 
 
@@ -66,8 +68,14 @@ def rtdot_calc(luminosity, mass_gas, mdot_gas, mddot_gas, mass_pot, mdot_pot, ra
 
 
 def cap_velocities(dot_radius, dotdot_radius, dotdotdot_radius):
-    velocity_cap = 2 * const.ETA_DRIVE * const.c #outflow velocity cannot exceed driving wind velocity
-    if dot_radius > velocity_cap:
+    velocity_cap = const.WIND_VELOCITY #outflow velocity cannot exceed driving wind velocity
+    if np.ndim(dot_radius) > 0:
+        #Array input (e.g. a batch of outflows): apply the same cap lane by lane
+        capped = dot_radius > velocity_cap
+        dot_radius = np.where(capped, velocity_cap, dot_radius)
+        dotdot_radius = np.where(capped & (dotdot_radius > 0), 0., dotdot_radius)
+        dotdotdot_radius = np.where(capped & (dotdotdot_radius > 0), 0., dotdotdot_radius)
+    elif dot_radius > velocity_cap:
         dot_radius = velocity_cap
         if dotdot_radius > 0:
             dotdot_radius = 0
@@ -27,4 +27,7 @@ UNIT_ENERGY = UNIT_MASS * (UNIT_VELOCITY ** 2)
 
 UNIT_KPC = UNIT_LENGTH / _kpc
 UNIT_YEAR = UNIT_TIME / SECONDS_IN_YEAR
-UNIT_MSUN = UNIT_MASS / _sunmass
\ No newline at end of file
+UNIT_MSUN = UNIT_MASS / _sunmass
+
+# Driving wind velocity in code units; the outflow velocity cannot exceed it
+WIND_VELOCITY = 2 * ETA_DRIVE * c / UNIT_VELOCITY
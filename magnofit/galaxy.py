@@ -1,8 +1,7 @@
+import dataclasses
 from dataclasses import dataclass
 
-import astropy.table
 import numpy as np
-from astropy import units as u
 
 from . import constants as const
 from .calc import luminosity as lc
@@ -100,7 +99,34 @@ class Galaxy:
     def agn_luminosity(self, time):
         return self.fade.luminosity_coefficient(time % self.quasar_repetition_timescale, self) * self.luminosity_eddington
 
+    def compile(self):
+        # Snapshot of all parameters the integrator and fade models read, derived once
+        return CompiledGalaxy(
+            halo_profile=self.halo_profile,
+            bulge_profile=self.bulge_profile,
+            fade=self.fade,
+            halo_mass=self.halo_mass,
+            halo_scale_radius=self.halo_scale_radius,
+            halo_concentration=self.halo_concentration,
+            halo_gas_fraction=self.halo_gas_fraction,
+            bulge_mass=self.bulge_mass,
+            bulge_scale_radius=self.bulge_scale_radius,
+            bulge_gas_fraction=self.bulge_gas_fraction,
+            eddington_ratio=self.eddington_ratio,
+            eddington_ratio_shutdown=self.eddington_ratio_shutdown,
+            drop_timescale=self.drop_timescale,
+            alpha_drop=self.alpha_drop,
+            quasar_activity_duration=self.quasar_activity_duration,
+            quasar_repetition_timescale=self.quasar_repetition_timescale,
+            quasar_lum_variation_timescale=self.quasar_lum_variation_timescale,
+            salpeter_timescale=self.salpeter_timescale,
+            smbh_mass=self.smbh_mass,
+        )
+
     def to_table(self):
+        import astropy.table
+        from astropy import units as u
+
         table = astropy.table.Table(
             {
                 "virial_mass": [self.virial_mass * const.UNIT_MSUN] * u.Msun,
@@ -172,3 +198,191 @@ class Galaxy:
         # Bandara et al. 2009, doi: 10.1088/0004-637X/704/2/1135 (equation 8)
         log_virial_mass = ((np.log10(self.smbh_mass* const.UNIT_MSUN) - 8.18) / 1.55 ) + 13.0
         return (10 ** log_virial_mass) / const.UNIT_MSUN
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledGalaxy:
+    """Immutable snapshot of a Galaxy, created with Galaxy.compile().
+
+    Derived properties (halo_mass, quasar_lum_variation_timescale, ...) are plain
+    attributes here instead of being recomputed on every access, which keeps
+    them out of the simulation's inner loop. Fade models accept it wherever they
+    accept a Galaxy. Numeric attributes may be arrays for a batch of galaxies.
+    """
+
+    halo_profile: mc.Mass
+    bulge_profile: mc.Mass
+    fade: lc.Luminosity
+
+    halo_mass: float
+    halo_scale_radius: float
+    halo_concentration: float
+    halo_gas_fraction: float
+
+    bulge_mass: float
+    bulge_scale_radius: float
+    bulge_gas_fraction: float
+
+    eddington_ratio: float
+    eddington_ratio_shutdown: float
+    drop_timescale: float
+    alpha_drop: float
+
+    quasar_activity_duration: float
+    quasar_repetition_timescale: float
+    quasar_lum_variation_timescale: float
+    salpeter_timescale: float
+
+    # SMBH mass at the start of the simulation; the evolving value is tracked by the integrator
+    smbh_mass: float
+
+    def luminosity_eddington(self, smbh_mass):
+        # Same expression as Galaxy.luminosity_eddington, for the current SMBH mass
+        return const.LUMINOSITY_EDD * (smbh_mass * const.UNIT_MSUN) * const.UNIT_TIME / const.UNIT_ENERGY
+
+
+class UniformDraws:
+    """Vectorized stand-in for rng.uniform when drawing for a population.
+
+    The k-th call to uniform(low, high) returns column k of rng.random((size, count)),
+    scaled to [low, high). This gives the same values as calling rng.uniform count
+    times for each of the size galaxies in turn, as a loop over Galaxy objects does.
+    """
+
+    def __init__(self, rng, size, count):
+        self._values = rng.random((size, count))
+        self._column = 0
+
+    def uniform(self, low, high):
+        values = low + (high - low) * self._values[:, self._column]
+        self._column += 1
+        return values
+
+
+# Galaxy fields that are shared by all galaxies of a population
+_SHARED_FIELDS = ("halo_profile", "bulge_profile", "fade")
+
+
+def _shared_components(galaxies, collection="population"):
+    # The profiles and fade of the first galaxy, after checking that every galaxy has
+    # equal ones: of the same class and with the same parameters
+    first = galaxies[0]
+    for galaxy in galaxies[1:]:
+        for name in _SHARED_FIELDS:
+            component, reference = getattr(galaxy, name), getattr(first, name)
+            if type(component) is not type(reference) or vars(component) != vars(reference):
+                raise ValueError(
+                    f"All galaxies in a {collection} must share the same {name}, "
+                    f"got {component} and {reference}."
+                )
+    return {name: getattr(first, name) for name in _SHARED_FIELDS}
+
+
+@dataclass
+class GalaxyPopulation(Galaxy):
+    """Galaxies stored as one array per parameter.
+
+    Every numeric field holds one value per galaxy (scalars are broadcast to all
+    galaxies) or None, name holds an array of names or None, and the profiles and
+    the fade are shared. Derived properties are those of Galaxy, evaluated on the
+    arrays. Slicing returns a population with views of the arrays, e.g. to send
+    chunks to workers; Galaxy objects are only created by population[i] and by
+    iterating.
+    """
+
+    def __post_init__(self):
+        sizes = {
+            np.size(getattr(self, field.name))
+            for field in dataclasses.fields(self)
+            if field.name not in _SHARED_FIELDS and np.ndim(getattr(self, field.name)) > 0
+        }
+        if len(sizes) != 1:
+            raise ValueError("Population fields must be arrays of one common length.")
+        (self._size,) = sizes
+
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if field.name in _SHARED_FIELDS or value is None:
+                continue
+            if field.name == "name":
+                setattr(self, field.name, np.asarray(value, dtype=object))
+            elif np.ndim(value) == 0:
+                setattr(self, field.name, np.full(self._size, value, dtype=np.float64))
+            else:
+                setattr(self, field.name, np.asarray(value, dtype=np.float64))
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            return Galaxy(
+                **{
+                    name: value if name in _SHARED_FIELDS or value is None else value[index].item()
+                    for name, value in self._fields().items()
+                }
+            )
+        return GalaxyPopulation(
+            **{
+                name: value if name in _SHARED_FIELDS or value is None else value[index]
+                for name, value in self._fields().items()
+            }
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def chunks(self, chunk_size):
+        """Yield consecutive populations of at most chunk_size galaxies."""
+        for start in range(0, len(self), chunk_size):
+            yield self[start : start + chunk_size]
+
+    @classmethod
+    def from_galaxies(cls, galaxies):
+        """Collect Galaxy objects, which must share their profiles and fade, into a population."""
+        fields = {
+            field.name: [getattr(galaxy, field.name) for galaxy in galaxies]
+            for field in dataclasses.fields(Galaxy)
+        }
+        fields.update(_shared_components(galaxies))
+        for name, values in fields.items():
+            if name not in _SHARED_FIELDS and all(value is None for value in values):
+                fields[name] = None
+        return cls(**fields)
+
+    def generate_stochastic_parameters(self, rng):
+        # Draws as many values per galaxy, in the same order, as calling
+        # Galaxy.generate_stochastic_parameters on each galaxy in turn. rng may also
+        # be UniformDraws that the caller has used for other parameters before.
+        if not isinstance(rng, UniformDraws):
+            missing = [self.smbh_mass is None, self.bulge_mass is None, self.bulge_sigma is None]
+            rng = UniformDraws(rng, len(self), sum(missing))
+        super().generate_stochastic_parameters(rng)
+
+    def to_table(self):
+        import astropy.table
+        from astropy import units as u
+
+        table = astropy.table.Table(
+            {
+                "virial_mass": self.virial_mass * const.UNIT_MSUN * u.Msun,
+                "virial_radius": self.virial_radius * u.kpc,
+                "bulge_mass": self.bulge_mass * const.UNIT_MSUN * u.Msun,
+                "bulge_scale": self.bulge_scale_radius * u.kpc,
+                "bulge_sigma": self.bulge_sigma * u.kilometer / u.second,
+                "bulge_gas_fraction": self.bulge_gas_fraction,
+                "smbh_mass": self.smbh_mass * const.UNIT_MSUN * u.Msun,
+                "quasar_activity_duration": self.quasar_activity_duration * const.UNIT_YEAR * u.year,
+                "duty_cycle": self.duty_cycle,
+                "fade_type": np.full(len(self), str(self.fade)),
+                "outflow_solid_angle_fraction": self.outflow_sphere_angle_ratio,
+            },
+        )
+        if self.name is not None:
+            table["name"] = self.name.astype(str)
+
+        return table
+
+    def _fields(self):
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
@@ -1,54 +1,64 @@
-import astropy.table
+import dataclasses
+
 import numpy as np
-from astropy import units as u
 
 import magnofit.constants as const
 
+# astropy and h5py take most of the import time of magnofit, so they are only
+# imported by the functions that use them; the simulation itself needs neither
 
-def outflows_to_table(outflows, galaxy_params):
-    outflow_array = np.empty(
-        (len(outflows),),
-        dtype=np.dtype(
-            [
-                ("time", np.float64),
-                ("dot_time", np.float64),
-                ("radius", np.float64),
-                ("dot_radius", np.float64),
-                ("dotdot_radius", np.float64),
-                ("dotdotdot_radius", np.float64),
-                ("dot_mass", np.float64),
-                ("mass_out", np.float64),
-                ("total_mass", np.float64),
-                ("luminosity_AGN", np.float64),
-            ]
-        ),
-    )
 
-    for i, (o, g) in enumerate(zip(outflows, galaxy_params)):
-        outflow_array["radius"][i] = o.radius
-        outflow_array["dot_radius"][i] = o.dot_radius
-        outflow_array["dotdot_radius"][i] = o.dotdot_radius
-        outflow_array["dotdotdot_radius"][i] = o.dotdotdot_radius
+# Columns of an outflow table: name, unit and description
+OUTFLOW_SCHEMA = (
+    ("time", "yr", "Time since the start of the outflow"),
+    ("dot_time", "yr", "Current timestep"),
+    ("radius", "kpc", "Current outflow radius"),
+    ("dot_radius", "km / s", "Current outflow velocity"),
+    ("dotdot_radius", "km / s2", "Current outflow acceleration"),
+    ("dotdotdot_radius", "km / s3", "Current outflow jerk"),
+    ("dot_mass", "solMass / yr", "Mass outflow rate derived as M v / R"),
+    ("mass_out", "solMass", "Gas mass in outflow"),
+    ("total_mass", "solMass", "Total mass within outflow radius"),
+    ("luminosity_AGN", "erg / s", "Current AGN luminosity"),
+)
+
+OUTFLOW_DTYPE = np.dtype([(name, np.float64) for name, _, _ in OUTFLOW_SCHEMA])
+
 
-        outflow_array["time"][i] = o.time
-        outflow_array["dot_time"][i] = o.dot_time
+def trajectory_to_array(trajectory, galaxy, rows=None):
+    """Convert recorded outflow states to a structured array in physical units.
 
-        outflow_array["mass_out"][i] = o.mass_out
-        outflow_array["total_mass"][i] = o.total_mass
+    trajectory maps the names in magnofit.trajectory.TRAJECTORY_COLUMNS to arrays
+    in code units (a TrajectoryBuffer or a dict of arrays), including the SMBH
+    mass of every row. galaxy provides the remaining, constant parameters.
+    rows optionally selects (and orders) the rows to convert.
+    """
 
-        outflow_array["luminosity_AGN"][i] = g.agn_luminosity(o.time)
+    def column(name):
+        values = np.asarray(trajectory[name], dtype=np.float64)
+        return values if rows is None else values[rows]
 
-    outflow_array["radius"] = outflow_array["radius"] * const.UNIT_KPC
+    time = column("time")
+    outflow_array = np.empty(time.shape, dtype=OUTFLOW_DTYPE)
+
+    # Only smbh_mass changes between the rows of one outflow, so the luminosity of
+    # all rows is evaluated in one call on a galaxy holding an array of SMBH masses
+    galaxy = dataclasses.replace(galaxy, smbh_mass=column("smbh_mass"))
+    outflow_array["luminosity_AGN"] = (
+        galaxy.agn_luminosity(time) * const.UNIT_ENERGY / const.UNIT_TIME
+    )
+
+    outflow_array["radius"] = column("radius") * const.UNIT_KPC
     outflow_array["dot_radius"] = (
-        outflow_array["dot_radius"] * const.UNIT_VELOCITY / 1.0e5
+        column("dot_radius") * const.UNIT_VELOCITY / 1.0e5
     )  # to km/s
-    outflow_array["time"] = outflow_array["time"] * const.UNIT_YEAR
-    outflow_array["dot_time"] = outflow_array["dot_time"] * const.UNIT_YEAR
+    outflow_array["dotdot_radius"] = column("dotdot_radius")
+    outflow_array["dotdotdot_radius"] = column("dotdotdot_radius")
+    outflow_array["time"] = time * const.UNIT_YEAR
+    outflow_array["dot_time"] = column("dot_time") * const.UNIT_YEAR
 
     outflow_array["mass_out"] = (
-        outflow_array["mass_out"]
-        * galaxy_params[0].outflow_sphere_angle_ratio
-        * const.UNIT_MSUN
+        column("mass_out") * galaxy.outflow_sphere_angle_ratio * const.UNIT_MSUN
     )
     derived_dot_mass = np.divide(
         outflow_array["mass_out"] * outflow_array["dot_radius"] * 1.0e5,  # to cm/s
@@ -58,37 +68,418 @@ def outflows_to_table(outflows, galaxy_params):
     )
     outflow_array["dot_mass"] = derived_dot_mass * const.SECONDS_IN_YEAR
 
-    outflow_array["total_mass"] = outflow_array["total_mass"] * const.UNIT_MSUN
-    outflow_array["luminosity_AGN"] = (
-        outflow_array["luminosity_AGN"] * const.UNIT_ENERGY / const.UNIT_TIME
-    )
+    outflow_array["total_mass"] = column("total_mass") * const.UNIT_MSUN
 
-    outflow_table = astropy.table.Table(
+    return outflow_array
+
+
+def outflow_array_to_table(outflow_array):
+    """Wrap a structured array from trajectory_to_array in an astropy table with units."""
+    import astropy.table
+    from astropy import units as u
+
+    return astropy.table.Table(
         outflow_array,
-        units=(
-            u.yr,
-            u.yr,
-            u.kpc,
-            u.km / u.s,
-            u.km / u.s / u.s,
-            u.km / u.s / u.s / u.s,
-            u.Msun / u.yr,
-            u.Msun,
-            u.Msun,
-            u.erg / u.s,
-        ),
-        descriptions=(
-            "Time since the start of the outflow",
-            "Current timestep",
-            "Current outflow radius",
-            "Current outflow velocity",
-            "Current outflow acceleration",
-            "Current outflow jerk",
-            "Mass outflow rate derived as M v / R",
-            "Gas mass in outflow",
-            "Total mass within outflow radius",
-            "Current AGN luminosity",
-        ),
+        units=[u.Unit(unit) for _, unit, _ in OUTFLOW_SCHEMA],
+        descriptions=[description for _, _, description in OUTFLOW_SCHEMA],
+    )
+
+
+@dataclasses.dataclass
+class OutflowArray:
+    """Outflow rows as a plain structured array, without astropy.
+
+    run_outflow_simulation returns this with output="numpy". data has the
+    columns of OUTFLOW_SCHEMA (OUTFLOW_DTYPE) in the units listed there (units
+    maps every column to its unit), and meta holds what the table meta would,
+    e.g. n_steps and termination_reason.
+    """
+
+    data: np.ndarray
+    meta: dict = dataclasses.field(default_factory=dict)
+
+    units = {name: unit for name, unit, _ in OUTFLOW_SCHEMA}
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    @property
+    def colnames(self):
+        return list(self.data.dtype.names)
+
+    def as_array(self):
+        return self.data
+
+    def to_astropy(self):
+        """The astropy table run_outflow_simulation returns with output="table"."""
+        table = outflow_array_to_table(self.data)
+        table.meta.update(self.meta)
+        return table
+
+    def to_pandas(self):
+        import pandas
+
+        return pandas.DataFrame(self.data)
+
+
+def trajectory_to_table(trajectory, galaxy, rows=None):
+    return outflow_array_to_table(trajectory_to_array(trajectory, galaxy, rows))
+
+
+def outflows_to_table(outflows, galaxy_params):
+    trajectory = {
+        name: np.array([getattr(o, name) for o in outflows], dtype=np.float64)
+        for name in (
+            "radius",
+            "dot_radius",
+            "dotdot_radius",
+            "dotdotdot_radius",
+            "mass_out",
+            "total_mass",
+            "time",
+            "dot_time",
+        )
+    }
+    trajectory["smbh_mass"] = np.array([g.smbh_mass for g in galaxy_params], dtype=np.float64)
+
+    return trajectory_to_table(trajectory, galaxy_params[0])
+
+
+# Datasets of a population file: one row per galaxy, keyed by id, and the outflow
+# rows of all galaxies with the id of their galaxy, grouped by galaxy in id order
+GALAXIES_DATASET = "galaxies"
+OUTFLOW_DATASET = "outflow_properties"
+
+
+def galaxy_rows(galaxy_table, galaxy_id):
+    """Structured array with the ids and the columns of a galaxy table.
+
+    galaxy_table is e.g. Galaxy.to_table() or GalaxyPopulation.to_table(), and
+    galaxy_id holds one id per row (or a single id).
+    """
+    rows = np.empty(
+        len(galaxy_table),
+        dtype=[("id", np.int64)]
+        + [(name, galaxy_table[name].dtype) for name in galaxy_table.colnames],
+    )
+    rows["id"] = galaxy_id
+    for name in galaxy_table.colnames:
+        rows[name] = galaxy_table[name]
+    return rows
+
+
+def outflow_rows(outflow_array, galaxy_id):
+    """Prepend the id of its galaxy to every row of an outflow (e.g. from trajectory_to_array)."""
+    rows = np.empty(len(outflow_array), dtype=[("id", np.int64)] + outflow_array.dtype.descr)
+    rows["id"] = galaxy_id
+    for name in outflow_array.dtype.names:
+        rows[name] = outflow_array[name]
+    return rows
+
+
+def flatten_population(galaxies, outflow_rows, columns=None):
+    """Join the galaxy columns onto their outflow rows, as an astropy table.
+
+    outflow_rows may be any subset of the rows of a population, as long as they
+    remain grouped by galaxy in id order. The table has the outflow columns, then
+    the galaxy columns, then the id, as the flat layout of earlier versions;
+    columns optionally selects (and orders) the columns to join. Outflow columns
+    are views of outflow_rows, galaxy columns are repeated with np.repeat.
+    """
+    outflow_names = [name for name in outflow_rows.dtype.names if name != "id"]
+    galaxy_names = [name for name in galaxies.dtype.names if name != "id"]
+    if columns is None:
+        columns = outflow_names + galaxy_names + ["id"]
+
+    # Number of rows of every galaxy, to repeat the galaxy columns that often
+    bounds = np.searchsorted(outflow_rows["id"], galaxies["id"])
+    counts = np.diff(bounds, append=len(outflow_rows))
+
+    import astropy.table
+
+    return astropy.table.Table(
+        [
+            outflow_rows[name]
+            if name in outflow_rows.dtype.names
+            else np.repeat(galaxies[name], counts)
+            for name in columns
+        ],
+        names=columns,
+        copy=False,
     )
 
-    return outflow_table
+
+def read_population(path, columns=None, where=None, chunk_rows=131072):
+    """Read the galaxies and outflow rows of a population file written with OutflowWriter.
+
+    columns optionally selects the galaxy and outflow columns to read (ids are
+    always read). where optionally maps column names to predicates, functions
+    of an array of values that return a boolean mask; only the outflow rows for
+    which all of them hold are kept, and a predicate on a galaxy column drops
+    the galaxies it fails together with their rows. Rows are read chunk_rows at
+    a time, with only the selected columns and those of the predicates, and
+    filtered before the next chunk is read.
+
+    Files in the earlier flat layout, with the galaxy columns on every outflow row,
+    are split into the same two arrays; as with the two-table layout, galaxies none
+    of whose rows pass the predicates on outflow columns are kept.
+    """
+    import h5py
+
+    with h5py.File(path, "r") as file:
+        galaxy_rows, outflows, names, outflow_where, galaxy_where = _population_selection(
+            file, columns, where, chunk_rows
+        )
+        if galaxy_rows is None:
+            return _read_flat_population(outflows, names, outflow_where, galaxy_where, chunk_rows)
+        outflow_columns, _ = names
+        return galaxy_rows, _read_rows(outflows, outflow_columns, outflow_where, chunk_rows)
+
+
+def read_outflows(path, columns=None, where=None, chunk_rows=131072):
+    """Read a population file as one flat astropy table.
+
+    columns selects (and orders) the columns of the table, including "id" if
+    wanted; see read_population for where and chunk_rows.
+    """
+    galaxies, outflow_rows = read_population(path, columns, where, chunk_rows)
+    return flatten_population(galaxies, outflow_rows, columns)
+
+
+def iter_outflows(path, columns=None, where=None, chunk_rows=131072):
+    """Read a population file as flat astropy tables of the rows of one chunk each.
+
+    The tables are those of read_outflows, split by chunks of chunk_rows stored
+    rows (so after filtering with where, they may be shorter or empty). Only the
+    galaxies and one chunk of rows are held in memory at a time, so files
+    larger than memory can be streamed.
+    """
+    import h5py
+
+    with h5py.File(path, "r") as file:
+        galaxy_rows, outflows, names, outflow_where, galaxy_where = _population_selection(
+            file, columns, where, chunk_rows
+        )
+        outflow_columns, galaxy_columns = names
+        if columns is None:
+            columns = outflow_columns[1:] + galaxy_columns[1:] + ["id"]
+        if galaxy_rows is None:
+            outflow_columns = outflow_columns + galaxy_columns[1:]
+        for rows in _iter_rows(outflows, outflow_columns, outflow_where + galaxy_where, chunk_rows):
+            if galaxy_rows is None:
+                # Flat layout: the galaxy columns are on the rows already
+                import astropy.table
+
+                yield astropy.table.Table([rows[name] for name in columns], names=columns, copy=False)
+            else:
+                yield flatten_population(galaxy_rows, rows, columns)
+
+
+def _population_selection(file, columns, where, chunk_rows):
+    # The galaxy rows (None for the flat layout), the outflow dataset, the outflow and
+    # galaxy columns to read, each starting with "id", and the (name, predicate) pairs
+    # on outflow and on galaxy columns to filter the outflow rows with. Those on galaxy
+    # columns are only left for the flat layout; otherwise, they have selected the
+    # galaxy rows, and an "id" predicate on the outflow rows keeps those of the
+    # selected galaxies.
+    where = where or {}
+    outflows = file[OUTFLOW_DATASET]
+    outflow_names = [name for name, _, _ in OUTFLOW_SCHEMA]
+    if GALAXIES_DATASET in file:
+        galaxies = file[GALAXIES_DATASET]
+        galaxy_names = [name for name in galaxies.dtype.names if name != "id"]
+    else:
+        galaxies = None
+        galaxy_names = [name for name in outflows.dtype.names if name not in outflow_names + ["id"]]
+
+    if columns is None:
+        columns = outflow_names + galaxy_names
+    unknown = (set(columns) | set(where)) - set(outflow_names + galaxy_names + ["id"])
+    if unknown:
+        raise KeyError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    outflow_columns = ["id"] + [name for name in outflow_names if name in columns]
+    galaxy_columns = ["id"] + [name for name in galaxy_names if name in columns]
+    outflow_where = [(name, where[name]) for name in where if name not in galaxy_names]
+    galaxy_where = [(name, where[name]) for name in where if name in galaxy_names]
+
+    if galaxies is None:
+        return None, outflows, (outflow_columns, galaxy_columns), outflow_where, galaxy_where
+    galaxy_rows = _read_rows(galaxies, galaxy_columns, galaxy_where, chunk_rows)
+    if galaxy_where:
+        outflow_where.append(("id", lambda ids: np.isin(ids, galaxy_rows["id"])))
+    return galaxy_rows, outflows, (outflow_columns, galaxy_columns), outflow_where, []
+
+
+def _read_flat_population(outflows, names, outflow_where, galaxy_where, chunk_rows):
+    # read_population of a flat layout file in one pass: the galaxies are taken from
+    # the rows that pass the predicates on galaxy columns, before those on outflow
+    # columns select the outflow rows
+    outflow_columns, galaxy_columns = names
+    empty_rows = np.empty(0, dtype=outflows.dtype)
+    galaxy_chunks = [_select_fields(empty_rows, galaxy_columns)]
+    outflow_chunks = [_select_fields(empty_rows, outflow_columns)]
+    for rows in _iter_rows(outflows, outflows.dtype.names, galaxy_where, chunk_rows):
+        _, first_rows = np.unique(rows["id"], return_index=True)
+        galaxy_chunks.append(_select_fields(rows[first_rows], galaxy_columns))
+        outflow_chunks.append(_select_fields(_filter_rows(rows, outflow_where), outflow_columns))
+
+    # The rows of a galaxy may span chunks
+    galaxy_rows = np.concatenate(galaxy_chunks)
+    _, first_rows = np.unique(galaxy_rows["id"], return_index=True)
+    return galaxy_rows[first_rows], np.concatenate(outflow_chunks)
+
+
+def _iter_rows(dataset, names, where, chunk_rows):
+    # Rows of an hdf5 dataset with the fields in names, for which all (name,
+    # predicate) pairs in where hold, read and filtered chunk by chunk. The rows
+    # are stored whole, so chunks are read whole into one buffer; h5py field
+    # selection would read as much and convert more slowly.
+    buffer = np.empty(min(chunk_rows, len(dataset)), dtype=dataset.dtype)
+    for start in range(0, len(dataset), chunk_rows):
+        stop = min(start + chunk_rows, len(dataset))
+        rows = buffer[: stop - start]
+        dataset.read_direct(rows, np.s_[start:stop])
+        yield _select_fields(_filter_rows(rows, where), names)
+
+
+def _filter_rows(rows, where):
+    # The rows for which all (name, predicate) pairs in where hold
+    if not where:
+        return rows
+    return rows[np.logical_and.reduce([predicate(rows[name]) for name, predicate in where])]
+
+
+def _read_rows(dataset, names, where, chunk_rows):
+    # All rows of _iter_rows in one array
+    selected_rows = np.empty(len(dataset), dtype=[(name, dataset.dtype[name]) for name in names])
+    size = 0
+    for rows in _iter_rows(dataset, names, where, chunk_rows):
+        selected_rows[size : size + len(rows)] = rows
+        size += len(rows)
+    return selected_rows[:size]
+
+
+def _select_fields(rows, names):
+    selected = np.empty(len(rows), dtype=[(name, rows.dtype[name]) for name in names])
+    for name in names:
+        selected[name] = rows[name]
+    return selected
+
+
+class _AppendableDataset:
+    # Resizable, chunked and compressed dataset, created with the dtype of the first rows
+    def __init__(self, file, name, chunk_rows, compression, string_length):
+        self._file = file
+        self._name = name
+        self._chunk_rows = chunk_rows
+        self._compression = compression
+        self._string_length = string_length
+        self._dataset = None
+        self._buffer = []
+        self._buffered = 0
+
+    def __len__(self):
+        written = 0 if self._dataset is None else len(self._dataset)
+        return written + self._buffered
+
+    def append(self, rows):
+        if len(rows) == 0:
+            return
+        self._buffer.append(rows)
+        self._buffered += len(rows)
+        if self._buffered >= self._chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        rows = np.concatenate(self._buffer)
+        if self._dataset is None:
+            self._dataset = self._file.create_dataset(
+                self._name,
+                shape=(0,),
+                maxshape=(None,),
+                dtype=self._storage_dtype(rows.dtype),
+                # Chunks are allocated in full, so small datasets get smaller chunks
+                chunks=(min(self._chunk_rows, len(rows)),),
+                compression=self._compression,
+            )
+        rows = rows.astype(self._dataset.dtype)
+        start = len(self._dataset)
+        self._dataset.resize((start + len(rows),))
+        self._dataset[start:] = rows
+        self._buffer = []
+        self._buffered = 0
+
+    def _storage_dtype(self, dtype):
+        # hdf5 has no fixed-length unicode type
+        return np.dtype(
+            [
+                (name, f"S{max(dtype[name].itemsize // 4, self._string_length)}")
+                if dtype[name].kind == "U"
+                else (name, dtype[name])
+                for name in dtype.names
+            ]
+        )
+
+
+class OutflowWriter:
+    """Appends rows to resizable, chunked and compressed hdf5 datasets.
+
+    Rows (structured arrays, with the same fields for all appends to one dataset)
+    are buffered until a chunk is full, so memory use does not grow with the
+    number of rows written. Unicode fields are stored as byte strings of at least
+    string_length characters. Populations are written as galaxy_rows to
+    GALAXIES_DATASET and outflow_rows to OUTFLOW_DATASET, and read back with
+    read_population.
+    """
+
+    def __init__(self, path, chunk_rows=8192, compression="gzip", string_length=32):
+        import h5py
+
+        self.path = path
+        self._file = h5py.File(path, "w")
+        self._datasets = {}
+        self._options = (chunk_rows, compression, string_length)
+
+    def __len__(self):
+        # Outflow rows written so far
+        return self.rows(OUTFLOW_DATASET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def rows(self, dataset):
+        return len(self._datasets[dataset]) if dataset in self._datasets else 0
+
+    def append(self, rows, dataset=OUTFLOW_DATASET):
+        if dataset not in self._datasets:
+            self._datasets[dataset] = _AppendableDataset(self._file, dataset, *self._options)
+        self._datasets[dataset].append(rows)
+
+    def append_galaxy(self, galaxy_table, outflow_array, galaxy_id):
+        """Append one galaxy (e.g. Galaxy.to_table()) and its outflow rows."""
+        self.append(galaxy_rows(galaxy_table, galaxy_id), GALAXIES_DATASET)
+        self.append(outflow_rows(outflow_array, galaxy_id), OUTFLOW_DATASET)
+
+    def close(self):
+        if self._file:
+            for dataset in self._datasets.values():
+                dataset.flush()
+            self._file.close()
+
+
+def iter_rows(path, dataset=OUTFLOW_DATASET, chunk_rows=8192):
+    """Read the rows of an hdf5 dataset (e.g. written by OutflowWriter) in slices."""
+    import h5py
+
+    with h5py.File(path, "r") as file:
+        rows = file[dataset]
+        for start in range(0, len(rows), chunk_rows):
+            yield rows[start : start + chunk_rows]
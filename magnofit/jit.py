@@ -0,0 +1,352 @@
+"""Compiled integration loop for run_outflow_simulation (backend="numba").
+
+The loop below repeats the steps of the pure-Python integrator on plain floats,
+with the built-in mass profiles and fade models selected by integer codes, so
+that Numba can compile it as a whole. Numba is an optional dependency; without
+it, NUMBA_AVAILABLE is False and the functions here are ordinary (slow) Python.
+"""
+
+import math
+
+import numpy as np
+
+from . import constants as const
+from .calc import luminosity as lc
+from .calc import mass as mc
+from .trajectory import TRAJECTORY_COLUMNS
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+
+def _jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+# Supported components; subclasses may override the physics, so types must match exactly
+MASS_PROFILES = {
+    mc.MassNFW: 0,
+    mc.MassIsothermal: 1,
+    mc.MassHernquist: 2,
+    mc.MassJaffe: 3,
+    mc.MassAlpha: 4,
+}
+FADES = {
+    lc.LuminosityFadeNone: 0,
+    lc.LuminosityFadeExponential: 1,
+    lc.LuminosityFadePowerLaw: 2,
+    lc.LuminosityFadeKing: 3,
+}
+
+# Galaxy parameters passed to the compiled loop, in this order
+GALAXY_FIELDS = (
+    "halo_mass",
+    "halo_scale_radius",
+    "halo_concentration",
+    "halo_gas_fraction",
+    "bulge_mass",
+    "bulge_scale_radius",
+    "bulge_gas_fraction",
+    "eddington_ratio",
+    "eddington_ratio_shutdown",
+    "drop_timescale",
+    "alpha_drop",
+    "quasar_activity_duration",
+    "quasar_repetition_timescale",
+    "quasar_lum_variation_timescale",
+    "salpeter_timescale",
+    "smbh_mass",
+)
+
+EPS = float(np.finfo(float).eps)
+VELOCITY_CAP = const.WIND_VELOCITY
+
+
+def supports(params):
+    """Whether the compiled loop implements the profiles and fade of params."""
+    return (
+        type(params.halo_profile) in MASS_PROFILES
+        and type(params.bulge_profile) in MASS_PROFILES
+        and type(params.fade) in FADES
+    )
+
+
+@_jit
+def _mass_fractions(code, alpha, scaled_radius, scaled_dot_radius, scaled_dotdot_radius, concentration):
+    # See the calculate_fractions methods in magnofit.calc.mass; densities are not needed here
+    if code == 0:
+        concentration_term = math.log(1. + concentration) - concentration / (1. + concentration)
+        mass_fraction = (math.log(1. + scaled_radius) - scaled_radius / (1. + scaled_radius)) / concentration_term
+        dot_mass_fraction = scaled_dot_radius * scaled_radius / ((1. + scaled_radius) ** 2) / concentration_term
+        dotdot_mass_fraction = (scaled_dotdot_radius * scaled_radius / ((1. + scaled_radius) ** 2) + scaled_dot_radius ** 2 * (1. - scaled_radius) / ((1. + scaled_radius) ** 3)) / concentration_term
+    elif code == 1:
+        mass_fraction = scaled_radius
+        dot_mass_fraction = scaled_dot_radius
+        dotdot_mass_fraction = scaled_dotdot_radius
+    elif code == 2:
+        mass_fraction = scaled_radius ** 2. / ((1. + scaled_radius) ** 2.)
+        dot_mass_fraction = scaled_dot_radius * 2. * scaled_radius / ((1. + scaled_radius) ** 3.)
+        dotdot_mass_fraction = 2. * (scaled_dotdot_radius * scaled_radius + scaled_dot_radius ** 2. * (1. - 2. * scaled_radius) / (1. + scaled_radius)) / ((1. + scaled_radius) ** 3.)
+    elif code == 3:
+        mass_fraction = scaled_radius / (1. + scaled_radius)
+        dot_mass_fraction = scaled_dot_radius / ((1. + scaled_radius) ** 2.)
+        dotdot_mass_fraction = scaled_dotdot_radius / ((1. + scaled_radius) ** 2.) + scaled_dot_radius ** 2. * 2. / ((1. + scaled_radius) ** 3.)
+    else:
+        mass_fraction = scaled_radius ** (3 - alpha)
+        dot_mass_fraction = (3 - alpha) * scaled_radius ** (2 - alpha) * scaled_dot_radius
+        dotdot_mass_fraction = (3 - alpha) * (2 - alpha) * scaled_radius ** (1 - alpha) * scaled_dot_radius ** 2 + (3 - alpha) * scaled_radius ** (2 - alpha) * scaled_dotdot_radius
+
+    # Truncated profiles (see magnofit.calc.mass.clamp_fractions)
+    if (code == 0 or code == 1 or code == 4) and mass_fraction > 1.:
+        return 1., 0., 0.
+
+    return mass_fraction, dot_mass_fraction, dotdot_mass_fraction
+
+
+@_jit
+def _mass_component(code, alpha, radius, dot_radius, dotdot_radius, total_mass, scale_length, concentration, gas_fraction):
+    # See Mass.calculate
+    mass_fraction, dot_mass_fraction, dotdot_mass_fraction = _mass_fractions(
+        code, alpha, radius / scale_length, dot_radius / scale_length, dotdot_radius / scale_length, concentration
+    )
+
+    mass_potential = total_mass * mass_fraction * (1 - gas_fraction)
+    dot_mass_potential = total_mass * dot_mass_fraction * (1 - gas_fraction)
+    mass_gas = total_mass * mass_fraction * gas_fraction
+    dot_mass_gas = total_mass * dot_mass_fraction * gas_fraction
+    dotdot_mass_gas = total_mass * dotdot_mass_fraction * gas_fraction
+
+    return mass_potential, dot_mass_potential, mass_gas, dot_mass_gas, dotdot_mass_gas
+
+
+@_jit
+def _luminosity_coefficient(code, time_eff, eddington_ratio, drop_timescale, alpha_drop, variation_timescale):
+    # See the luminosity_coefficient methods in magnofit.calc.luminosity
+    if code == 3:
+        return eddington_ratio * (1 + time_eff / variation_timescale) ** (-19. / 16.)
+    if time_eff <= variation_timescale:
+        return eddington_ratio
+    if code == 0:
+        return 0.0
+    if code == 1:
+        return eddington_ratio * math.exp(-(time_eff - variation_timescale) / drop_timescale)
+    return eddington_ratio * (time_eff / variation_timescale) ** (-1. * alpha_drop)
+
+
+@_jit
+def _luminosity_mean_coefficient(code, time_start, duration, timestep, eddington_ratio, drop_timescale, alpha_drop, variation_timescale):
+    # See the luminosity_mean_coefficient methods in magnofit.calc.luminosity
+    if code == 0:
+        return eddington_ratio * duration / timestep
+    if code == 3:
+        return eddington_ratio * 16 * variation_timescale / (3 * timestep) * ((1 + time_start / variation_timescale) ** (-3./16.) - (1 + (time_start + duration) / variation_timescale) ** (-3./16.))
+    if time_start + duration <= variation_timescale:
+        return eddington_ratio
+    if code == 1:
+        if time_start <= variation_timescale:
+            return eddington_ratio * (variation_timescale - time_start) / timestep + eddington_ratio * drop_timescale / timestep * (1 - math.exp((variation_timescale - duration - time_start) / drop_timescale))
+        return eddington_ratio * drop_timescale / timestep * math.exp((variation_timescale - time_start) / drop_timescale) * (1 - math.exp(- duration / drop_timescale))
+    if alpha_drop == -1:
+        if time_start <= variation_timescale:
+            return eddington_ratio * (variation_timescale - time_start) / timestep + eddington_ratio * variation_timescale / timestep * math.log((time_start + duration) / variation_timescale)
+        return eddington_ratio * variation_timescale / timestep * math.log((time_start + duration) / time_start)
+    if time_start <= variation_timescale:
+        return eddington_ratio * (variation_timescale - time_start) / timestep + eddington_ratio * variation_timescale ** alpha_drop / (timestep * (1. - alpha_drop)) * (variation_timescale ** (1. - alpha_drop) - (time_start + duration) ** (1. - alpha_drop))
+    return eddington_ratio * variation_timescale ** alpha_drop / (timestep * (1. - alpha_drop)) * (time_start ** (1. - alpha_drop) - (time_start + duration) ** (1. - alpha_drop))
+
+
+@_jit
+def _rtdot(luminosity, mass_gas, mdot_gas, mddot_gas, mass_pot, mdot_pot, radius, rdot, rddot):
+    # Equation of motion, see magnofit.calc.time.rtdot_calc (G = 1 in code units)
+    A_term = mdot_gas * rdot**2 + mass_gas * rdot * rddot + 2 * rdot / radius**2 * (mass_gas * mass_pot + mass_gas**2 / 2)
+    B_term = mddot_gas * rdot / mass_gas + mdot_gas * rdot**2 / (mass_gas * radius) + 2 * mdot_gas * rddot / mass_gas + rdot * rddot / radius + (mdot_gas * mass_pot + mass_gas * mdot_pot + mass_gas * mdot_gas) / (mass_gas * radius**2) - (2 * mass_gas * mass_pot * rdot + mass_gas**2 * rdot) / (2 * mass_gas * radius**3)
+
+    return 3 * (const.GAMMA - 1) / (mass_gas * radius) * (const.ETA_DRIVE * luminosity - A_term) - B_term
+
+
+@_jit
+def _integrate(
+    halo_code,
+    halo_alpha,
+    bulge_code,
+    bulge_alpha,
+    fade_code,
+    galaxy,
+    radius,
+    dot_radius,
+    smbh_grows,
+    max_timesteps,
+    max_time,
+    max_radius,
+    dt_min,
+):
+    """Integrate one outflow, see run_outflow_simulation.
+
+    Returns the recorded rows (one row of TRAJECTORY_COLUMNS per column of the
+    returned array), the number of rows and the step at which the radius became
+    negative (0 if it never did).
+    """
+    (
+        halo_mass,
+        halo_scale_radius,
+        halo_concentration,
+        halo_gas_fraction,
+        bulge_mass,
+        bulge_scale_radius,
+        bulge_gas_fraction,
+        eddington_ratio,
+        eddington_ratio_shutdown,
+        drop_timescale,
+        alpha_drop,
+        quasar_activity_duration,
+        quasar_repetition_timescale,
+        variation_timescale,
+        salpeter_timescale,
+        smbh_mass,
+    ) = galaxy
+
+    trajectory = np.empty((10, max_timesteps))
+    dtmax = quasar_activity_duration * 0.1
+    agn_episode_start_flag = 0
+    courant_factor = 0.02
+
+    dotdot_radius = 0.0
+    dotdotdot_radius = 0.0
+    time = 0.0
+
+    timestep = 0
+    while timestep < max_timesteps - 1 and time < max_time and radius < max_radius:
+        timestep += 1
+
+        halo_potential, halo_dot_potential, halo_gas, halo_dot_gas, halo_dotdot_gas = _mass_component(
+            halo_code, halo_alpha, radius, dot_radius, dotdot_radius,
+            halo_mass, halo_scale_radius, halo_concentration, halo_gas_fraction,
+        )
+        bulge_potential, bulge_dot_potential, bulge_gas, bulge_dot_gas, bulge_dotdot_gas = _mass_component(
+            bulge_code, bulge_alpha, radius, dot_radius, dotdot_radius,
+            bulge_mass, bulge_scale_radius, np.nan, bulge_gas_fraction,
+        )
+        mass_potential = halo_potential + bulge_potential
+        dot_mass_potential = halo_dot_potential + bulge_dot_potential
+        mass_gas = halo_gas + bulge_gas
+        dot_mass_gas = halo_dot_gas + bulge_dot_gas
+        dotdot_mass_gas = halo_dotdot_gas + bulge_dotdot_gas
+
+        # Courant-like criterion
+        dot_t1 = radius / (abs(dot_radius) + EPS)
+        dot_t2 = dot_radius / (abs(dotdot_radius) + EPS)
+        dot_t3 = dotdot_radius / (abs(dotdotdot_radius) + EPS)
+        if dot_radius >= VELOCITY_CAP:
+            dot_t3 = math.inf
+        dt = courant_factor * min(abs(dot_t1), abs(dot_t2), abs(dot_t3))
+
+        if agn_episode_start_flag > 0:
+            dt = dt_min
+            agn_episode_start_flag += 1
+            if agn_episode_start_flag > 3:
+                agn_episode_start_flag = 0
+
+        next_rep = (time + dt) // quasar_repetition_timescale
+        if next_rep > time // quasar_repetition_timescale:
+            agn_episode_start_flag = 1
+            dt = quasar_repetition_timescale * next_rep - time + EPS
+
+        dt = max(dt, dt_min)
+        dt = min(dt, dtmax)
+
+        time_eff = time % quasar_repetition_timescale
+
+        mean_luminosity_coef = _luminosity_coefficient(
+            fade_code, time_eff, eddington_ratio, drop_timescale, alpha_drop, variation_timescale
+        )
+        if mean_luminosity_coef >= eddington_ratio_shutdown:
+            predicted_luminosity_coef = _luminosity_coefficient(
+                fade_code, time_eff + dt, eddington_ratio, drop_timescale, alpha_drop, variation_timescale
+            )
+            if predicted_luminosity_coef >= eddington_ratio_shutdown:
+                duration = dt
+            else:
+                duration = quasar_activity_duration - time_eff
+            mean_luminosity_coef = _luminosity_mean_coefficient(
+                fade_code, time_eff, duration, dt, eddington_ratio, drop_timescale, alpha_drop, variation_timescale
+            )
+        else:
+            mean_luminosity_coef = 0.0
+
+        mean_luminosity = mean_luminosity_coef * (const.LUMINOSITY_EDD * (smbh_mass * const.UNIT_MSUN) * const.UNIT_TIME / const.UNIT_ENERGY)
+
+        row = timestep - 1
+        trajectory[0, row] = radius
+        trajectory[1, row] = dot_radius
+        trajectory[2, row] = dotdot_radius
+        trajectory[3, row] = dotdotdot_radius
+        trajectory[4, row] = mass_gas
+        trajectory[5, row] = mass_gas + mass_potential
+        trajectory[6, row] = dot_mass_gas
+        trajectory[7, row] = time
+        trajectory[8, row] = dt
+        trajectory[9, row] = smbh_mass
+
+        if smbh_grows:
+            smbh_mass *= math.exp(mean_luminosity_coef * dt / salpeter_timescale)
+
+        # See magnofit.calc.time.simple_time_step and cap_velocities
+        next_dotdotdot_radius = _rtdot(
+            mean_luminosity, mass_gas, dot_mass_gas, dotdot_mass_gas, mass_potential,
+            dot_mass_potential, radius, dot_radius, dotdot_radius,
+        )
+        next_dotdot_radius = dotdot_radius + next_dotdotdot_radius * dt
+        next_dot_radius = dot_radius + next_dotdot_radius * dt + 0.5 * next_dotdotdot_radius * (dt ** 2.)
+        if next_dot_radius > VELOCITY_CAP:
+            next_dot_radius = VELOCITY_CAP
+            if next_dotdot_radius > 0:
+                next_dotdot_radius = 0.
+            if next_dotdotdot_radius > 0:
+                next_dotdotdot_radius = 0.
+        next_radius = radius + next_dot_radius * dt + 0.5 * next_dotdot_radius * dt ** 2. + (1. / 6.) * next_dotdotdot_radius * dt ** 3.
+
+        if next_radius < 0.0:
+            return trajectory, timestep, timestep
+
+        radius = next_radius
+        dot_radius = next_dot_radius
+        dotdot_radius = next_dotdot_radius
+        dotdotdot_radius = next_dotdotdot_radius
+        time = time + dt
+
+    return trajectory, timestep, 0
+
+
+def integrate_outflow(params, radius, dot_radius, smbh_grows, max_timesteps, max_time, max_radius, dt_min):
+    """Run the compiled loop for a CompiledGalaxy.
+
+    Returns the trajectory as a dict of TRAJECTORY_COLUMNS arrays, or None if
+    the calculation failed due to a negative radius.
+    """
+    galaxy = tuple(float(getattr(params, name)) for name in GALAXY_FIELDS)
+    trajectory, size, failed_step = _integrate(
+        MASS_PROFILES[type(params.halo_profile)],
+        float(getattr(params.halo_profile, "alpha", 0.0)),
+        MASS_PROFILES[type(params.bulge_profile)],
+        float(getattr(params.bulge_profile, "alpha", 0.0)),
+        FADES[type(params.fade)],
+        galaxy,
+        float(radius),
+        float(dot_radius),
+        bool(smbh_grows),
+        int(max_timesteps),
+        float(max_time),
+        float(max_radius),
+        float(dt_min),
+    )
+
+    if failed_step:
+        return None
+
+    return {name: trajectory[i, :size] for i, name in enumerate(TRAJECTORY_COLUMNS)}
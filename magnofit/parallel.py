@@ -0,0 +1,512 @@
+import dataclasses
+import importlib
+import inspect
+import math
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.managers import BaseManager
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from . import io
+from .simulation import run_outflow_simulation
+from .termination import TerminationReason
+
+# Modules a WorkerPool imports in its workers before the first batch
+PRELOAD_MODULES = ("numpy", "magnofit.simulation", "magnofit.parallel")
+
+# Outflow rows as returned by the workers: the index of the galaxy in the population,
+# then the columns of an outflow table
+OUTFLOW_ROW_DTYPE = np.dtype([("id", np.int64)] + io.OUTFLOW_DTYPE.descr)
+
+
+@dataclasses.dataclass
+class PopulationOutflows:
+    """Outflows of galaxies of a population, as plain arrays.
+
+    index holds the indices of the galaxies in the population. rows holds the rows
+    of all accepted outflows (OUTFLOW_ROW_DTYPE), grouped by galaxy in the order of
+    index, with the index of their galaxy as id. counts is the number of rows of
+    every galaxy (0 if its outflow was rejected), n_steps the number of integration
+    steps (-1 if rejected), reasons the TerminationReason code and seconds the time
+    the worker spent simulating it.
+    """
+
+    index: np.ndarray
+    rows: np.ndarray
+    counts: np.ndarray
+    n_steps: np.ndarray
+    reasons: np.ndarray
+    seconds: np.ndarray
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def start(self):
+        """Index of the first galaxy."""
+        return int(self.index[0]) if len(self.index) else 0
+
+    @property
+    def elapsed(self):
+        return float(self.seconds.sum())
+
+    @property
+    def accepted(self):
+        return self.counts > 0
+
+    def split(self):
+        """Rows of every galaxy, in order (empty arrays for rejected outflows)."""
+        return np.split(self.rows, np.cumsum(self.counts)[:-1])
+
+    def tables(self):
+        """The tables run_outflow_simulation returns for these galaxies (None if rejected)."""
+        tables = []
+        for rows, n_steps, reason in zip(self.split(), self.n_steps, self.reasons):
+            table = None
+            if len(rows):
+                table = io.outflow_array_to_table(rows[list(io.OUTFLOW_DTYPE.names)])
+                table.meta["n_steps"] = int(n_steps)
+                table.meta["termination_reason"] = TerminationReason(reason).name
+            tables.append(table)
+        return tables
+
+    def take(self, positions):
+        """The outflows of the galaxies at the given positions, in that order."""
+        positions = np.asarray(positions, dtype=np.int64)
+        counts = self.counts[positions]
+        rows = self.rows
+        if rows is not None:
+            # Shift every row of the taken galaxies from its place in the result to
+            # its place in rows
+            offsets = np.cumsum(self.counts) - self.counts
+            shifts = offsets[positions] - (np.cumsum(counts) - counts)
+            rows = rows[np.arange(counts.sum()) + np.repeat(shifts, counts)]
+        return PopulationOutflows(
+            index=self.index[positions],
+            rows=rows,
+            counts=counts,
+            n_steps=self.n_steps[positions],
+            reasons=self.reasons[positions],
+            seconds=self.seconds[positions],
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        parts = list(parts)
+        rows = [part.rows for part in parts]
+        return cls(
+            index=np.concatenate([part.index for part in parts] or [np.empty(0, np.int64)]),
+            rows=(
+                None
+                if any(part_rows is None for part_rows in rows)
+                else np.concatenate(rows or [np.empty(0, OUTFLOW_ROW_DTYPE)])
+            ),
+            counts=np.concatenate([part.counts for part in parts] or [np.empty(0, np.int64)]),
+            n_steps=np.concatenate([part.n_steps for part in parts] or [np.empty(0, np.int64)]),
+            reasons=np.concatenate([part.reasons for part in parts] or [np.empty(0, np.int8)]),
+            seconds=np.concatenate([part.seconds for part in parts] or [np.empty(0)]),
+        )
+
+
+def simulate_population(population, seeds=None, index=None, **simulation_kwargs):
+    """Simulate every galaxy of a population in this process.
+
+    seeds holds one seed per galaxy for its rng (default_rng(seed)); without
+    seeds, all rows of every outflow are returned, as with rng=None. index holds
+    the ids of the galaxies (default 0, 1, ...).
+    """
+    index = np.arange(len(population)) if index is None else np.asarray(index, dtype=np.int64)
+    counts = np.zeros(len(population), dtype=np.int64)
+    n_steps = np.full(len(population), -1, dtype=np.int64)
+    reasons = np.empty(len(population), dtype=np.int8)
+    seconds = np.empty(len(population))
+    rows = []
+    for i, galaxy in enumerate(population):
+        started = time.perf_counter()
+        rng = None if seeds is None else np.random.default_rng(seeds[i])
+        outflow, reasons[i] = run_outflow_simulation(
+            galaxy, rng=rng, return_reason=True, output="numpy", **simulation_kwargs
+        )
+        if outflow is not None:
+            counts[i] = len(outflow)
+            n_steps[i] = outflow.meta["n_steps"]
+            rows.append(io.outflow_rows(outflow.data, index[i]))
+        seconds[i] = time.perf_counter() - started
+
+    return PopulationOutflows(
+        index=index,
+        rows=np.concatenate(rows) if rows else np.empty(0, OUTFLOW_ROW_DTYPE),
+        counts=counts,
+        n_steps=n_steps,
+        reasons=reasons,
+        seconds=seconds,
+    )
+
+
+def _simulate_chunk(task):
+    index, population, seeds, simulation_kwargs, shared_rows = task
+    result = simulate_population(population, seeds, index, **simulation_kwargs)
+    if shared_rows is not None:
+        # Every galaxy has output_array_length slots in the shared buffer; only the
+        # counts travel back to the parent process
+        name, slots, size = shared_rows
+        memory = _attach_shared_memory(name)
+        try:
+            buffer = np.ndarray((size, slots), dtype=OUTFLOW_ROW_DTYPE, buffer=memory.buf)
+            for i, galaxy_rows in zip(index, result.split()):
+                buffer[i, : len(galaxy_rows)] = galaxy_rows
+            del buffer
+        finally:
+            memory.close()
+        result.rows = None
+    return result
+
+
+def _attach_shared_memory(name):
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the block with the resource tracker,
+        # which would destroy it when this worker exits
+        memory = SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+def _simulation_default(name):
+    return inspect.signature(run_outflow_simulation).parameters[name].default
+
+
+class CostModel:
+    """Estimates how long the simulation of every galaxy of a population takes.
+
+    The number of integration steps is modelled as log(steps) = coefficients @
+    features, with the features 1, log of the number of AGN episodes before
+    max_time, log(duty_cycle) and log(virial_mass), and capped at max_timesteps.
+    Every AGN episode starts with dt_min steps and is resolved in steps of at most
+    a tenth of quasar_activity_duration, so runs with many episodes take longest.
+    A run takes seconds_per_step times its steps.
+
+    update() refits both from finished runs. The initial values count as
+    prior_weight runs, so that the first few timings do not swing the estimates.
+    """
+
+    # Fitted to galaxies of tools/generate.py run without a step limit
+    coefficients = np.array([6.1, 0.57, -0.95, 0.17])
+    seconds_per_step = 2.5e-5
+
+    def __init__(self, max_time=None, max_timesteps=None, prior_weight=20.0):
+        self.max_time = _simulation_default("max_time") if max_time is None else max_time
+        self.max_timesteps = (
+            _simulation_default("max_timesteps") if max_timesteps is None else max_timesteps
+        )
+        self.prior_weight = prior_weight
+        # Normal equations of the step model and the sum of the time per step of
+        # every run, both starting from the prior
+        self._gram = prior_weight * np.eye(len(self.coefficients))
+        self._moment = prior_weight * self.coefficients
+        self._seconds_per_step = prior_weight * self.seconds_per_step
+        self._known = 0
+        self.coefficients = self.coefficients.copy()
+        self.observed = 0
+
+    @classmethod
+    def for_simulation(cls, max_time=None, max_timesteps=None, **simulation_kwargs):
+        """A cost model for runs with the given run_outflow_simulation arguments."""
+        return cls(max_time=max_time, max_timesteps=max_timesteps)
+
+    def features(self, population):
+        episodes = self.max_time / population.quasar_repetition_timescale
+        return np.column_stack(
+            [
+                np.ones(len(population)),
+                np.log(np.maximum(episodes, 1.0)),
+                np.log(population.duty_cycle),
+                np.log(population.virial_mass),
+            ]
+        )
+
+    def predict(self, population):
+        """Estimated seconds per galaxy."""
+        return self._predict(self.features(population))
+
+    def update(self, population, result):
+        """Refit from the PopulationOutflows of simulating population."""
+        self._update(self.features(population), result)
+
+    def _predict(self, features):
+        steps = np.minimum(np.exp(features @ self.coefficients), self.max_timesteps)
+        return self.seconds_per_step * steps
+
+    def _update(self, features, result):
+        steps = result.n_steps.astype(np.float64)
+        steps[result.reasons == TerminationReason.MAX_TIMESTEPS] = self.max_timesteps
+        known = steps > 0
+        self._known += np.count_nonzero(known)
+        self._seconds_per_step += np.sum(result.seconds[known] / steps[known])
+        self.seconds_per_step = self._seconds_per_step / (self.prior_weight + self._known)
+        # Rejected runs do not report their steps; their time tells them
+        steps[~known] = result.seconds[~known] / self.seconds_per_step
+
+        self._gram += features.T @ features
+        self._moment += features.T @ np.log(np.maximum(steps, 1.0))
+        self.coefficients = np.linalg.solve(self._gram, self._moment)
+        self.observed += len(result)
+
+
+class _Scheduler:
+    # Hands out chunks of galaxies worth about target_seconds each, the most
+    # expensive first, from the galaxies within lookahead of the first one whose
+    # result has not been yielded yet
+    def __init__(self, cost_model, features, processes, chunk_size, target_seconds, lookahead):
+        self.cost_model = cost_model
+        self.features = features
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.target_seconds = target_seconds
+        self.lookahead = lookahead
+        self.pending = np.ones(len(features), dtype=bool)
+
+    def next_chunk(self, first):
+        window = first + np.flatnonzero(self.pending[first : first + self.lookahead])
+        if not len(window):
+            return window
+        costs = self.cost_model._predict(self.features[window])
+        # Stable, so that galaxies of equal cost go in order
+        order = np.argsort(-costs, kind="stable")
+        if self.chunk_size is not None:
+            size = self.chunk_size
+        else:
+            if self.cost_model.observed:
+                size = 1 + np.searchsorted(np.cumsum(costs[order]), self.target_seconds)
+            else:
+                # Single galaxies until the first timings arrive
+                size = 1
+            # Never more than an even share of the pending galaxies
+            size = min(size, math.ceil(np.count_nonzero(self.pending) / self.processes))
+        chunk = np.sort(window[order[:size]])
+        self.pending[chunk] = False
+        return chunk
+
+    def update(self, result):
+        self.cost_model._update(self.features[result.index], result)
+
+
+def imap_population(
+    population,
+    seeds=None,
+    processes=None,
+    pool=None,
+    chunk_size=None,
+    target_chunk_seconds=1.0,
+    lookahead=None,
+    cost_model=None,
+    _shared_rows=None,
+    **simulation_kwargs,
+):
+    """Simulate a population in worker processes, yielding PopulationOutflows in order.
+
+    Workers receive chunks of the population (its arrays, not Galaxy objects) and
+    the seeds, and return plain arrays. Galaxies are dispatched longest first, by
+    the runtime that cost_model (default: CostModel.for_simulation) predicts from
+    their parameters and refits from the timings of every finished chunk, so that
+    the run does not end on a few long simulations. Each worker takes a new chunk
+    as soon as it is done, and unless chunk_size is given, chunks are sized to take
+    about target_chunk_seconds.
+
+    Results are yielded in galaxy order, so every galaxy waits for all earlier
+    ones. lookahead limits dispatching to that many galaxies from the first one
+    not yielded yet (default: the whole population), which bounds the results held
+    back. pool is an optional multiprocessing pool to use instead of starting one
+    with the given number of processes. See simulate_population for seeds and
+    run_outflow_simulation for simulation_kwargs.
+    """
+    processes = processes or os.cpu_count()
+    seeds = None if seeds is None else np.asarray(seeds)
+    if cost_model is None:
+        cost_model = CostModel.for_simulation(**simulation_kwargs)
+    scheduler = _Scheduler(
+        cost_model,
+        cost_model.features(population),
+        processes,
+        chunk_size,
+        target_chunk_seconds,
+        lookahead or len(population),
+    )
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    # Completed chunks are handed over by the pool's result thread
+    finished = queue.Queue()
+
+    next_yield, in_flight, completed = 0, 0, []
+    done = np.zeros(len(population) + 1, dtype=bool)
+    try:
+        while next_yield < len(population):
+            # Two chunks per process keep the workers busy while results are collected
+            while in_flight < 2 * processes:
+                index = scheduler.next_chunk(next_yield)
+                if not len(index):
+                    break
+                task = (
+                    index,
+                    population[index],
+                    None if seeds is None else seeds[index],
+                    simulation_kwargs,
+                    _shared_rows,
+                )
+                pool.apply_async(
+                    _simulate_chunk, (task,), callback=finished.put, error_callback=finished.put
+                )
+                in_flight += 1
+
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            in_flight -= 1
+            scheduler.update(result)
+            done[result.index] = True
+            completed.append(result)
+            if not done[next_yield]:
+                continue
+
+            # Yield the galaxies up to the next one still running
+            stop = next_yield + int(np.argmin(done[next_yield:]))
+            ready, completed = _split_completed(completed, stop)
+            next_yield = stop
+            yield ready
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def _split_completed(parts, stop):
+    # The outflows of the galaxies before stop, in order, and the remaining parts
+    ready, remaining = [], []
+    for part in parts:
+        before = part.index < stop
+        if before.all():
+            ready.append(part)
+        elif before.any():
+            ready.append(part.take(np.flatnonzero(before)))
+            remaining.append(part.take(np.flatnonzero(~before)))
+        else:
+            remaining.append(part)
+    ready = PopulationOutflows.concatenate(ready)
+    return ready.take(np.argsort(ready.index)), remaining
+
+
+def run_population(population, seeds=None, shared_memory=False, **kwargs):
+    """Simulate a population in worker processes and return one PopulationOutflows.
+
+    With shared_memory=True, workers write their rows into a shared memory block
+    instead of sending them back; this requires seeds, so that every outflow has
+    at most output_array_length rows. Other arguments are those of
+    imap_population.
+    """
+    if not shared_memory:
+        return PopulationOutflows.concatenate(imap_population(population, seeds, **kwargs))
+
+    if seeds is None:
+        raise ValueError("shared_memory requires seeds, which bound the number of rows per galaxy.")
+    slots = kwargs.get("output_array_length", 200)
+    size = len(population)
+    memory = SharedMemory(create=True, size=max(size * slots * OUTFLOW_ROW_DTYPE.itemsize, 1))
+    try:
+        result = PopulationOutflows.concatenate(
+            imap_population(population, seeds, _shared_rows=(memory.name, slots, size), **kwargs)
+        )
+        buffer = np.ndarray((size, slots), dtype=OUTFLOW_ROW_DTYPE, buffer=memory.buf)
+        result.rows = buffer[np.arange(slots) < result.counts[:, np.newaxis]]
+        del buffer
+    finally:
+        memory.close()
+        memory.unlink()
+    return result
+
+
+def _preload(modules):
+    for module in modules:
+        importlib.import_module(module)
+
+
+class WorkerPool:
+    """Worker processes that stay up to simulate any number of populations.
+
+    Starting workers and importing magnofit in them takes seconds, so workflows
+    that simulate many small batches should start one pool and pass every batch
+    to imap or run. Workers are started with start_method, "forkserver" by
+    default where available and "spawn" otherwise, so they do not inherit the
+    state of the parent process, and import preload when they start. With
+    forkserver, the server imports preload once and every worker is forked from
+    it ready to run.
+
+    Use the pool as a context manager, or close it when done.
+    """
+
+    def __init__(self, processes=None, start_method=None, preload=PRELOAD_MODULES):
+        if start_method is None:
+            methods = multiprocessing.get_all_start_methods()
+            start_method = "forkserver" if "forkserver" in methods else "spawn"
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            context.set_forkserver_preload(list(preload))
+        self.processes = processes or os.cpu_count()
+        self.start_method = start_method
+        self._pool = context.Pool(self.processes, initializer=_preload, initargs=(tuple(preload),))
+
+    def imap(self, population, seeds=None, **kwargs):
+        """imap_population in the workers of this pool."""
+        return imap_population(population, seeds, processes=self.processes, pool=self._pool, **kwargs)
+
+    def run(self, population, seeds=None, **kwargs):
+        """run_population in the workers of this pool."""
+        return run_population(population, seeds, processes=self.processes, pool=self._pool, **kwargs)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+class _PoolManager(BaseManager):
+    pass
+
+
+def serve_pool(address, authkey, **pool_kwargs):
+    """Serve a WorkerPool at address (host, port) until the process is stopped.
+
+    Other processes, e.g. successive runs of the generation tools, submit
+    populations to it with connect_pool, so that none of them starts workers.
+    authkey (bytes) must be given to connect. pool_kwargs are those of
+    WorkerPool.
+    """
+    with WorkerPool(**pool_kwargs) as pool:
+        _PoolManager.register("pool", callable=lambda: pool, exposed=("run",))
+        _PoolManager(address=address, authkey=authkey).get_server().serve_forever()
+
+
+def connect_pool(address, authkey):
+    """A proxy of the WorkerPool served at address; its run() simulates there."""
+    _PoolManager.register("pool")
+    manager = _PoolManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.pool()
@@ -1,12 +1,45 @@
 import dataclasses
-from copy import copy
+import os
+import warnings
 
 import numpy as np
 
 from . import constants as const
 from . import io
+from . import jit
 from .calc import time as tc
-from .galaxy import Galaxy
+from .galaxy import Galaxy, GalaxyPopulation, _shared_components
+from .termination import ACCEPTANCE_RADIUS, TerminationReason
+from .trajectory import TRAJECTORY_COLUMNS, TrajectoryBuffer, TrajectoryReservoir
+
+
+# Integrators for run_outflow_simulation; "adaptive" uses simple_time_step with
+# error-controlled timesteps (see run_outflow_simulation)
+INTEGRATORS = {
+    "simple": tc.simple_time_step,
+    "leapfrog_dkd": tc.leapfrog_dkd_time_step,
+    "leapfrog_kdk": tc.leapfrog_kdk_time_step,
+    "adaptive": None,
+}
+
+# Result types of run_outflow_simulation
+OUTPUTS = ("table", "numpy")
+# Bounds on the Courant factor of the adaptive integrator
+ADAPTIVE_COURANT_FACTOR_RANGE = (2e-4, 0.5)
+# Dormand-Prince 5(4) pair of the coasting steps with fast_forward: the coefficients
+# of the stages after the first, and the difference between the fifth and fourth
+# order weights of all stages
+DORMAND_PRINCE_STAGES = (
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+)
+DORMAND_PRINCE_ERROR = (
+    71 / 57600, 0.0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40
+)
 
 
 @dataclasses.dataclass
@@ -26,6 +59,10 @@ class OutflowState:
     time: float = 0.0
     dot_time: float = 0.0
 
+    # Largest radius reached so far and when it was reached, used by early exit predicates
+    peak_radius: float = 0.0
+    peak_time: float = 0.0
+
 
 def run_outflow_simulation(
     init_params: Galaxy,
@@ -36,19 +73,106 @@ def run_outflow_simulation(
     max_radius=12.0 / const.UNIT_KPC,
     dt_min=1.0 / const.UNIT_YEAR,
     rng=np.random.default_rng(0),
+    reservoir_sampling=False,
+    backend=None,
+    integrator="simple",
+    tolerance=1e-10,
+    fast_forward=False,
+    early_exit=(),
+    return_reason=False,
+    cache=None,
+    output="table",
 ):
-    dtmax = init_params.quasar_activity_duration * 0.1
+    """Simulate the outflow of a galaxy.
+
+    Returns an astropy table with the outflow properties at output_array_length
+    timesteps drawn at random (all timesteps if rng is None), or None if the
+    simulation failed or has no rows beyond the acceptance radius. With
+    output="numpy", the rows are returned as a magnofit.io.OutflowArray instead,
+    which is much cheaper to build; its to_astropy() gives the table.
+
+    early_exit is a sequence of magnofit.termination.EarlyExit predicates, e.g.
+    termination.default_early_exits(), which stop (and reject) runs whose output
+    would be rejected anyway. With return_reason=True, a tuple of the result and
+    a termination.TerminationReason is returned instead.
+
+    cache is an optional magnofit.cache.ResultCache; results of runs with the
+    same galaxy and arguments are then read from it instead of simulated.
+    """
+    if cache is not None:
+        # Every argument but the galaxy and the cache is part of the cache key
+        arguments = {
+            name: value for name, value in locals().items() if name not in ("init_params", "cache")
+        }
+        if backend is None:
+            arguments["backend"] = os.environ.get("MAGNOFIT_BACKEND", "python")
+        return cache.run(run_outflow_simulation, init_params, **arguments)
+
+    if output not in OUTPUTS:
+        raise ValueError(f"Unknown output {output!r}, expected one of {', '.join(OUTPUTS)}.")
+    if integrator not in INTEGRATORS:
+        raise ValueError(
+            f"Unknown integrator {integrator!r}, expected one of {', '.join(INTEGRATORS)}."
+        )
+    # The adaptive scheme advances with simple_time_step and adjusts the Courant factor
+    time_step = INTEGRATORS[integrator] or tc.simple_time_step
+
+    # Derived galaxy parameters are computed once instead of on every access
+    params = init_params.compile()
+    dtmax = params.quasar_activity_duration * 0.1
     agn_episode_start_flag = 0
     courant_factor = 0.02
+    # With fast_forward, the timestep of the error-controlled coasting steps in an
+    # AGN-off interval (see _coasting_step)
+    coasting_dt = None
 
     curr_outflow = OutflowState(
         radius=0.001 / const.UNIT_KPC,
         dot_radius=100000.0 / const.UNIT_VELOCITY,
     )
-    curr_galaxy = copy(init_params)
-
-    outflows = []
-    galaxy_params = []
+    curr_outflow.peak_radius = curr_outflow.radius
+    # The only galaxy parameter that evolves is smbh_mass; the trajectory is
+    # recorded column by column
+    smbh_mass = params.smbh_mass
+    trajectory = TrajectoryBuffer()
+
+    # With reservoir sampling, the output rows are drawn while integrating instead
+    # of from the complete trajectory, so only output_array_length rows are stored
+    reservoir = None
+    if reservoir_sampling and rng:
+        reservoir = TrajectoryReservoir(output_array_length, rng)
+
+    if _select_backend(backend, params, integrator, fast_forward or early_exit) == "numba":
+        trajectory = jit.integrate_outflow(
+            params,
+            curr_outflow.radius,
+            curr_outflow.dot_radius,
+            smbh_grows,
+            max_timesteps,
+            max_time,
+            max_radius,
+            dt_min,
+        )
+        if trajectory is None:
+            return _result(None, TerminationReason.NEGATIVE_RADIUS, return_reason)
+        if reservoir is not None:
+            # The compiled loop records every row; they are offered to the reservoir
+            # in the same order, so the sample is the same as with the Python loop
+            for row in zip(*(trajectory[name] for name in TRAJECTORY_COLUMNS)):
+                if row[0] > ACCEPTANCE_RADIUS:
+                    reservoir.append(*row)
+
+        n_steps = len(trajectory["time"])
+        if n_steps >= max_timesteps - 1:
+            reason = TerminationReason.MAX_TIMESTEPS
+        elif trajectory["time"][-1] + trajectory["dot_time"][-1] >= max_time:
+            reason = TerminationReason.MAX_TIME
+        else:
+            reason = TerminationReason.MAX_RADIUS
+        table = _trajectory_to_output(
+            trajectory, reservoir, init_params, output_array_length, rng, n_steps, output
+        )
+        return _result(table, reason, return_reason)
 
     timestep = 0
     while (
@@ -56,6 +180,11 @@ def run_outflow_simulation(
         and curr_outflow.time < max_time
         and curr_outflow.radius < max_radius
     ):
+        # Stop runs whose output would be rejected anyway
+        for predicate in early_exit:
+            if predicate.check(curr_outflow, params, max_time):
+                return _result(None, predicate.reason, return_reason)
+
         timestep += 1
         """Main simulation loop. Essentially, this consists of three steps:
         1. Calculate the potential and gas masses within the current outflow radius
@@ -65,23 +194,23 @@ def run_outflow_simulation(
 
         # Mass calculation adds up two components: bulge and halo.
         # More components can be added in a straightforward manner.
-        halo_component = init_params.halo_profile.calculate(
+        halo_component = params.halo_profile.calculate(
             curr_outflow.radius,
             curr_outflow.dot_radius,
             curr_outflow.dotdot_radius,
-            init_params.halo_mass,
-            init_params.halo_scale_radius,
-            init_params.halo_concentration,
-            init_params.halo_gas_fraction,
+            params.halo_mass,
+            params.halo_scale_radius,
+            params.halo_concentration,
+            params.halo_gas_fraction,
         )
-        bulge_component = init_params.bulge_profile.calculate(
+        bulge_component = params.bulge_profile.calculate(
             curr_outflow.radius,
             curr_outflow.dot_radius,
             curr_outflow.dotdot_radius,
-            init_params.bulge_mass,
-            init_params.bulge_scale_radius,
+            params.bulge_mass,
+            params.bulge_scale_radius,
             None,
-            init_params.bulge_gas_fraction,
+            params.bulge_gas_fraction,
         )
 
         (
@@ -110,99 +239,656 @@ def run_outflow_simulation(
         dot_t2 = curr_outflow.dot_radius / (
             abs(curr_outflow.dotdot_radius) + np.finfo(float).eps
         )
-        # acceleration / jerk
+        # acceleration / jerk; at the velocity cap the acceleration is held at zero
+        # (see calc.time.cap_velocities) and does not limit the timestep
         dot_t3 = curr_outflow.dotdot_radius / (
             abs(curr_outflow.dotdotdot_radius) + np.finfo(float).eps
         )
+        if curr_outflow.dot_radius >= const.WIND_VELOCITY:
+            dot_t3 = np.inf
 
         # Most conservative time step size
-        dt = courant_factor * min(abs(dot_t1), abs(dot_t2), abs(dot_t3))
-
-        # We have to be careful at the start of each AGN episode in order to
-        # propagate the derivatives of radius properly.
-        if agn_episode_start_flag > 0:
-            dt = dt_min
-            agn_episode_start_flag += 1
-            if agn_episode_start_flag > 3:
-                agn_episode_start_flag = 0
-
-        # If we're jumping to a new AGN episode, shorten the timestep to coincide
-        # with exactly the start of the episode, in order to get correct luminosity output
-        next_rep = (curr_outflow.time + dt) // init_params.quasar_repetition_timescale
-        curr_rep = curr_outflow.time // init_params.quasar_repetition_timescale
-        if next_rep > curr_rep:
-            agn_episode_start_flag = 1
-            dt = (
-                init_params.quasar_repetition_timescale
-                * ((curr_outflow.time + dt) // init_params.quasar_repetition_timescale)
-                - curr_outflow.time
-                + np.finfo(float).eps
-            )  # want an epsilon to make sure we are inside an AGN episode now
-
-        dt = max(dt, dt_min)
-        dt = min(dt, dtmax)
-
-        curr_outflow.dot_time = dt
-        next_outflow = OutflowState(time=curr_outflow.time + dt)
+        courant_time = min(abs(dot_t1), abs(dot_t2), abs(dot_t3))
 
-        time_eff = curr_outflow.time % init_params.quasar_repetition_timescale
+        time_eff = curr_outflow.time % params.quasar_repetition_timescale
 
-        # Calculation of "driving" luminosity
-        mean_luminosity_coef = init_params.fade.luminosity_coefficient(
-            time_eff, init_params
+        # The AGN is off until the next episode starts: no energy is injected, and with
+        # fast_forward the coasting outflow is integrated with steps of its own
+        quiescent = (
+            fast_forward
+            and agn_episode_start_flag == 0
+            and params.fade.luminosity_coefficient(time_eff, params) < params.eddington_ratio_shutdown
         )
-
-        # We are either fully outside an AGN episode or just before one's start;
-        # in the latter case, we will spend ~eps time in the episode, no energy injection will occur
-        if mean_luminosity_coef >= init_params.eddington_ratio_shutdown:
-            # This is the expected luminosity coefficient at the end of this timestep
-            predicted_luminosity_coef = init_params.fade.luminosity_coefficient(
-                time_eff + dt, init_params
+        if quiescent:
+            if coasting_dt is None:
+                coasting_dt = courant_factor * courant_time
+            (
+                next_radius,
+                next_dot_radius,
+                next_dotdot_radius,
+                next_dotdotdot_radius,
+                dt,
+                coasting_dt,
+                next_agn_episode_start_flag,
+            ) = _coasting_step(
+                curr_outflow,
+                params,
+                (mass_potential, dot_mass_potential, mass_gas, dot_mass_gas, dotdot_mass_gas),
+                coasting_dt,
+                tolerance,
+                dt_min,
             )
-            # We are fully inside an AGN episode
-            if predicted_luminosity_coef >= init_params.eddington_ratio_shutdown:
-                mean_luminosity_coef = init_params.fade.luminosity_mean_coefficient(
-                    # effective time now
-                    time_eff,
-                    # duration of activity during this timestep
+            if not np.isfinite(next_radius):
+                return _result(None, TerminationReason.NON_FINITE, return_reason)
+            mean_luminosity_coef = 0.0
+        else:
+            # The next AGN-off interval starts its coasting steps afresh
+            coasting_dt = None
+            error_controlled = integrator == "adaptive"
+            step_courant_factor = courant_factor
+
+            rejected_dt = np.inf
+            while True:
+                dt = step_courant_factor * courant_time
+                if error_controlled:
+                    # The AGN episode handling compares the timestep before the dtmax bound
+                    # with the start of the next episode; a grown Courant factor must not
+                    # trigger it while the episode is still far away
+                    dt = min(dt, dtmax)
+                dt, next_agn_episode_start_flag = _limit_timestep(
                     dt,
-                    # length of this timestep
+                    curr_outflow.time,
+                    agn_episode_start_flag,
+                    params,
+                    dt_min,
+                    dtmax,
+                )
+
+                # Calculation of "driving" luminosity
+                mean_luminosity_coef = _step_luminosity_coefficient(params, time_eff, dt)
+                mean_luminosity = mean_luminosity_coef * params.luminosity_eddington(smbh_mass)
+
+                # Calculates next radius and its derivatives from various current parameters
+                (
+                    next_radius,
+                    next_dot_radius,
+                    next_dotdot_radius,
+                    next_dotdotdot_radius,
+                ) = time_step(
+                    curr_outflow.radius,
+                    curr_outflow.dot_radius,
+                    curr_outflow.dotdot_radius,
+                    curr_outflow.dotdotdot_radius,
+                    mass_potential,
+                    dot_mass_potential,
+                    mass_gas,
+                    dot_mass_gas,
+                    dotdot_mass_gas,
+                    mean_luminosity,
                     dt,
-                    init_params,
                 )
-            # We are passing the end of an AGN episode
-            else:
-                mean_luminosity_coef = init_params.fade.luminosity_mean_coefficient(
-                    # effective time now
-                    time_eff,
-                    # duration for which the AGN is still active during this timestep
-                    init_params.quasar_activity_duration - time_eff,
-                    # length of this timestep
+
+                if not error_controlled:
+                    break
+
+                # Error estimate from the jerk evaluated for this step and the one of the
+                # previous step, without further evaluations of the equation of motion
+                error = _step_error(
+                    curr_outflow.radius,
+                    curr_outflow.dotdotdot_radius,
+                    next_dotdotdot_radius,
+                    curr_outflow.dot_time,
                     dt,
-                    init_params,
                 )
+                if not np.isfinite(error):
+                    # A non-finite trial step, e.g. near a collapse: retry once with the
+                    # smallest Courant factor, then accept the step if it is finite itself
+                    if step_courant_factor > ADAPTIVE_COURANT_FACTOR_RANGE[0] and dt < rejected_dt:
+                        rejected_dt = dt
+                        step_courant_factor = ADAPTIVE_COURANT_FACTOR_RANGE[0]
+                        continue
+                    if not np.isfinite(next_radius):
+                        return _result(None, TerminationReason.NON_FINITE, return_reason)
+                    break
+                # Accept the step if the error is small enough, or if shrinking the Courant
+                # factor no longer shortens it (dt at its minimum, or fixed by the AGN episode
+                # handling); otherwise retry with a shorter step
+                if error <= tolerance or dt >= rejected_dt:
+                    break
+                rejected_dt = dt
+                step_courant_factor = max(
+                    step_courant_factor * max(0.9 * (tolerance / error) ** (1.0 / 4.0), 0.2),
+                    ADAPTIVE_COURANT_FACTOR_RANGE[0],
+                )
+
+            if error_controlled:
+                # Grow (or shrink) the next step according to the error of this one; after a
+                # non-finite error, continue with the smallest Courant factor
+                if np.isfinite(error):
+                    courant_factor = min(
+                        max(
+                            step_courant_factor * min(0.9 * (tolerance / max(error, 1e-300)) ** (1.0 / 4.0), 5.0),
+                            ADAPTIVE_COURANT_FACTOR_RANGE[0],
+                        ),
+                        ADAPTIVE_COURANT_FACTOR_RANGE[1],
+                    )
+                else:
+                    courant_factor = ADAPTIVE_COURANT_FACTOR_RANGE[0]
+
+        agn_episode_start_flag = next_agn_episode_start_flag
+        curr_outflow.dot_time = dt
+
+        row = (
+            curr_outflow.radius,
+            curr_outflow.dot_radius,
+            curr_outflow.dotdot_radius,
+            curr_outflow.dotdotdot_radius,
+            curr_outflow.mass_out,
+            curr_outflow.total_mass,
+            curr_outflow.dot_mass,
+            curr_outflow.time,
+            curr_outflow.dot_time,
+            smbh_mass,
+        )
+        if reservoir is None:
+            trajectory.append(*row)
+        elif curr_outflow.radius > ACCEPTANCE_RADIUS:
+            # Outflows with radius <= ACCEPTANCE_RADIUS are rejected, as in _select_rows
+            reservoir.append(*row)
+
+        if smbh_grows:
+            smbh_mass *= np.exp(
+                mean_luminosity_coef * dt / params.salpeter_timescale
+            )
+
+        if next_radius < 0.0:
+            return _result(None, TerminationReason.NEGATIVE_RADIUS, return_reason)
+
+        curr_outflow.radius = next_radius
+        curr_outflow.dot_radius = next_dot_radius
+        curr_outflow.dotdot_radius = next_dotdot_radius
+        curr_outflow.dotdotdot_radius = next_dotdotdot_radius
+        curr_outflow.time = curr_outflow.time + dt
+        if curr_outflow.radius > curr_outflow.peak_radius:
+            curr_outflow.peak_radius = curr_outflow.radius
+            curr_outflow.peak_time = curr_outflow.time
+
+    if timestep >= max_timesteps - 1:
+        reason = TerminationReason.MAX_TIMESTEPS
+    elif curr_outflow.time >= max_time:
+        reason = TerminationReason.MAX_TIME
+    else:
+        reason = TerminationReason.MAX_RADIUS
+    table = _trajectory_to_output(
+        trajectory, reservoir, init_params, output_array_length, rng, timestep, output
+    )
+    return _result(table, reason, return_reason)
+
+
+def _limit_timestep(dt, time, agn_episode_start_flag, params, dt_min, dtmax):
+    """Apply the AGN episode handling and the dt_min, dtmax bounds to a Courant timestep.
+
+    Returns the timestep and the AGN episode start flag to use for the next one.
+    """
+    # We have to be careful at the start of each AGN episode in order to
+    # propagate the derivatives of radius properly.
+    if agn_episode_start_flag > 0:
+        dt = dt_min
+        agn_episode_start_flag += 1
+        if agn_episode_start_flag > 3:
+            agn_episode_start_flag = 0
+
+    # If we're jumping to a new AGN episode, shorten the timestep to coincide
+    # with exactly the start of the episode, in order to get correct luminosity output
+    next_rep = (time + dt) // params.quasar_repetition_timescale
+    curr_rep = time // params.quasar_repetition_timescale
+    if next_rep > curr_rep:
+        agn_episode_start_flag = 1
+        dt = (
+            params.quasar_repetition_timescale
+            * ((time + dt) // params.quasar_repetition_timescale)
+            - time
+            + np.finfo(float).eps
+        )  # want an epsilon to make sure we are inside an AGN episode now
+
+    dt = max(dt, dt_min)
+    dt = min(dt, dtmax)
+
+    return dt, agn_episode_start_flag
+
+
+def _step_luminosity_coefficient(params, time_eff, dt):
+    # Mean luminosity coefficient (in Eddington luminosities) over a timestep dt
+    mean_luminosity_coef = params.fade.luminosity_coefficient(time_eff, params)
+
+    # We are either fully outside an AGN episode or just before one's start;
+    # in the latter case, we will spend ~eps time in the episode, no energy injection will occur
+    if mean_luminosity_coef < params.eddington_ratio_shutdown:
+        return 0.0
+
+    # This is the expected luminosity coefficient at the end of this timestep
+    predicted_luminosity_coef = params.fade.luminosity_coefficient(time_eff + dt, params)
+    # We are fully inside an AGN episode
+    if predicted_luminosity_coef >= params.eddington_ratio_shutdown:
+        return params.fade.luminosity_mean_coefficient(
+            # effective time now
+            time_eff,
+            # duration of activity during this timestep
+            dt,
+            # length of this timestep
+            dt,
+            params,
+        )
+    # We are passing the end of an AGN episode
+    return params.fade.luminosity_mean_coefficient(
+        # effective time now
+        time_eff,
+        # duration for which the AGN is still active during this timestep
+        params.quasar_activity_duration - time_eff,
+        # length of this timestep
+        dt,
+        params,
+    )
+
+
+def _coasting_derivative(params, radius, dot_radius, dotdot_radius):
+    # Time derivative of (radius, dot_radius, dotdot_radius) of an outflow coasting
+    # with the AGN off
+    halo_component = params.halo_profile.calculate(
+        radius,
+        dot_radius,
+        dotdot_radius,
+        params.halo_mass,
+        params.halo_scale_radius,
+        params.halo_concentration,
+        params.halo_gas_fraction,
+    )
+    bulge_component = params.bulge_profile.calculate(
+        radius,
+        dot_radius,
+        dotdot_radius,
+        params.bulge_mass,
+        params.bulge_scale_radius,
+        None,
+        params.bulge_gas_fraction,
+    )
+    (
+        mass_potential,
+        dot_mass_potential,
+        mass_gas,
+        dot_mass_gas,
+        dotdot_mass_gas,
+        _,
+        _,
+    ) = (a + b for a, b in zip(halo_component, bulge_component))
+    dotdotdot_radius = tc.rtdot_calc(
+        0.0, mass_gas, dot_mass_gas, dotdot_mass_gas, mass_potential, dot_mass_potential, radius, dot_radius, dotdot_radius
+    )
+    return np.array([dot_radius, dotdot_radius, dotdotdot_radius])
+
+
+def _coasting_step(outflow, params, masses, dt, tolerance, dt_min):
+    """Advance an outflow coasting between AGN episodes by one Dormand-Prince 5(4) step.
+
+    The timestep is controlled by the error estimate of the embedded fourth order
+    solution alone, not by the Courant criterion, and ends at the start of the next
+    AGN episode at the latest. masses are the enclosed masses and their derivatives
+    at the current radius, as in run_outflow_simulation.
+
+    Returns the radius and its derivatives after the step, the timestep taken, the
+    timestep proposed for the next step and the AGN episode start flag to use for it.
+    """
+    mass_potential, dot_mass_potential, mass_gas, dot_mass_gas, dotdot_mass_gas = masses
+    state = np.array([outflow.radius, outflow.dot_radius, outflow.dotdot_radius])
+    derivative = np.array(
+        [
+            outflow.dot_radius,
+            outflow.dotdot_radius,
+            tc.rtdot_calc(
+                0.0,
+                mass_gas,
+                dot_mass_gas,
+                dotdot_mass_gas,
+                mass_potential,
+                dot_mass_potential,
+                outflow.radius,
+                outflow.dot_radius,
+                outflow.dotdot_radius,
+            ),
+        ]
+    )
+
+    while True:
+        # No dtmax bound: an AGN-off interval ends at the start of the next episode
+        step_dt, next_agn_episode_start_flag = _limit_timestep(
+            dt, outflow.time, 0, params, dt_min, np.inf
+        )
+        stages = [derivative]
+        for coefficients in DORMAND_PRINCE_STAGES:
+            next_state = state + step_dt * sum(c * k for c, k in zip(coefficients, stages))
+            stages.append(_coasting_derivative(params, *next_state))
+        # The last stage is evaluated at the fifth order solution; the position error
+        # is combined with the velocity and acceleration errors converted to position
+        # errors over the step
+        error_radius, error_dot_radius, error_dotdot_radius = step_dt * sum(
+            e * k for e, k in zip(DORMAND_PRINCE_ERROR, stages)
+        )
+        error = max(
+            abs(error_radius),
+            abs(error_dot_radius) * step_dt,
+            abs(error_dotdot_radius) * step_dt**2 / 2.0,
+        ) / (abs(outflow.radius) + np.finfo(float).eps)
+
+        if not np.isfinite(error):
+            # E.g. near a collapse: shrink the step down to dt_min, then return it as it is
+            if step_dt > dt_min:
+                dt = 0.2 * step_dt
+                continue
+            break
+        # Accept the step if the error is small enough or the step cannot be shortened
+        if error <= tolerance or step_dt <= dt_min:
+            break
+        dt = step_dt * max(0.9 * (tolerance / error) ** (1.0 / 5.0), 0.2)
+
+    # Grow (or shrink) the next step according to the error of this one; a step cut
+    # short by the start of the next episode does not limit the next one
+    if np.isfinite(error):
+        dt = max(dt, step_dt) * min(0.9 * (tolerance / max(error, 1e-300)) ** (1.0 / 5.0), 5.0)
+
+    next_radius, next_dot_radius, next_dotdot_radius = next_state
+    return (
+        next_radius,
+        next_dot_radius,
+        next_dotdot_radius,
+        stages[-1][2],
+        step_dt,
+        dt,
+        next_agn_episode_start_flag,
+    )
+
+
+def _step_error(radius, jerk, next_jerk, previous_dt, dt):
+    # Relative position error of a simple_time_step: the step is a third order Taylor
+    # expansion, so its leading error is that of the omitted snap, estimated from the
+    # change of the jerk since the previous step. The velocity error (snap dt^3 / 6)
+    # is converted to a position error over the step. Nothing is known before the
+    # first step.
+    if previous_dt <= 0.0:
+        return 0.0
+    snap = (next_jerk - jerk) / previous_dt
+    return abs(snap) * dt**4 / 6.0 / (abs(radius) + np.finfo(float).eps)
+
+
+def _trajectory_to_output(
+    trajectory, reservoir, galaxy, output_array_length, rng, n_steps, output="table"
+):
+    if reservoir is not None:
+        if len(reservoir) == 0:
+            return None
+        outflow_array = io.trajectory_to_array(reservoir, galaxy)
+    else:
+        rows = _select_rows(trajectory, output_array_length, rng)
+        if rows is None:
+            return None
+        outflow_array = io.trajectory_to_array(trajectory, galaxy, rows)
+
+    table = _wrap_output(outflow_array, output)
+    # Number of integration steps taken, e.g. to compare integrators
+    table.meta["n_steps"] = n_steps
+    return table
+
+
+def _wrap_output(outflow_array, output):
+    if output == "numpy":
+        return io.OutflowArray(outflow_array)
+    return io.outflow_array_to_table(outflow_array)
+
+
+def _result(table, reason, return_reason):
+    if table is not None:
+        table.meta["termination_reason"] = reason.name
+    return (table, reason) if return_reason else table
+
+
+def _select_backend(backend, params, integrator, python_only_options):
+    # backend=None defers to the MAGNOFIT_BACKEND environment variable
+    if backend is None:
+        backend = os.environ.get("MAGNOFIT_BACKEND", "python")
+    if backend not in ("python", "numba"):
+        raise ValueError(f"Unknown simulation backend {backend!r}, expected 'python' or 'numba'.")
+
+    if backend == "numba":
+        if not jit.NUMBA_AVAILABLE:
+            warnings.warn("Numba is not installed, falling back to the Python backend.")
+            return "python"
+        if integrator != "simple" or python_only_options:
+            warnings.warn(
+                "The numba backend only supports the simple integrator without fast_forward "
+                "or early_exit, falling back to the Python backend."
+            )
+            return "python"
+        if not jit.supports(params):
+            warnings.warn(
+                "The numba backend only supports the built-in mass profiles and fade models, "
+                "falling back to the Python backend."
+            )
+            return "python"
+
+    return backend
+
+
+def _select_rows(trajectory, output_array_length, rng):
+    # Reject outflows with radius <= ACCEPTANCE_RADIUS
+    rows = np.flatnonzero(trajectory["radius"] > ACCEPTANCE_RADIUS)
+    if len(rows) == 0:
+        return None
+
+    # Randomly select predefined number of outflows, weighted by their timesteps
+    if rng:
+        dot_time = trajectory["dot_time"][rows]
+        weights = dot_time / np.sum(dot_time)
+        size = min(len(rows), output_array_length)
+        rows = rows[rng.choice(len(rows), p=weights, size=size)]
+
+    return rows
+
+
+def _stack_galaxies(galaxies):
+    """Combine galaxies into one Galaxy whose numeric fields are per-lane arrays.
+
+    Derived properties (halo_mass, bulge_scale_radius, luminosity_eddington, ...)
+    are then evaluated for all lanes at once. Mass profiles and the fade model
+    must be shared by every galaxy in the batch.
+    """
+    if isinstance(galaxies, GalaxyPopulation):
+        return galaxies
+
+    fields = _shared_components(galaxies, "batch")
+    for field in dataclasses.fields(Galaxy):
+        if field.name in fields:
+            continue
+        if field.name == "name":
+            fields[field.name] = None
         else:
-            mean_luminosity_coef = 0.0
+            fields[field.name] = np.array(
+                [getattr(g, field.name) for g in galaxies], dtype=np.float64
+            )
+
+    return Galaxy(**fields)
+
+
+def _mean_luminosity_coefficient(params, time_eff, dt):
+    # Same decisions as in run_outflow_simulation, taken for all lanes at once
+    fade = params.fade
+    shutdown = params.eddington_ratio_shutdown
+    active = fade.luminosity_coefficient(time_eff, params) >= shutdown
+    # Still inside the AGN episode at the end of the timestep, or passing its end
+    still_active = fade.luminosity_coefficient(time_eff + dt, params) >= shutdown
+    duration = np.where(still_active, dt, params.quasar_activity_duration - time_eff)
+    mean_luminosity_coef = fade.luminosity_mean_coefficient(time_eff, duration, dt, params)
+
+    return np.where(active, mean_luminosity_coef, 0.0)
+
+
+def _select_lanes(params, selection):
+    # Keep only the selected lanes of compiled, stacked galaxy parameters
+    return dataclasses.replace(
+        params,
+        **{
+            field.name: getattr(params, field.name)[selection]
+            for field in dataclasses.fields(params)
+            if isinstance(getattr(params, field.name), np.ndarray)
+        },
+    )
+
+
+def run_outflow_simulation_batch(
+    galaxies,
+    output_array_length=200,
+    smbh_grows=True,
+    max_timesteps=30000,
+    max_time=1.5e8 / const.UNIT_YEAR,
+    max_radius=12.0 / const.UNIT_KPC,
+    dt_min=1.0 / const.UNIT_YEAR,
+    rngs=None,
+    output="table",
+    return_reason=False,
+):
+    """Lockstep version of run_outflow_simulation for a batch of galaxies.
+
+    The state of every galaxy ("lane") is kept in arrays and all lanes are
+    advanced together, each with its own timestep, AGN episode start flag and
+    termination condition. Lanes that finish drop out of the batch.
+
+    galaxies is a sequence of Galaxy objects or a GalaxyPopulation. rngs is
+    either None (return all rows of every outflow, like rng=None in
+    run_outflow_simulation) or a sequence with one generator (or None) per galaxy.
+
+    Returns a list with one entry per galaxy: the same table (or None) that
+    run_outflow_simulation would return for it with the same output, or with
+    return_reason=True, the same (table, TerminationReason) tuple.
+    """
+    if output not in OUTPUTS:
+        raise ValueError(f"Unknown output {output!r}, expected one of {', '.join(OUTPUTS)}.")
+    # A GalaxyPopulation is used as it is; Galaxy objects are only created for the output
+    if not isinstance(galaxies, GalaxyPopulation):
+        galaxies = list(galaxies)
+    if len(galaxies) == 0:
+        return []
+    if rngs is None:
+        rngs = [None] * len(galaxies)
+    if len(rngs) != len(galaxies):
+        raise ValueError("rngs must provide one generator per galaxy.")
+
+    courant_factor = 0.02
+    eps = np.finfo(float).eps
+
+    # Lane state; only lanes that are still being integrated are kept
+    params = _stack_galaxies(galaxies).compile()
+    lanes = np.arange(len(galaxies))
+    radius = np.full(len(lanes), 0.001 / const.UNIT_KPC)
+    dot_radius = np.full(len(lanes), 100000.0 / const.UNIT_VELOCITY)
+    dotdot_radius = np.zeros(len(lanes))
+    dotdotdot_radius = np.zeros(len(lanes))
+    time = np.zeros(len(lanes))
+    smbh_mass = params.smbh_mass
+    agn_episode_start_flag = np.zeros(len(lanes), dtype=int)
+    # Lanes still integrated when the loop ends ran out of timesteps
+    reasons = np.full(len(galaxies), TerminationReason.MAX_TIMESTEPS, dtype=np.int8)
+
+    # Rows of all lanes, interleaved step by step; the lane column tells them apart
+    trajectory = TrajectoryBuffer(TRAJECTORY_COLUMNS + ("lane",), capacity=64 * len(lanes))
+
+    dtmax = params.quasar_activity_duration * 0.1
+
+    timestep = 0
+    while len(lanes) > 0 and timestep < max_timesteps - 1:
+        timestep += 1
+
+        halo_component = params.halo_profile.calculate(
+            radius,
+            dot_radius,
+            dotdot_radius,
+            params.halo_mass,
+            params.halo_scale_radius,
+            params.halo_concentration,
+            params.halo_gas_fraction,
+        )
+        bulge_component = params.bulge_profile.calculate(
+            radius,
+            dot_radius,
+            dotdot_radius,
+            params.bulge_mass,
+            params.bulge_scale_radius,
+            None,
+            params.bulge_gas_fraction,
+        )
+        (
+            mass_potential,
+            dot_mass_potential,
+            mass_gas,
+            dot_mass_gas,
+            dotdot_mass_gas,
+            _,
+            _,
+        ) = (a + b for a, b in zip(halo_component, bulge_component))
+
+        # Courant-like criterion, see run_outflow_simulation
+        dot_t1 = radius / (np.abs(dot_radius) + eps)
+        dot_t2 = dot_radius / (np.abs(dotdot_radius) + eps)
+        dot_t3 = dotdot_radius / (np.abs(dotdotdot_radius) + eps)
+        dot_t3 = np.where(dot_radius >= const.WIND_VELOCITY, np.inf, dot_t3)
+        dt = courant_factor * np.minimum(
+            np.minimum(np.abs(dot_t1), np.abs(dot_t2)), np.abs(dot_t3)
+        )
 
-        mean_luminosity = mean_luminosity_coef * curr_galaxy.luminosity_eddington
+        episode_start = agn_episode_start_flag > 0
+        dt[episode_start] = dt_min
+        agn_episode_start_flag[episode_start] += 1
+        agn_episode_start_flag[agn_episode_start_flag > 3] = 0
+
+        repetition_timescale = params.quasar_repetition_timescale
+        next_rep = (time + dt) // repetition_timescale
+        new_episode = next_rep > time // repetition_timescale
+        agn_episode_start_flag[new_episode] = 1
+        dt = np.where(new_episode, repetition_timescale * next_rep - time + eps, dt)
+
+        dt = np.maximum(dt, dt_min)
+        dt = np.minimum(dt, dtmax)
+
+        time_eff = time % repetition_timescale
+        mean_luminosity_coef = _mean_luminosity_coefficient(params, time_eff, dt)
+        mean_luminosity = mean_luminosity_coef * params.luminosity_eddington(smbh_mass)
+
+        trajectory.extend(
+            radius,
+            dot_radius,
+            dotdot_radius,
+            dotdotdot_radius,
+            mass_gas,
+            mass_gas + mass_potential,
+            dot_mass_gas,
+            time,
+            dt,
+            smbh_mass,
+            lanes,
+        )
 
-        next_galaxy = copy(curr_galaxy)
         if smbh_grows:
-            next_galaxy.smbh_mass *= np.exp(
-                mean_luminosity_coef * dt / init_params.salpeter_timescale
+            smbh_mass = smbh_mass * np.exp(
+                mean_luminosity_coef * dt / params.salpeter_timescale
             )
 
-        # Calculates next radius and its derivatives from various current parameters
         (
-            next_outflow.radius,
-            next_outflow.dot_radius,
-            next_outflow.dotdot_radius,
-            next_outflow.dotdotdot_radius,
+            radius,
+            dot_radius,
+            dotdot_radius,
+            dotdotdot_radius,
         ) = tc.simple_time_step(
-            curr_outflow.radius,
-            curr_outflow.dot_radius,
-            curr_outflow.dotdot_radius,
-            curr_outflow.dotdotdot_radius,
+            radius,
+            dot_radius,
+            dotdot_radius,
+            dotdotdot_radius,
             mass_potential,
             dot_mass_potential,
             mass_gas,
@@ -211,36 +897,51 @@ def run_outflow_simulation(
             mean_luminosity,
             dt,
         )
+        time = time + dt
+
+        negative = radius < 0.0
+        alive = ~negative & (time < max_time) & (radius < max_radius)
+        if not alive.all():
+            # Same order of checks as at the end of run_outflow_simulation
+            if timestep < max_timesteps - 1:
+                reasons[lanes[~alive]] = np.where(
+                    time[~alive] >= max_time, TerminationReason.MAX_TIME, TerminationReason.MAX_RADIUS
+                )
+            reasons[lanes[negative]] = TerminationReason.NEGATIVE_RADIUS
+            lanes = lanes[alive]
+            radius = radius[alive]
+            dot_radius = dot_radius[alive]
+            dotdot_radius = dotdot_radius[alive]
+            dotdotdot_radius = dotdotdot_radius[alive]
+            time = time[alive]
+            agn_episode_start_flag = agn_episode_start_flag[alive]
+
+            smbh_mass = smbh_mass[alive]
+            params = _select_lanes(params, alive)
+            dtmax = params.quasar_activity_duration * 0.1
+
+    return _collect_batch_outflows(
+        galaxies, trajectory, reasons, output_array_length, rngs, output, return_reason
+    )
 
-        outflows.append(curr_outflow)
-        galaxy_params.append(curr_galaxy)
-
-        if next_outflow.radius < 0.0:
-            print(
-                f"At step = {timestep} time = {curr_outflow.time} calc failed due to negative radius."
-            )
-            return None
-
-        curr_outflow = next_outflow
-        next_outflow = OutflowState()
 
-        curr_galaxy = next_galaxy
-        next_galaxy = copy(curr_galaxy)
+def _collect_batch_outflows(galaxies, trajectory, reasons, output_array_length, rngs, output, return_reason):
+    # Group the rows by lane, keeping their time order
+    trajectory = trajectory.take(np.argsort(trajectory["lane"], kind="stable"))
+    bounds = np.searchsorted(trajectory["lane"], np.arange(len(galaxies) + 1))
 
-    # Reject outflows with radius <= 0.02
-    galaxy_params = [g for (o, g) in zip(outflows, galaxy_params) if o.radius > 0.02]
-    outflows = [o for o in outflows if o.radius > 0.02]
-    if len(outflows) == 0:
-        return None
+    results = []
+    for lane, g in enumerate(galaxies):
+        reason = TerminationReason(reasons[lane])
+        rows = None
+        if reason != TerminationReason.NEGATIVE_RADIUS:
+            lane_trajectory = trajectory.take(slice(bounds[lane], bounds[lane + 1]))
+            rows = _select_rows(lane_trajectory, output_array_length, rngs[lane])
 
-    # Randomly select predefined number of outflows
-    # The pairing between outflows and galaxies must be retained, hence the syntax
-    if rng and len(outflows) > 0:
-        weights = [o.dot_time for o in outflows]
-        weights /= np.sum(weights)
-        size = min(len(outflows), output_array_length)
-        outflows, galaxy_params = zip(
-            *rng.choice(list(zip(outflows, galaxy_params)), p=weights, size=size)
-        )
+        table = None
+        if rows is not None:
+            table = _wrap_output(io.trajectory_to_array(lane_trajectory, g, rows), output)
+            table.meta["n_steps"] = len(lane_trajectory)
+        results.append(_result(table, reason, return_reason))
 
-    return io.outflows_to_table(outflows, galaxy_params)
+    return results
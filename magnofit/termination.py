@@ -0,0 +1,116 @@
+from enum import IntEnum
+
+from . import constants as const
+
+# Rows with a radius at or below this (in kpc) are rejected from the output
+ACCEPTANCE_RADIUS = 0.02 / const.UNIT_KPC
+
+
+class TerminationReason(IntEnum):
+    # The simulation ran to completion
+    MAX_TIME = 0
+    MAX_RADIUS = 1
+    MAX_TIMESTEPS = 2
+    # The simulation failed
+    NEGATIVE_RADIUS = 3
+    # The simulation was stopped early by one of the predicates below
+    STALLED = 4
+    FALLING_BACK = 5
+    UNREACHABLE = 6
+    # The simulation failed: the adaptive integration produced a non-finite step
+    NON_FINITE = 7
+
+
+class EarlyExit:
+    """Predicate that stops a simulation whose output would be rejected anyway.
+
+    check() is called before every step with the current OutflowState, the
+    CompiledGalaxy and the max_time of the simulation; the simulation stops with
+    `reason` when it returns True.
+    """
+
+    reason = None
+
+    def check(self, outflow, params, max_time):
+        raise NotImplementedError()
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+def _agn_active(outflow, params):
+    time_eff = outflow.time % params.quasar_repetition_timescale
+    return params.fade.luminosity_coefficient(time_eff, params) >= params.eddington_ratio_shutdown
+
+
+def _unreachable_after_episodes(outflow, params, max_time):
+    # Whether an outflow between AGN episodes, coasting at its current, decreasing
+    # velocity until the next episode and then moving at the wind velocity, still
+    # stays within the acceptance radius until max_time: later episodes can push an
+    # outflow out again, so it is only rejected if even these cannot
+    if outflow.dotdot_radius > 0 or _agn_active(outflow, params):
+        return False
+    time_eff = outflow.time % params.quasar_repetition_timescale
+    next_episode = outflow.time - time_eff + params.quasar_repetition_timescale
+    coasting = max(outflow.dot_radius, 0.0) * (min(next_episode, max_time) - outflow.time)
+    driven = const.WIND_VELOCITY * max(max_time - next_episode, 0.0)
+    return outflow.radius + coasting + driven <= ACCEPTANCE_RADIUS
+
+
+class Stalled(EarlyExit):
+    """The outflow has never reached the acceptance radius, has not reached a new
+    maximum radius for `episodes` AGN repetition timescales, i.e. full AGN episodes
+    no longer push it outwards, and the episodes left before max_time cannot push
+    it beyond the acceptance radius either."""
+
+    reason = TerminationReason.STALLED
+
+    def __init__(self, episodes=1):
+        self.episodes = episodes
+
+    def check(self, outflow, params, max_time):
+        return (
+            outflow.peak_radius <= ACCEPTANCE_RADIUS
+            and outflow.time - outflow.peak_time > self.episodes * params.quasar_repetition_timescale
+            and _unreachable_after_episodes(outflow, params, max_time)
+        )
+
+
+class FallingBack(EarlyExit):
+    """The outflow has never reached the acceptance radius, falls back below
+    `fraction` of the largest radius it has reached with the AGN off, and the
+    episodes left before max_time cannot push it beyond the acceptance radius."""
+
+    reason = TerminationReason.FALLING_BACK
+
+    def __init__(self, fraction=0.5):
+        self.fraction = fraction
+
+    def check(self, outflow, params, max_time):
+        return (
+            outflow.peak_radius <= ACCEPTANCE_RADIUS
+            and outflow.dot_radius < 0
+            and outflow.radius < self.fraction * outflow.peak_radius
+            and _unreachable_after_episodes(outflow, params, max_time)
+        )
+
+
+class Unreachable(EarlyExit):
+    """The outflow cannot reach the acceptance radius before max_time: not even at
+    the driving wind velocity, or, between AGN episodes, not by coasting at its
+    current, decreasing velocity until the next episode and moving at the wind
+    velocity from then on."""
+
+    reason = TerminationReason.UNREACHABLE
+
+    def check(self, outflow, params, max_time):
+        if outflow.peak_radius > ACCEPTANCE_RADIUS:
+            return False
+
+        if outflow.radius + const.WIND_VELOCITY * (max_time - outflow.time) <= ACCEPTANCE_RADIUS:
+            return True
+        return _unreachable_after_episodes(outflow, params, max_time)
+
+
+def default_early_exits():
+    return [Stalled(), FallingBack(), Unreachable()]
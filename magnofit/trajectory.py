@@ -0,0 +1,133 @@
+import numpy as np
+
+
+# Quantities recorded at every step of a simulation, in code units
+TRAJECTORY_COLUMNS = (
+    "radius",
+    "dot_radius",
+    "dotdot_radius",
+    "dotdotdot_radius",
+    # Total mass of outflowing gas
+    "mass_out",
+    # Total mass within outflow radius, including gas and non-gas ('potential') components
+    "total_mass",
+    # Mass outflow rate per unit time
+    "dot_mass",
+    "time",
+    # Length of the step taken from this state
+    "dot_time",
+    # The only galaxy parameter that evolves during a simulation
+    "smbh_mass",
+)
+
+
+class TrajectoryBuffer:
+    """Columnar record of an outflow trajectory.
+
+    Every column is a float64 array in one preallocated block which grows
+    geometrically, so appending a step does not allocate any Python objects.
+    Columns are read back as array views with buffer[name].
+    """
+
+    def __init__(self, columns=TRAJECTORY_COLUMNS, capacity=1024):
+        self.columns = tuple(columns)
+        self._index = {name: i for i, name in enumerate(self.columns)}
+        self._data = np.empty((len(self.columns), max(int(capacity), 1)))
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        return self._data[self._index[name], : self._size]
+
+    @property
+    def capacity(self):
+        return self._data.shape[1]
+
+    def _reserve(self, size):
+        if size > self.capacity:
+            data = np.empty((len(self.columns), max(size, 2 * self.capacity)))
+            data[:, : self._size] = self._data[:, : self._size]
+            self._data = data
+
+    def append(self, *values):
+        # One value per column, in the order of self.columns
+        self._reserve(self._size + 1)
+        self._data[:, self._size] = values
+        self._size += 1
+
+    def extend(self, *values):
+        # One array per column, in the order of self.columns
+        count = len(values[0])
+        self._reserve(self._size + count)
+        for i, column in enumerate(values):
+            self._data[i, self._size : self._size + count] = column
+        self._size += count
+
+    def take(self, rows):
+        """Return a new buffer holding the given rows (an index array or boolean mask)."""
+        data = self._data[:, : self._size][:, rows]
+        taken = TrajectoryBuffer(self.columns, capacity=data.shape[1])
+        taken._data[:, : data.shape[1]] = data
+        taken._size = data.shape[1]
+        return taken
+
+    def as_dict(self):
+        return {name: self[name] for name in self.columns}
+
+
+class TrajectoryReservoir:
+    """Fixed-size, weighted sample of trajectory rows, drawn while they are recorded.
+
+    Each of the `size` slots holds an independent draw from all rows appended so
+    far, with probabilities proportional to the `weight` column. The result
+    therefore follows the same distribution as rng.choice(rows, p=weights, size=size)
+    over the complete trajectory, using O(size) memory.
+    Reading columns works as for TrajectoryBuffer.
+
+    Rather than deciding for every slot at every row, each slot jumps ahead: a
+    slot last replaced at total weight W keeps its row until the total weight
+    passes W / U, with U uniform in (0, 1], since it survives to total weight
+    W' with probability W / W'. Appending a row is then O(1) unless it
+    replaces a slot, which happens O(size log(total / first weight)) times.
+    """
+
+    def __init__(self, size, rng, columns=TRAJECTORY_COLUMNS, weight="dot_time"):
+        self.columns = tuple(columns)
+        self._index = {name: i for i, name in enumerate(self.columns)}
+        self._weight_index = self._index[weight]
+        self._rng = rng
+        self._data = np.empty((len(self.columns), int(size)))
+        self._total_weight = 0.0
+        self._count = 0
+        # Total weight at which every slot switches to the row being appended; all
+        # slots take the first row of positive weight
+        self._thresholds = np.zeros(int(size))
+        self._next_threshold = 0.0
+
+    @property
+    def size(self):
+        return self._data.shape[1]
+
+    def __len__(self):
+        # With fewer rows than slots, every slot still holds a valid draw
+        return min(self._count, self.size)
+
+    def __getitem__(self, name):
+        return self._data[self._index[name], : len(self)]
+
+    def append(self, *values):
+        # One value per column, in the order of self.columns
+        self._total_weight += values[self._weight_index]
+        self._count += 1
+        if self._total_weight <= self._next_threshold:
+            return
+
+        replaced = self._thresholds < self._total_weight
+        self._data[:, replaced] = np.asarray(values, dtype=np.float64)[:, np.newaxis]
+        self._thresholds[replaced] = self._total_weight / (1.0 - self._rng.random(np.count_nonzero(replaced)))
+        self._next_threshold = self._thresholds.min()
+
+    def as_dict(self):
+        return {name: self[name] for name in self.columns}
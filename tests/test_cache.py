@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+
+import magnofit.calc.mass
+from magnofit.cache import ResultCache
+from magnofit.galaxy import Galaxy
+from magnofit.simulation import run_outflow_simulation
+from magnofit.termination import TerminationReason
+
+
+@pytest.fixture
+def galaxy():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+    return initial_galaxy_parameters
+
+
+def test_cache_hit(tmp_path, galaxy):
+    cache = ResultCache(tmp_path)
+
+    reference = run_outflow_simulation(galaxy, rng=np.random.default_rng(1))
+    outflow_properties = run_outflow_simulation(galaxy, rng=np.random.default_rng(1), cache=cache)
+    assert len(cache) == 1
+    assert np.array_equal(outflow_properties.as_array(), reference.as_array())
+
+    # The hit restores the rng to its state after the simulation
+    rng = np.random.default_rng(1)
+    cached, reason = run_outflow_simulation(galaxy, rng=rng, cache=cache, return_reason=True)
+    assert len(cache) == 1
+    assert reason == TerminationReason.MAX_RADIUS
+    assert np.array_equal(cached.as_array(), reference.as_array())
+    assert cached["radius"].unit == reference["radius"].unit
+    assert cached.meta == reference.meta
+    rng_reference = np.random.default_rng(1)
+    run_outflow_simulation(galaxy, rng=rng_reference)
+    assert rng.random() == rng_reference.random()
+
+    # Arrays are read from the same entry
+    cached = run_outflow_simulation(galaxy, rng=np.random.default_rng(1), cache=cache, output="numpy")
+    assert len(cache) == 1
+    assert np.array_equal(cached.data, reference.as_array())
+    assert cached.meta == reference.meta
+
+    # Rejected runs are cached as well
+    assert run_outflow_simulation(galaxy, max_timesteps=10, cache=cache) is None
+    assert run_outflow_simulation(galaxy, max_timesteps=10, cache=cache) is None
+    assert len(cache) == 2
+
+
+def test_cache_key(tmp_path, galaxy):
+    cache = ResultCache(tmp_path)
+    key = cache.key(galaxy, rng=None)
+
+    # Only inputs that can change the result change the key
+    assert cache.key(Galaxy(**{**vars(galaxy), "name": "renamed"}), rng=None) == key
+    assert cache.key(galaxy, rng=None, max_timesteps=100) != key
+    assert cache.key(galaxy, rng=np.random.default_rng(0)) != key
+    assert cache.key(Galaxy(**{**vars(galaxy), "eddington_ratio": 0.9}), rng=None) != key
+    changed_profile = Galaxy(**{**vars(galaxy), "bulge_profile": magnofit.calc.mass.MassHernquist()})
+    assert cache.key(changed_profile, rng=None) != key
+
+
+def test_cache_eviction(tmp_path, galaxy):
+    cache = ResultCache(tmp_path, max_bytes=1)
+    run_outflow_simulation(galaxy, rng=None, cache=cache)
+    assert len(cache) == 0
+
+    cache = ResultCache(tmp_path)
+    keys = []
+    for i, max_timesteps in enumerate((2000, 3000, 4000)):
+        run_outflow_simulation(galaxy, rng=None, max_timesteps=max_timesteps, cache=cache)
+        (key,) = {path.stem for path in tmp_path.glob("*.npz")} - set(keys)
+        os.utime(cache._path(key), (i, i))
+        keys.append(key)
+    # Reading the first entry makes the second one the least recently used
+    run_outflow_simulation(galaxy, rng=None, max_timesteps=2000, cache=cache)
+
+    sizes = [cache._path(key).stat().st_size for key in keys]
+    cache.max_bytes = (sizes[0] + sizes[2]) / cache.eviction_fraction
+    cache._evict()
+    assert keys[0] in cache
+    assert keys[1] not in cache
+    assert keys[2] in cache
@@ -1,7 +1,11 @@
+import dataclasses
+
 import pytest
 import numpy as np
 
-from magnofit.galaxy import Galaxy
+import magnofit.calc.luminosity as lc
+import magnofit.calc.mass
+from magnofit.galaxy import Galaxy, GalaxyPopulation
 import magnofit.constants as const
 
 
@@ -47,3 +51,84 @@ def test_bulge_sigma(rng, expected_bulge_sigma):
 
 
 
+
+
+def test_compiled_galaxy():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+    compiled = initial_galaxy_parameters.compile()
+
+    assert compiled.halo_mass == initial_galaxy_parameters.halo_mass
+    assert compiled.quasar_lum_variation_timescale == initial_galaxy_parameters.quasar_lum_variation_timescale
+    assert compiled.luminosity_eddington(compiled.smbh_mass) == initial_galaxy_parameters.luminosity_eddington
+
+    fade = initial_galaxy_parameters.fade
+    assert fade.luminosity_coefficient(0.01, compiled) == fade.luminosity_coefficient(0.01, initial_galaxy_parameters)
+
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        compiled.smbh_mass = 1.0
+
+
+def test_galaxy_population():
+    duty_cycle = np.linspace(0.05, 0.5, 10)
+    galaxies = [Galaxy(duty_cycle=d, fade=lc.LuminosityFadeKing()) for d in duty_cycle]
+    rng = np.random.default_rng(0)
+    for galaxy in galaxies:
+        galaxy.generate_stochastic_parameters(rng)
+
+    population = GalaxyPopulation(duty_cycle=duty_cycle, fade=lc.LuminosityFadeKing())
+    population.generate_stochastic_parameters(np.random.default_rng(0))
+
+    # The same draws as galaxy by galaxy; vectorized powers may differ in the last bit
+    assert len(population) == 10
+    for name in ("smbh_mass", "bulge_mass", "bulge_sigma", "quasar_lum_variation_timescale"):
+        expected = [getattr(galaxy, name) for galaxy in galaxies]
+        np.testing.assert_allclose(getattr(population, name), expected, rtol=1e-15)
+
+    galaxy = population[3]
+    assert type(galaxy) is Galaxy
+    assert galaxy.duty_cycle == duty_cycle[3]
+    assert galaxy.bulge_mass == population.bulge_mass[3]
+
+    chunks = list(population.chunks(4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert np.shares_memory(chunks[1].bulge_mass, population.bulge_mass)
+    assert chunks[1][0].smbh_mass == population.smbh_mass[4]
+
+    table = population.to_table()
+    assert table.colnames == galaxies[0].to_table().colnames
+    galaxy_table = galaxy.to_table()
+    assert table["fade_type"][3] == galaxy_table["fade_type"][0]
+    for name in table.colnames[:-2]:
+        assert table[name].unit == galaxy_table[name].unit
+        assert table[name].value[3] == pytest.approx(galaxy_table[name].value[0], rel=1e-15)
+
+    collected = GalaxyPopulation.from_galaxies(galaxies)
+    assert np.array_equal(collected.smbh_mass, [galaxy.smbh_mass for galaxy in galaxies])
+    assert collected.name is None
+
+
+@pytest.mark.parametrize(
+    "components",
+    [
+        {"fade": lc.LuminosityFadeNone()},
+        {"halo_profile": magnofit.calc.mass.MassAlpha(1.5)},
+        {"bulge_profile": magnofit.calc.mass.MassAlpha(2.5)},
+    ],
+)
+def test_population_requires_shared_components(components):
+    galaxies = [
+        Galaxy(
+            halo_profile=magnofit.calc.mass.MassAlpha(2.0),
+            bulge_profile=magnofit.calc.mass.MassAlpha(2.0),
+            fade=lc.LuminosityFadeKing(),
+        )
+        for _ in range(3)
+    ]
+    # Components of another class or with other parameters
+    galaxies[2] = dataclasses.replace(galaxies[2], **components)
+
+    with pytest.raises(ValueError):
+        GalaxyPopulation.from_galaxies(galaxies)
+    # Separate instances with equal parameters are shared
+    assert GalaxyPopulation.from_galaxies(galaxies[:2]).halo_profile.alpha == 2.0
@@ -0,0 +1,216 @@
+import dataclasses
+
+import numpy as np
+import pytest
+from astropy import units as u
+
+import magnofit.calc.luminosity as lc
+import magnofit.io
+from magnofit.galaxy import Galaxy
+from magnofit.simulation import OutflowState
+
+
+@pytest.fixture
+def trajectory():
+    return {
+        "radius": np.array([0.0, 0.5, 1.0]),
+        "dot_radius": np.array([0.1, 0.2, 0.3]),
+        "dotdot_radius": np.array([1.0, -1.0, 0.5]),
+        "dotdotdot_radius": np.array([10.0, 20.0, -30.0]),
+        "mass_out": np.array([1e-4, 2e-4, 3e-4]),
+        "total_mass": np.array([0.1, 0.2, 0.3]),
+        "dot_mass": np.array([0.0, 0.0, 0.0]),
+        "time": np.array([0.0, 1e-4, 0.1]),
+        "dot_time": np.array([1e-4, 1e-4, 1e-3]),
+        "smbh_mass": np.array([1e-3, 1.1e-3, 1.2e-3]),
+    }
+
+
+@pytest.fixture
+def galaxy():
+    galaxy = Galaxy(fade=lc.LuminosityFadeKing(), outflow_sphere_angle_ratio=0.5)
+    galaxy.generate_stochastic_parameters(np.random.default_rng(0))
+    return galaxy
+
+
+def _per_row_outflow_array(outflows, galaxy_params):
+    # The row by row construction of outflows_to_table before trajectory_to_array
+    outflow_array = np.empty(
+        len(outflows),
+        dtype=[
+            (name, np.float64)
+            for name in (
+                "time",
+                "dot_time",
+                "radius",
+                "dot_radius",
+                "dotdot_radius",
+                "dotdotdot_radius",
+                "dot_mass",
+                "mass_out",
+                "total_mass",
+                "luminosity_AGN",
+            )
+        ],
+    )
+    for i, (o, g) in enumerate(zip(outflows, galaxy_params)):
+        for name in ("radius", "dot_radius", "dotdot_radius", "dotdotdot_radius", "time", "dot_time"):
+            outflow_array[name][i] = getattr(o, name)
+        outflow_array["mass_out"][i] = o.mass_out
+        outflow_array["total_mass"][i] = o.total_mass
+        outflow_array["luminosity_AGN"][i] = g.agn_luminosity(o.time)
+
+    const = magnofit.constants
+    outflow_array["radius"] = outflow_array["radius"] * const.UNIT_KPC
+    outflow_array["dot_radius"] = outflow_array["dot_radius"] * const.UNIT_VELOCITY / 1.0e5
+    outflow_array["time"] = outflow_array["time"] * const.UNIT_YEAR
+    outflow_array["dot_time"] = outflow_array["dot_time"] * const.UNIT_YEAR
+    outflow_array["mass_out"] = (
+        outflow_array["mass_out"] * galaxy_params[0].outflow_sphere_angle_ratio * const.UNIT_MSUN
+    )
+    derived_dot_mass = np.divide(
+        outflow_array["mass_out"] * outflow_array["dot_radius"] * 1.0e5,
+        outflow_array["radius"] * const.UNIT_LENGTH,
+        out=np.zeros_like(outflow_array["radius"]),
+        where=(outflow_array["radius"] != 0.0),
+    )
+    outflow_array["dot_mass"] = derived_dot_mass * const.SECONDS_IN_YEAR
+    outflow_array["total_mass"] = outflow_array["total_mass"] * const.UNIT_MSUN
+    outflow_array["luminosity_AGN"] = outflow_array["luminosity_AGN"] * const.UNIT_ENERGY / const.UNIT_TIME
+    return outflow_array
+
+
+def test_trajectory_to_array_matches_per_row_construction(trajectory, galaxy):
+    outflows = [
+        OutflowState(**{name: values[i] for name, values in trajectory.items() if name != "smbh_mass"})
+        for i in range(3)
+    ]
+    galaxy_params = [
+        dataclasses.replace(galaxy, smbh_mass=smbh_mass) for smbh_mass in trajectory["smbh_mass"]
+    ]
+    expected = _per_row_outflow_array(outflows, galaxy_params)
+
+    outflow_array = magnofit.io.trajectory_to_array(trajectory, galaxy)
+    outflow_table = magnofit.io.outflows_to_table(outflows, galaxy_params)
+
+    assert outflow_array.dtype.names == expected.dtype.names
+    assert tuple(outflow_table.colnames) == expected.dtype.names
+    for name in expected.dtype.names:
+        assert np.allclose(outflow_array[name], expected[name], rtol=1e-14, atol=0)
+        assert np.allclose(outflow_table[name].data, expected[name], rtol=1e-14, atol=0)
+    # The derived mass outflow rate is zero where the radius is zero
+    assert outflow_array["dot_mass"][0] == 0.0
+    assert outflow_array["dot_mass"][1] > 0.0
+
+
+def test_trajectory_to_table_rows_and_units(trajectory, galaxy):
+    outflow_table = magnofit.io.trajectory_to_table(trajectory, galaxy, rows=[2, 2, 1])
+
+    assert len(outflow_table) == 3
+    assert np.array_equal(outflow_table["radius"].data, [1.0, 1.0, 0.5])
+    assert outflow_table["dot_mass"].unit == u.Msun / u.yr
+    assert outflow_table["luminosity_AGN"].unit == u.erg / u.s
+
+
+def test_flatten_population(trajectory, galaxy):
+    outflow_table = magnofit.io.trajectory_to_table(trajectory, galaxy)
+    galaxy_table = galaxy.to_table()
+    galaxies = np.concatenate([magnofit.io.galaxy_rows(galaxy_table, i) for i in (3, 5)])
+    outflow_rows = np.concatenate(
+        [magnofit.io.outflow_rows(outflow_table.as_array(), i) for i in (3, 5)]
+    )
+
+    # Same layout as a cross merge of the two tables in pandas
+    flat = magnofit.io.flatten_population(galaxies, outflow_rows)
+    merged = outflow_table.to_pandas().merge(galaxy_table.to_pandas(), how="cross")
+    assert flat.colnames == list(merged.columns) + ["id"]
+    for name in merged.columns:
+        assert np.array_equal(flat[name][:3], merged[name].to_numpy())
+    assert np.array_equal(flat["id"], [3, 3, 3, 5, 5, 5])
+
+    # A subset of the rows, without any rows of the first galaxy
+    flat = magnofit.io.flatten_population(galaxies, outflow_rows[4:], columns=["radius", "duty_cycle", "id"])
+    assert flat.colnames == ["radius", "duty_cycle", "id"]
+    assert np.array_equal(flat["id"], [5, 5])
+    assert np.array_equal(flat["duty_cycle"], [galaxy.duty_cycle] * 2)
+
+
+def test_outflow_writer(tmp_path, trajectory, galaxy):
+    outflow_array = magnofit.io.trajectory_to_array(trajectory, galaxy)
+    galaxy_table = galaxy.to_table()
+    path = tmp_path / "outflows.hdf5"
+
+    with magnofit.io.OutflowWriter(path, chunk_rows=4) as writer:
+        for galaxy_id in range(5):
+            writer.append_galaxy(galaxy_table, outflow_array, galaxy_id)
+        assert len(writer) == 15
+        assert writer.rows(magnofit.io.GALAXIES_DATASET) == 5
+
+    galaxies, outflow_rows = magnofit.io.read_population(path)
+    assert np.array_equal(galaxies["id"], np.arange(5))
+    assert np.all(galaxies["fade_type"] == str(galaxy.fade).encode())
+    assert np.array_equal(outflow_rows["id"], np.repeat(np.arange(5), 3))
+    assert np.array_equal(outflow_rows["radius"], np.tile(outflow_array["radius"], 5))
+
+    rows = np.concatenate(list(magnofit.io.iter_rows(path, chunk_rows=4)))
+    assert np.array_equal(rows, outflow_rows)
+
+    # Flat files of earlier versions are split into the same two tables
+    outflow_properties = magnofit.io.read_outflows(path)
+    flat_path = tmp_path / "flat.hdf5"
+    outflow_properties.write(flat_path, path="outflow_properties", serialize_meta=True)
+    flat_galaxies, flat_outflow_rows = magnofit.io.read_population(flat_path)
+    assert np.array_equal(flat_galaxies, galaxies)
+    assert np.array_equal(flat_outflow_rows, outflow_rows)
+
+
+def test_read_outflows_columns_and_where(tmp_path, trajectory, galaxy):
+    outflow_array = magnofit.io.trajectory_to_array(trajectory, galaxy)
+    path = tmp_path / "outflows.hdf5"
+    with magnofit.io.OutflowWriter(path, chunk_rows=4) as writer:
+        for galaxy_id in range(5):
+            galaxy_table = galaxy.to_table()
+            galaxy_table["duty_cycle"] = 0.1 * galaxy_id
+            writer.append_galaxy(galaxy_table, outflow_array, galaxy_id)
+    flat_path = tmp_path / "flat.hdf5"
+    magnofit.io.read_outflows(path).write(flat_path, path="outflow_properties")
+
+    columns = ["radius", "duty_cycle", "id"]
+    where = {
+        "radius": lambda radius: radius > np.median(outflow_array["radius"]),
+        "duty_cycle": lambda duty_cycle: duty_cycle > 0.15,
+    }
+    outflow_properties = magnofit.io.read_outflows(path)
+    expected = outflow_properties[
+        (outflow_properties["radius"] > np.median(outflow_array["radius"]))
+        & (outflow_properties["duty_cycle"] > 0.15)
+    ][columns]
+    assert len(expected) == 3
+
+    for file_path in (path, flat_path):
+        # Chunks of 4 rows split the rows of a galaxy
+        selected = magnofit.io.read_outflows(file_path, columns, where, chunk_rows=4)
+        assert selected.colnames == columns
+        assert np.array_equal(selected.as_array(), expected.as_array())
+        chunks = list(magnofit.io.iter_outflows(file_path, columns, where, chunk_rows=4))
+        assert all(chunk.colnames == columns for chunk in chunks)
+        assert np.array_equal(np.concatenate([chunk.as_array() for chunk in chunks]), expected.as_array())
+    chunks = magnofit.io.iter_outflows(flat_path, chunk_rows=4)
+    assert np.array_equal(
+        np.concatenate([chunk.as_array() for chunk in chunks]), outflow_properties.as_array()
+    )
+
+    # Galaxies none of whose rows pass the predicates on outflow columns are kept
+    # with both layouts
+    where = {"id": lambda ids: ids != 3, "duty_cycle": lambda duty_cycle: duty_cycle > 0.15}
+    galaxies, outflow_rows = magnofit.io.read_population(path, ["radius", "duty_cycle"], where, chunk_rows=4)
+    assert np.array_equal(galaxies["id"], [2, 3, 4])
+    assert np.array_equal(np.unique(outflow_rows["id"]), [2, 4])
+    flat_galaxies, flat_outflow_rows = magnofit.io.read_population(
+        flat_path, ["radius", "duty_cycle"], where, chunk_rows=4
+    )
+    assert np.array_equal(flat_galaxies, galaxies)
+    assert np.array_equal(flat_outflow_rows, outflow_rows)
+
+    with pytest.raises(KeyError):
+        magnofit.io.read_outflows(path, ["radius", "dot_duty_cycle"])
@@ -1,3 +1,4 @@
+import numpy as np
 import pytest
 
 from magnofit.galaxy import Galaxy
@@ -77,3 +78,44 @@ def test_episode_quasar_lum_variation_ts(fade, expected_quasar_lum_variation_ts)
         initial_galaxy_parameters
     )
     assert quasar_lum_variation_ts == pytest.approx(expected_quasar_lum_variation_ts)
+
+
+@pytest.mark.parametrize(
+    "fade",
+    [
+        lc.LuminosityFadeNone(),
+        lc.LuminosityFadeExponential(),
+        lc.LuminosityFadePowerLaw(),
+        lc.LuminosityFadeKing(),
+    ],
+)
+def test_luminosity_coefficients_on_arrays(fade):
+    time = np.array([0.0, 1e-6, 0.001, 0.01, 0.1, 1.0])
+    duration = np.array([1e-6, 1e-5, 1e-5, 1e-4, 1e-6, 1e-3])
+    timestep = 2 * duration
+    eddington_ratio = np.linspace(0.5, 1.5, len(time))
+    # Both the times and the galaxy parameters are arrays
+    galaxies = Galaxy(fade=fade, eddington_ratio=eddington_ratio)
+
+    coef = fade.luminosity_coefficient(time, galaxies)
+    mean_coef = fade.luminosity_mean_coefficient(time, duration, timestep, galaxies)
+
+    assert np.shape(coef) == time.shape
+    assert np.shape(mean_coef) == time.shape
+    for i in range(len(time)):
+        galaxy = Galaxy(fade=fade, eddington_ratio=eddington_ratio[i])
+        assert coef[i] == pytest.approx(fade.luminosity_coefficient(time[i], galaxy))
+        assert mean_coef[i] == pytest.approx(
+            fade.luminosity_mean_coefficient(time[i], duration[i], timestep[i], galaxy)
+        )
+
+
+def test_mean_luminosity_coefficient_logarithmic_power_law():
+    fade = lc.LuminosityFadePowerLaw()
+    initial_galaxy_parameters = Galaxy(fade=fade, alpha_drop=-1.0)
+    time = 2 * initial_galaxy_parameters.quasar_lum_variation_timescale
+
+    mean_coef = fade.luminosity_mean_coefficient(
+        time, 1e-6, 1e-6, initial_galaxy_parameters
+    )
+    assert np.isfinite(mean_coef)
@@ -106,3 +106,42 @@ def test_mass_calculations(
     assert dotdot_mass_gass == pytest.approx(expected_dotdot_mass_gass)
     assert rho_gas == pytest.approx(expected_rho_gas)
     assert rho_gas_outer == pytest.approx(expected_rho_gas_outer)
+
+
+@pytest.mark.parametrize(
+    "mass_calculator",
+    [
+        mc.MassNFW(),
+        mc.MassIsothermal(),
+        mc.MassHernquist(),
+        mc.MassJaffe(),
+        mc.MassAlpha(1.5),
+    ],
+)
+def test_mass_calculations_on_arrays(mass_calculator):
+    # Radii on both sides of the component edge exercise the clamping
+    radius = np.geomspace(1e-3, 1e3, 25)
+    dot_radius = np.linspace(-2.0, 3.0, 25)
+    dotdot_radius = np.linspace(50.0, -50.0, 25)
+
+    array_results = mass_calculator.calculate(
+        radius, dot_radius, dotdot_radius, 150.0, 10.0, 10.0, 0.05
+    )
+
+    for i in range(len(radius)):
+        scalar_results = mass_calculator.calculate(
+            radius[i], dot_radius[i], dotdot_radius[i], 150.0, 10.0, 10.0, 0.05
+        )
+        for array_result, scalar_result in zip(array_results, scalar_results):
+            assert np.shape(array_result) == radius.shape
+            assert array_result[i] == pytest.approx(scalar_result, rel=1e-12)
+
+
+def test_mass_calculations_clamp_scalar():
+    mass_fraction, dot_mass_fraction, dotdot_mass_fraction, rho_contact, rho_outer = (
+        mc.MassIsothermal().calculate_fractions(2.0, 1.0, 1.0, None)
+    )
+
+    assert (mass_fraction, dot_mass_fraction, dotdot_mass_fraction) == (1.0, 0.0, 0.0)
+    assert (rho_contact, rho_outer) == (1.0e-10, 1.0e-10)
+    assert isinstance(mass_fraction, float)
@@ -1,10 +1,19 @@
+import subprocess
+import sys
+
 import astropy.table
 import magnofit.calc.mass
 import magnofit.constants as const
 import numpy as np
 import pytest
-from magnofit.galaxy import Galaxy
-from magnofit.simulation import run_outflow_simulation
+from magnofit.galaxy import Galaxy, GalaxyPopulation
+from magnofit.io import OutflowArray
+import magnofit.calc.luminosity
+import magnofit.calc.time as tc
+import magnofit.jit
+import magnofit.simulation
+from magnofit.simulation import run_outflow_simulation, run_outflow_simulation_batch
+from magnofit.termination import TerminationReason
 
 
 def test_simulation_default_params():
@@ -64,3 +73,253 @@ def test_simulation_analytical():
     )
 
     assert driving_term ** (1.0 / 3) == pytest.approx((dynamics_term) ** (1.0 / 3))
+
+
+def test_simulation_batch_matches_scalar():
+    rng = np.random.default_rng(0)
+    galaxies = []
+    for _ in range(3):
+        galaxy = Galaxy(
+            virial_mass=(10 ** rng.uniform(12, 14)) / const.UNIT_MSUN,
+            bulge_gas_fraction=rng.uniform(0.001, 0.3),
+            duty_cycle=rng.uniform(0.04, 1),
+            quasar_activity_duration=rng.uniform(10 ** 4.0, 10 ** 5.5) / const.UNIT_YEAR,
+            fade=magnofit.calc.luminosity.LuminosityFadeKing(),
+        )
+        galaxy.generate_stochastic_parameters(rng)
+        galaxies.append(galaxy)
+
+    batch_outflows = run_outflow_simulation_batch(
+        galaxies, rngs=[np.random.default_rng(i + 1) for i in range(len(galaxies))]
+    )
+
+    assert len(batch_outflows) == len(galaxies)
+    for i, (galaxy, batch_outflow) in enumerate(zip(galaxies, batch_outflows)):
+        outflow = run_outflow_simulation(galaxy, rng=np.random.default_rng(i + 1))
+        assert outflow.colnames == batch_outflow.colnames
+        assert len(outflow) == len(batch_outflow)
+        assert outflow.meta == batch_outflow.meta
+        for col in outflow.colnames:
+            assert np.allclose(outflow[col].data, batch_outflow[col].data, rtol=1e-6)
+
+    # A population is integrated without stacking Galaxy objects first
+    population_outflows = run_outflow_simulation_batch(
+        GalaxyPopulation.from_galaxies(galaxies),
+        rngs=[np.random.default_rng(i + 1) for i in range(len(galaxies))],
+    )
+    for batch_outflow, population_outflow in zip(batch_outflows, population_outflows):
+        assert np.array_equal(batch_outflow.as_array(), population_outflow.as_array())
+
+
+def test_simulation_batch_termination_reasons():
+    # Outflows that fail with a negative radius or run out of timesteps
+    rng = np.random.default_rng(11)
+    galaxies = []
+    for _ in range(5):
+        galaxy = Galaxy(fade=magnofit.calc.luminosity.LuminosityFadePowerLaw())
+        galaxy.generate_stochastic_parameters(rng)
+        galaxies.append(galaxy)
+
+    batch_results = run_outflow_simulation_batch(galaxies, max_timesteps=3000, return_reason=True)
+
+    reasons = set()
+    for galaxy, (batch_outflow, batch_reason) in zip(galaxies, batch_results):
+        outflow, reason = run_outflow_simulation(galaxy, rng=None, max_timesteps=3000, return_reason=True)
+        assert batch_reason == reason
+        assert (batch_outflow is None) == (outflow is None)
+        if outflow is not None:
+            assert batch_outflow.meta == outflow.meta
+        reasons.add(reason)
+    assert TerminationReason.NEGATIVE_RADIUS in reasons
+    assert TerminationReason.MAX_TIMESTEPS in reasons
+
+
+def test_simulation_batch_requires_shared_components():
+    galaxies = [
+        Galaxy(fade=magnofit.calc.luminosity.LuminosityFadeKing()),
+        Galaxy(fade=magnofit.calc.luminosity.LuminosityFadeNone()),
+    ]
+    rng = np.random.default_rng(0)
+    for galaxy in galaxies:
+        galaxy.generate_stochastic_parameters(rng)
+
+    with pytest.raises(ValueError):
+        run_outflow_simulation_batch(galaxies)
+
+
+def test_simulation_reservoir_sampling():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters,
+        rng=np.random.default_rng(1),
+        reservoir_sampling=True,
+    )
+    repeated_outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters,
+        rng=np.random.default_rng(1),
+        reservoir_sampling=True,
+    )
+
+    assert len(outflow_properties) == 200
+    assert np.all(outflow_properties["radius"] > 0.02)
+    for col in outflow_properties.colnames:
+        assert np.array_equal(outflow_properties[col], repeated_outflow_properties[col])
+
+
+def _check_against_expected_outflow_properties(backend):
+    initial_galaxy_parameters = Galaxy()
+    rng = np.random.default_rng(0)
+    initial_galaxy_parameters.generate_stochastic_parameters(rng)
+
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, backend=backend
+    )
+    expected_outflow_properties = astropy.table.Table.read(
+        "tests/data/expected_outflow_properties.hdf5"
+    )
+    assert len(outflow_properties) == len(expected_outflow_properties)
+    for col, expected_col in zip(
+        outflow_properties.itercols(), expected_outflow_properties.itercols()
+    ):
+        assert np.allclose(col.data, expected_col.data)
+
+
+def test_simulation_numba_backend():
+    pytest.importorskip("numba")
+    _check_against_expected_outflow_properties("numba")
+
+
+def test_simulation_numba_backend_uncompiled(monkeypatch):
+    # Without Numba, the loop of the numba backend still runs as plain Python
+    monkeypatch.setattr(magnofit.jit, "NUMBA_AVAILABLE", True)
+    monkeypatch.setenv("MAGNOFIT_BACKEND", "numba")
+    _check_against_expected_outflow_properties(None)
+
+
+def test_simulation_unknown_backend():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    with pytest.raises(ValueError):
+        run_outflow_simulation(initial_galaxy_parameters, backend="fortran")
+
+
+@pytest.mark.parametrize("integrator", ["leapfrog_dkd", "leapfrog_kdk", "adaptive"])
+def test_simulation_integrators(integrator):
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=None)
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, integrator=integrator
+    )
+    if integrator == "adaptive":
+        assert outflow_properties.meta["n_steps"] < reference.meta["n_steps"]
+
+    # Radius along the trajectory agrees with the default integrator
+    time = outflow_properties["time"].value
+    time_range = time <= reference["time"].value.max()
+    expected_radius = np.interp(
+        time[time_range], reference["time"].value, reference["radius"].value
+    )
+    relative_difference = np.abs(outflow_properties["radius"].value[time_range] / expected_radius - 1)
+    assert np.median(relative_difference) < 0.05
+
+
+def test_simulation_adaptive_non_finite_error(monkeypatch):
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+    nan_step = lambda *args: (np.nan,) * 4
+
+    # A non-finite error estimate no longer retries the step forever
+    monkeypatch.setattr(magnofit.simulation, "_step_error", lambda *args: np.nan)
+    _, reason = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, integrator="adaptive", max_timesteps=500, return_reason=True
+    )
+    assert reason == TerminationReason.MAX_TIMESTEPS
+
+    # Neither does a non-finite step, which ends the run
+    monkeypatch.setattr(tc, "simple_time_step", nan_step)
+    result, reason = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, integrator="adaptive", max_timesteps=500, return_reason=True
+    )
+    assert result is None
+    assert reason == TerminationReason.NON_FINITE
+
+
+def test_simulation_unknown_integrator():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    with pytest.raises(ValueError):
+        run_outflow_simulation(initial_galaxy_parameters, integrator="euler")
+
+
+def test_simulation_fast_forward():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=None)
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, fast_forward=True
+    )
+
+    assert outflow_properties.meta["n_steps"] < reference.meta["n_steps"]
+    # Both runs stop at max_radius at nearly the same time
+    assert outflow_properties["time"].max() == pytest.approx(reference["time"].max(), rel=1e-2)
+
+    # The coasting steps follow the path of the default integration
+    time = outflow_properties["time"].value
+    time_range = time <= reference["time"].value.max()
+    expected_radius = np.interp(
+        time[time_range], reference["time"].value, reference["radius"].value
+    )
+    relative_difference = np.abs(outflow_properties["radius"].value[time_range] / expected_radius - 1)
+    assert np.median(relative_difference) < 0.05
+
+
+def test_simulation_numpy_output():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=np.random.default_rng(1))
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters, rng=np.random.default_rng(1), output="numpy"
+    )
+    assert isinstance(outflow_properties, OutflowArray)
+    assert np.array_equal(outflow_properties.data, reference.as_array())
+    assert outflow_properties.meta == reference.meta
+    assert outflow_properties.units["radius"] == str(reference["radius"].unit)
+
+    table = outflow_properties.to_astropy()
+    assert np.array_equal(table.as_array(), reference.as_array())
+    assert table.meta == reference.meta
+    assert table["radius"].unit == reference["radius"].unit
+    assert outflow_properties.to_pandas().equals(reference.to_pandas())
+
+    (batch_reference,) = run_outflow_simulation_batch(
+        [initial_galaxy_parameters], rngs=[np.random.default_rng(1)]
+    )
+    (batch_outflow_properties,) = run_outflow_simulation_batch(
+        [initial_galaxy_parameters], rngs=[np.random.default_rng(1)], output="numpy"
+    )
+    assert np.array_equal(batch_outflow_properties.data, batch_reference.as_array())
+
+    with pytest.raises(ValueError):
+        run_outflow_simulation(initial_galaxy_parameters, output="pandas")
+
+
+def test_import_dependencies():
+    # In a fresh interpreter, as this one has imported astropy already
+    code = """
+import sys
+import magnofit.simulation
+print(sorted({name.split(".")[0] for name in sys.modules} & {"astropy", "h5py"}))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    # The simulation needs only NumPy; astropy is imported by the first table
+    assert output.strip() == "[]"
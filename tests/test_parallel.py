@@ -0,0 +1,148 @@
+import multiprocessing
+import socket
+import time
+
+import numpy as np
+import pytest
+
+import magnofit.calc.luminosity as lc
+from magnofit import parallel
+from magnofit.galaxy import GalaxyPopulation
+from magnofit.simulation import run_outflow_simulation
+
+
+@pytest.fixture
+def population():
+    population = GalaxyPopulation(
+        duty_cycle=np.linspace(0.05, 0.5, 6), fade=lc.LuminosityFadeKing()
+    )
+    population.generate_stochastic_parameters(np.random.default_rng(0))
+    return population
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"shared_memory": True}, {"chunk_size": 4}, {"lookahead": 2}]
+)
+def test_run_population(population, options):
+    seeds = np.arange(len(population)) + 1
+    result = parallel.run_population(
+        population, seeds, processes=2, max_timesteps=2000, **options
+    )
+
+    assert len(result) == len(population)
+    assert np.array_equal(result.rows["id"], np.repeat(np.arange(len(population)), result.counts))
+    for i, table in enumerate(result.tables()):
+        expected = run_outflow_simulation(
+            population[i], rng=np.random.default_rng(seeds[i]), max_timesteps=2000
+        )
+        if expected is None:
+            assert table is None
+            continue
+        assert np.array_equal(table.as_array(), expected.as_array())
+        assert table.meta == expected.meta
+        assert table["radius"].unit == expected["radius"].unit
+    assert result.accepted.any()
+
+
+def test_imap_population_order(population):
+    results = list(parallel.imap_population(population, processes=2, max_timesteps=10))
+    # Outflows that never pass the acceptance radius are rejected
+    assert [result.start for result in results] == list(np.cumsum([0] + [len(r) for r in results[:-1]]))
+    assert sum(len(result) for result in results) == len(population)
+    assert not any(result.accepted.any() for result in results)
+    assert all(table is None for result in results for table in result.tables())
+
+
+@pytest.mark.parametrize("start_method", ["forkserver", "spawn"])
+def test_worker_pool(population, start_method):
+    if start_method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"{start_method} is not available")
+    seeds = np.arange(len(population)) + 1
+    expected = parallel.run_population(population, seeds, processes=2, max_timesteps=2000)
+
+    with parallel.WorkerPool(2, start_method) as pool:
+        # Every batch runs in the same workers
+        for _ in range(2):
+            result = pool.run(population, seeds, max_timesteps=2000)
+            assert np.array_equal(result.rows, expected.rows)
+            assert np.array_equal(result.counts, expected.counts)
+        assert sum(len(part) for part in pool.imap(population[:3], max_timesteps=10)) == 3
+
+
+def test_serve_pool(population):
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        address = probe.getsockname()
+    server = multiprocessing.get_context("spawn").Process(
+        target=parallel.serve_pool, args=(address, b"test"), kwargs={"processes": 2}
+    )
+    server.start()
+    try:
+        for _ in range(100):
+            try:
+                pool = parallel.connect_pool(address, b"test")
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        result = pool.run(population, max_timesteps=10)
+        assert list(result.index) == list(range(len(population)))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def test_shared_memory_requires_seeds(population):
+    with pytest.raises(ValueError):
+        parallel.run_population(population, shared_memory=True)
+
+
+def test_cost_model(population):
+    model = parallel.CostModel(max_timesteps=10**6)
+    # Shorter AGN episodes mean more episodes and steps
+    episodes = GalaxyPopulation(quasar_activity_duration=np.geomspace(1e-3, 1e-1, 4))
+    assert np.all(np.diff(model.predict(episodes)) < 0)
+    assert np.all(parallel.CostModel(max_timesteps=10).predict(episodes) == 10 * model.seconds_per_step)
+
+    # Refitting from runs that took twice as long per step as expected
+    steps = np.exp(model.features(population) @ model.coefficients).round()
+    result = parallel.PopulationOutflows(
+        index=np.arange(len(population)),
+        rows=np.empty(0, parallel.OUTFLOW_ROW_DTYPE),
+        counts=np.ones(len(population), dtype=np.int64),
+        n_steps=steps.astype(np.int64),
+        reasons=np.zeros(len(population), dtype=np.int8),
+        seconds=2 * model.seconds_per_step * steps,
+    )
+    for _ in range(20):
+        model.update(population, result)
+    assert np.allclose(model.predict(population), result.seconds, rtol=0.1)
+    assert model.observed == 20 * len(population)
+
+
+def test_scheduler():
+    model = parallel.CostModel()
+    features = np.column_stack([np.ones(6), np.log([1, 5, 2, 50, 3, 4]), np.zeros(6), np.zeros(6)])
+    model.coefficients = np.array([0.0, 1.0, 0.0, 0.0])
+    model.seconds_per_step = 0.1
+    scheduler = parallel._Scheduler(model, features, 2, None, 0.6, lookahead=4)
+
+    # Single galaxies, the most expensive within the lookahead first
+    assert list(scheduler.next_chunk(0)) == [3]
+    model.observed = 1
+    assert list(scheduler.next_chunk(0)) == [1, 2]
+    assert list(scheduler.next_chunk(0)) == [0]
+    assert list(scheduler.next_chunk(0)) == []
+    # Never more than an even share of the pending galaxies
+    assert list(scheduler.next_chunk(2)) == [5]
+    assert list(scheduler.next_chunk(2)) == [4]
+
+    scheduler = parallel._Scheduler(model, features, 2, 4, 1.0, lookahead=6)
+    assert list(scheduler.next_chunk(0)) == [1, 3, 4, 5]
+
+
+def test_take(population):
+    result = parallel.run_population(population, processes=2, max_timesteps=2000, chunk_size=4)
+    taken = result.take([4, 1])
+    assert list(taken.index) == [4, 1]
+    assert [len(rows) for rows in taken.split()] == list(result.counts[[4, 1]])
+    assert all(np.array_equal(a, b) for a, b in zip(taken.split(), [result.split()[4], result.split()[1]]))
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+import magnofit.calc.luminosity as lc
+import magnofit.constants as const
+from magnofit import termination
+from magnofit.galaxy import Galaxy
+from magnofit.simulation import OutflowState, run_outflow_simulation
+
+
+@pytest.fixture
+def params():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+    return initial_galaxy_parameters.compile()
+
+
+def test_stalled(params):
+    predicate = termination.Stalled()
+    outflow = OutflowState(radius=0.01, peak_radius=0.015, peak_time=0.0)
+    # No AGN episode starts before max_time
+    max_time = 1.9 * params.quasar_repetition_timescale
+
+    outflow.time = 0.5 * params.quasar_repetition_timescale
+    assert not predicate.check(outflow, params, max_time)
+
+    outflow.time = 1.5 * params.quasar_repetition_timescale
+    assert predicate.check(outflow, params, max_time)
+
+    # The next AGN episode could push the outflow out again
+    assert not predicate.check(outflow, params, np.inf)
+
+    # Rows beyond the acceptance radius have been recorded already
+    outflow.peak_radius = 0.05
+    assert not predicate.check(outflow, params, max_time)
+
+
+def test_falling_back(params):
+    predicate = termination.FallingBack()
+    # Between AGN episodes, the last one before max_time
+    time = 0.5 * params.quasar_repetition_timescale
+    max_time = 0.9 * params.quasar_repetition_timescale
+    outflow = OutflowState(radius=0.005, dot_radius=-1.0, time=time, peak_radius=0.015)
+    assert predicate.check(outflow, params, max_time)
+
+    outflow.dot_radius = 1.0
+    assert not predicate.check(outflow, params, max_time)
+
+    # The next AGN episode could push the outflow out again
+    outflow.dot_radius = -1.0
+    assert not predicate.check(outflow, params, np.inf)
+
+    # During an AGN episode
+    outflow.time = params.quasar_repetition_timescale
+    assert not predicate.check(outflow, params, 1.5 * params.quasar_repetition_timescale)
+
+
+def test_unreachable(params):
+    predicate = termination.Unreachable()
+    outflow = OutflowState(radius=0.001, dot_radius=1.0, peak_radius=0.001)
+
+    assert predicate.check(outflow, params, 1.0 / const.UNIT_YEAR)
+    assert not predicate.check(outflow, params, 1.5e8 / const.UNIT_YEAR)
+
+
+def test_simulation_termination_reason():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    outflow_properties, reason = run_outflow_simulation(
+        initial_galaxy_parameters, return_reason=True
+    )
+    assert reason == termination.TerminationReason.MAX_RADIUS
+    assert outflow_properties.meta["termination_reason"] == "MAX_RADIUS"
+
+    _, reason = run_outflow_simulation(
+        initial_galaxy_parameters, max_timesteps=100, return_reason=True
+    )
+    assert reason == termination.TerminationReason.MAX_TIMESTEPS
+
+
+def test_simulation_negative_radius(capsys):
+    initial_galaxy_parameters = Galaxy(fade=lc.LuminosityFadePowerLaw())
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(11))
+
+    outflow_properties, reason = run_outflow_simulation(initial_galaxy_parameters, return_reason=True)
+    assert outflow_properties is None
+    assert reason == termination.TerminationReason.NEGATIVE_RADIUS
+    # Reported by the reason only
+    assert capsys.readouterr().out == ""
+
+
+def test_simulation_early_exit():
+    initial_galaxy_parameters = Galaxy()
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    outflow_properties, reason = run_outflow_simulation(
+        initial_galaxy_parameters,
+        max_time=1.0 / const.UNIT_YEAR,
+        early_exit=termination.default_early_exits(),
+        return_reason=True,
+    )
+    assert outflow_properties is None
+    assert reason == termination.TerminationReason.UNREACHABLE
+
+    # Runs that would be accepted are not affected
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=None)
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, early_exit=termination.default_early_exits()
+    )
+    assert np.array_equal(outflow_properties.as_array(), reference.as_array())
+
+
+def test_simulation_early_exit_matches_full_runs():
+    # An outflow that falls back between early AGN episodes and is pushed beyond the
+    # acceptance radius by later ones
+    rng = np.random.default_rng(11)
+    for _ in range(5):
+        initial_galaxy_parameters = Galaxy(fade=lc.LuminosityFadePowerLaw())
+        initial_galaxy_parameters.generate_stochastic_parameters(rng)
+
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=None, max_timesteps=80000)
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters,
+        rng=None,
+        max_timesteps=80000,
+        early_exit=termination.default_early_exits(),
+    )
+    assert reference is not None
+    assert np.array_equal(outflow_properties.as_array(), reference.as_array())
+
+
+def test_simulation_at_velocity_limit():
+    # With almost no gas, the outflow soon moves at the driving wind velocity, the
+    # largest velocity the early exit predicates allow for
+    initial_galaxy_parameters = Galaxy(
+        bulge_gas_fraction=1e-6, halo_gas_fraction=1e-7, duty_cycle=1.0
+    )
+    initial_galaxy_parameters.generate_stochastic_parameters(np.random.default_rng(0))
+
+    reference, reason = run_outflow_simulation(
+        initial_galaxy_parameters, rng=None, return_reason=True
+    )
+    assert reason == termination.TerminationReason.MAX_RADIUS
+    # Output velocities are in km/s
+    dot_radius = reference["dot_radius"].value * 1.0e5 / const.UNIT_VELOCITY
+    assert dot_radius.max() == pytest.approx(const.WIND_VELOCITY)
+    assert np.all(dot_radius <= const.WIND_VELOCITY * (1 + 1e-12))
+
+    # A run that reaches the acceptance radius just before max_time is not rejected
+    radius = reference["radius"].value / const.UNIT_KPC
+    crossing_time = reference["time"].value[radius > termination.ACCEPTANCE_RADIUS][0]
+    max_time = 1.01 * crossing_time / const.UNIT_YEAR
+    reference = run_outflow_simulation(initial_galaxy_parameters, rng=None, max_time=max_time)
+    outflow_properties = run_outflow_simulation(
+        initial_galaxy_parameters,
+        rng=None,
+        max_time=max_time,
+        early_exit=termination.default_early_exits(),
+    )
+    assert reference is not None
+    assert np.array_equal(outflow_properties.as_array(), reference.as_array())
@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+import magnofit.calc.luminosity as lc
+import magnofit.constants as const
+import magnofit.io
+import tools.utils as utils
+from magnofit.galaxy import Galaxy
+
+
+@pytest.fixture
+def archive(tmp_path):
+    # Ten galaxies with 20 rows each; rows 3, 10 and 17 of each move inwards and are
+    # not used for training
+    rng = np.random.default_rng(0)
+    rows = 20
+    path = tmp_path / "outflows.hdf5"
+    with magnofit.io.OutflowWriter(path, chunk_rows=16) as writer:
+        for galaxy_id in range(10):
+            galaxy = Galaxy(
+                fade=lc.LuminosityFadeKing(),
+                duty_cycle=rng.uniform(0.04, 1),
+                quasar_activity_duration=rng.uniform(1e4, 1e5) / const.UNIT_YEAR,
+                outflow_sphere_angle_ratio=rng.uniform(0.05, 1),
+                bulge_gas_fraction=rng.uniform(0.001, 0.3),
+            )
+            galaxy.generate_stochastic_parameters(rng)
+            trajectory = {
+                # Distinct radii, so that every row can be told apart
+                "radius": np.linspace(0.05, 1.0, rows) + 0.001 * galaxy_id,
+                "dot_radius": np.where(np.arange(rows) % 7 == 3, -0.1, rng.uniform(0.1, 0.3, rows)),
+                "dotdot_radius": np.zeros(rows),
+                "dotdotdot_radius": np.zeros(rows),
+                "mass_out": rng.uniform(1e-5, 1e-3, rows),
+                "total_mass": np.full(rows, 0.1),
+                "dot_mass": np.zeros(rows),
+                "time": np.linspace(0.0, 2 * galaxy.quasar_activity_duration, rows),
+                "dot_time": np.full(rows, 1e-4),
+                "smbh_mass": np.full(rows, galaxy.smbh_mass),
+            }
+            outflow_array = magnofit.io.trajectory_to_array(trajectory, galaxy)
+            writer.append_galaxy(galaxy.to_table(), outflow_array, galaxy_id)
+    return path
+
+
+def test_training_dataset(tmp_path, archive):
+    pytest.importorskip("tensorflow")
+
+    train_ids, test_ids = utils.split_ids(utils.simulated_outflow_ids(archive))
+    normalization = utils.fit_simulated_normalization(
+        train_ids, archive, tmp_path / "normalization_parameters.npz"
+    )
+
+    # The rows of load_simulated_outflows, split by galaxy as in split_sets_masks
+    outflow_properties = utils.load_simulated_outflows(
+        archive, utils.input_params + utils.output_params + ["id"]
+    )
+    X = utils.to_numpy(outflow_properties[utils.input_params])
+    y = utils.to_numpy(outflow_properties[utils.output_params])
+    train_mask, test_mask = utils.split_sets_masks(outflow_properties)
+    assert 0 < np.count_nonzero(test_mask) < np.count_nonzero(train_mask)
+
+    # Fitted to the training rows only
+    X_mean, X_stddev, y_mean, y_stddev = normalization
+    np.testing.assert_allclose(X_mean, np.mean(np.log10(X[train_mask]), axis=0), rtol=1e-12)
+    np.testing.assert_allclose(y_stddev, np.std(np.log10(y[train_mask]), axis=0), rtol=1e-12)
+
+    for ids, mask in ((train_ids, train_mask), (test_ids, test_mask)):
+        # Chunks of 16 stored rows split the rows of a galaxy; batches and the shuffle
+        # buffer are smaller than the rows of the split
+        dataset = utils.training_dataset(
+            ids, normalization, archive, batch_size=7, shuffle_buffer=32, chunk_rows=16
+        )
+        batches = list(dataset.as_numpy_iterator())
+        streamed = np.hstack(
+            [np.concatenate([X for X, _ in batches]), np.concatenate([y for _, y in batches])]
+        )
+        expected = np.hstack(
+            [
+                utils.normalize(X[mask], X_mean, X_stddev),
+                utils.normalize(y[mask], y_mean, y_stddev),
+            ]
+        )
+
+        # Every row of the split exactly once, in any order; the rows are told apart by
+        # their radius, and normalized to float32
+        assert streamed.dtype == np.float32
+        assert len(streamed) == len(expected)
+        streamed = streamed[np.argsort(streamed[:, 0])]
+        expected = expected[np.argsort(expected[:, 0])]
+        np.testing.assert_allclose(streamed, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.fixture
+def log_normal_rows():
+    rng = np.random.default_rng(0)
+    X = 10 ** rng.normal(3.0, 2.0, (1000, len(utils.input_params)))
+    y = 10 ** rng.normal(-1.0, 0.5, (1000, len(utils.output_params)))
+    return X, y
+
+
+def _assert_matches_numpy(normalization, X, y):
+    # The sums are taken in another order than by NumPy: equal to rounding, well
+    # within a relative tolerance of 1e-12, but not bit for bit
+    X_mean, X_stddev, y_mean, y_stddev = normalization
+    np.testing.assert_allclose(X_mean, np.mean(np.log10(X), axis=0), rtol=1e-12)
+    np.testing.assert_allclose(X_stddev, np.std(np.log10(X), axis=0), rtol=1e-12)
+    np.testing.assert_allclose(y_mean, np.mean(np.log10(y), axis=0), rtol=1e-12)
+    np.testing.assert_allclose(y_stddev, np.std(np.log10(y), axis=0), rtol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 7, 256, 999, 1000, 1_000_000])
+def test_fit_normalization_chunks(tmp_path, log_normal_rows, chunk_rows):
+    X, y = log_normal_rows
+    mask = np.random.default_rng(1).random(len(X)) < 0.8
+
+    path = tmp_path / "normalization_parameters.npz"
+    normalization = utils.fit_normalization(X, y, path, mask=mask, chunk_rows=chunk_rows)
+    _assert_matches_numpy(normalization, X[mask], y[mask])
+    for saved, fitted in zip(utils.load_normalization(path), normalization):
+        assert np.array_equal(saved, fitted)
+
+
+@pytest.mark.parametrize("boundaries", [[500], [1, 999], [0, 250, 250, 251, 1000]])
+def test_normalization_accumulator_merge(log_normal_rows, boundaries):
+    # Accumulators over shards, some of them empty or of a single row, merged into one
+    X, y = log_normal_rows
+    accumulator = utils.NormalizationAccumulator()
+    for X_shard, y_shard in zip(np.split(X, boundaries), np.split(y, boundaries)):
+        accumulator.merge(utils.NormalizationAccumulator().update(X_shard, y_shard))
+
+    assert accumulator.count == len(X)
+    _assert_matches_numpy(accumulator.parameters(), X, y)
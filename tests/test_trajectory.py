@@ -0,0 +1,60 @@
+import numpy as np
+
+from magnofit.trajectory import TRAJECTORY_COLUMNS, TrajectoryBuffer, TrajectoryReservoir
+
+
+def test_trajectory_buffer_grows():
+    trajectory = TrajectoryBuffer(capacity=4)
+    for step in range(10):
+        trajectory.append(*(step + 0.1 * i for i in range(len(TRAJECTORY_COLUMNS))))
+
+    assert len(trajectory) == 10
+    assert trajectory.capacity >= 10
+    assert np.array_equal(trajectory["radius"], np.arange(10.0))
+    assert np.allclose(trajectory["smbh_mass"], np.arange(10.0) + 0.9)
+
+
+def test_trajectory_buffer_extend_and_take():
+    trajectory = TrajectoryBuffer(columns=("time", "lane"), capacity=2)
+    trajectory.extend(np.array([0.0, 0.0, 0.0]), np.array([0, 1, 2]))
+    trajectory.extend(np.array([1.0, 1.0]), np.array([0, 2]))
+
+    taken = trajectory.take(trajectory["lane"] == 0)
+
+    assert len(trajectory) == 5
+    assert taken.as_dict().keys() == {"time", "lane"}
+    assert np.array_equal(taken["time"], [0.0, 1.0])
+    # Taken rows are copies
+    taken["time"][0] = 5.0
+    assert trajectory["time"][0] == 0.0
+
+
+def test_trajectory_reservoir_follows_weights():
+    reservoir = TrajectoryReservoir(5000, np.random.default_rng(0), columns=("value", "weight"), weight="weight")
+    for _ in range(2000):
+        for value, weight in enumerate([1.0, 2.0, 7.0]):
+            reservoir.append(value, weight)
+
+    frequencies = np.bincount(reservoir["value"].astype(int), minlength=3) / reservoir.size
+    assert np.allclose(frequencies, [0.1, 0.2, 0.7], atol=0.01)
+
+
+def test_trajectory_reservoir_with_growing_weights():
+    # Late rows replace slots that have kept early rows for many appends
+    reservoir = TrajectoryReservoir(4000, np.random.default_rng(1), columns=("value", "weight"), weight="weight")
+    weights = np.geomspace(1.0, 100.0, 5000)
+    for row, weight in enumerate(weights):
+        reservoir.append(row // 500, weight)
+
+    frequencies = np.bincount(reservoir["value"].astype(int), minlength=10) / reservoir.size
+    expected = weights.reshape(10, 500).sum(axis=1) / weights.sum()
+    assert np.allclose(frequencies, expected, atol=0.015)
+
+
+def test_trajectory_reservoir_with_few_rows():
+    reservoir = TrajectoryReservoir(5, np.random.default_rng(0), columns=("value", "weight"), weight="weight")
+    reservoir.append(3.0, 1.0)
+    reservoir.append(4.0, 1.0)
+
+    assert len(reservoir) == 2
+    assert set(reservoir["value"]) <= {3.0, 4.0}
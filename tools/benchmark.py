@@ -0,0 +1,88 @@
+"""
+Brief description
+
+This script compares run_outflow_simulation with alternative options (e.g.
+fast_forward or a different integrator) against the default step-by-step
+integration, on galaxies drawn as in tools/generate.py. It reports the wall
+time per completed run (one that ends before --max-timesteps), the number of
+integration steps and the deviation of the outflow radius from the default path.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from magnofit.simulation import run_outflow_simulation
+from magnofit.termination import TerminationReason
+from tools.generate import generate_initial_parameter_collection_randomised
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--galaxies", type=int, default=50)
+parser.add_argument("--max-timesteps", type=int, default=30000)
+parser.add_argument("--integrator", type=str, default="simple")
+parser.add_argument("--tolerance", type=float, default=1e-10)
+parser.add_argument("--fast-forward", action="store_true")
+args = parser.parse_args()
+
+
+def simulate(galaxy, **kwargs):
+    start_time = time.perf_counter()
+    outflow_properties, reason = run_outflow_simulation(
+        galaxy, rng=None, max_timesteps=args.max_timesteps, return_reason=True, **kwargs
+    )
+    return outflow_properties, reason, time.perf_counter() - start_time
+
+
+def radius_deviation(outflow_properties, reference):
+    # Median relative difference of the radius over the time both runs cover
+    time = outflow_properties["time"].value
+    reference_time = reference["time"].value
+    common = time <= min(time.max(), reference_time.max())
+    reference_radius = np.interp(time[common], reference_time, reference["radius"].value)
+    return np.median(np.abs(outflow_properties["radius"].value[common] / reference_radius - 1))
+
+
+galaxy_param_collection = generate_initial_parameter_collection_randomised(number=args.galaxies)
+
+# Wall time, completed runs and integration steps of all runs
+totals = {"default": [0.0, 0, 0], "candidate": [0.0, 0, 0]}
+deviations = []
+for galaxy in galaxy_param_collection:
+    runs = {
+        "default": simulate(galaxy),
+        "candidate": simulate(
+            galaxy,
+            integrator=args.integrator,
+            tolerance=args.tolerance,
+            fast_forward=args.fast_forward,
+        ),
+    }
+    for name, (outflow_properties, reason, elapsed) in runs.items():
+        totals[name][0] += elapsed
+        totals[name][1] += reason != TerminationReason.MAX_TIMESTEPS
+        if outflow_properties is not None:
+            totals[name][2] += outflow_properties.meta["n_steps"]
+
+    reference, candidate = runs["default"][0], runs["candidate"][0]
+    if reference is not None and candidate is not None:
+        deviations.append(radius_deviation(candidate, reference))
+
+# Wall time per completed run, infinite if no run completed
+per_completed_run = {
+    name: elapsed / completed if completed else np.inf
+    for name, (elapsed, completed, _) in totals.items()
+}
+for name, (elapsed, completed, steps) in totals.items():
+    print(
+        f"{name:>9}: {elapsed:.2f} s, {completed} of {len(galaxy_param_collection)} runs completed, "
+        f"{per_completed_run[name]:.2f} s / completed run, {steps} steps"
+    )
+print(
+    f"Speedup (wall time per completed run): "
+    f"{per_completed_run['default'] / per_completed_run['candidate']:.2f}x"
+)
+print(
+    f"Radius deviation from the default path over {len(deviations)} galaxies: "
+    f"median {np.median(deviations):.1e}, 95th percentile {np.percentile(deviations, 95):.1e}"
+)
@@ -4,45 +4,120 @@ Brief description
 This script simulates an outflow for a specified number of galaxies with
 randomised parameters, outputs the results as astropy tables, and saves
 them to a hdf5 archive.
+
+Every finished simulation is appended to a chunked hdf5 shard as soon as it
+completes, so memory use does not grow with the number of galaxies. Shards
+hold a fixed number of galaxies, and a manifest records which galaxies the
+completed shards cover. An interrupted run resumes from the shards that are
+missing; galaxy i is always simulated with default_rng(i + 1), so a resumed
+run gives the same output.
+
+The archive holds a table of galaxy parameters keyed by id and a table of
+outflow rows carrying the id of their galaxy (see magnofit.io.read_population).
 """
+import argparse
+import json
 import os
 import time
-import multiprocessing
 from tqdm import tqdm
 
-import astropy.table
+import h5py
 import numpy as np
-import pandas as pd
 
-from magnofit.galaxy import Galaxy
+import magnofit.io
+import magnofit.parallel
+from magnofit.cache import ResultCache
+from magnofit.galaxy import GalaxyPopulation, UniformDraws
 import magnofit.constants as const
-from magnofit.simulation import run_outflow_simulation
 import magnofit.calc.luminosity
 
 
 def generate_initial_parameter_collection_randomised(number=1):
     rng = np.random.default_rng(0)
-    galaxy_param_collection = []
-    for _ in range(number):
-        galaxy_params = Galaxy(
-            virial_mass=(10 ** rng.uniform(12, 14)) / const.UNIT_MSUN,
-            bulge_gas_fraction=rng.uniform(0.001, 0.3),
-            outflow_sphere_angle_ratio=rng.uniform(0.05, 1),
-            duty_cycle=rng.uniform(0.04, 1),
-            quasar_activity_duration=rng.uniform(10 ** 4.0, 10 ** 5.5)
-            / const.UNIT_YEAR,
-            fade=magnofit.calc.luminosity.LuminosityFadeKing(),
-        )
-        galaxy_params.generate_stochastic_parameters(rng)
-        galaxy_param_collection.append(galaxy_params)
+    # Five parameters drawn here and the three scaling relation scatters, per galaxy
+    # in the same order as drawing the galaxies one by one
+    draws = UniformDraws(rng, number, 8)
+    galaxy_param_collection = GalaxyPopulation(
+        virial_mass=(10 ** draws.uniform(12, 14)) / const.UNIT_MSUN,
+        bulge_gas_fraction=draws.uniform(0.001, 0.3),
+        outflow_sphere_angle_ratio=draws.uniform(0.05, 1),
+        duty_cycle=draws.uniform(0.04, 1),
+        quasar_activity_duration=draws.uniform(10 ** 4.0, 10 ** 5.5) / const.UNIT_YEAR,
+        fade=magnofit.calc.luminosity.LuminosityFadeKing(),
+    )
+    galaxy_param_collection.generate_stochastic_parameters(draws)
 
     return galaxy_param_collection
 
 
-if __name__ == "__main__":
+def iter_outflow_rows(results, progress):
+    # Rows of every galaxy, in order, from magnofit.parallel.imap_population
+    for result in results:
+        yield from result.split()
+        progress.update(len(result))
+
 
+def load_manifest(shard_directory, galaxy_collection_size, shard_size):
+    manifest_path = os.path.join(shard_directory, "manifest.json")
+    manifest = {"galaxies": galaxy_collection_size, "shard_size": shard_size, "shards": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if (manifest["galaxies"], manifest["shard_size"]) != (galaxy_collection_size, shard_size):
+            raise SystemExit(
+                f"{shard_directory} holds shards of a run with {manifest['galaxies']} galaxies "
+                f"and shard size {manifest['shard_size']}; remove it or choose another directory."
+            )
+    return manifest
+
+
+def save_manifest(shard_directory, manifest):
+    manifest_path = os.path.join(shard_directory, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def assemble_shards(shard_directory, manifest, writer):
+    # Streams the shards in galaxy order and numbers the accepted outflows consecutively;
+    # in the shards, galaxies are identified by their index in the collection
+    shards = sorted(manifest["shards"].values(), key=lambda shard: shard["galaxies"][0])
+    next_id = 0
+    for shard in shards:
+        if shard["file"] is None:
+            continue
+        shard_path = os.path.join(shard_directory, shard["file"])
+        with h5py.File(shard_path, "r") as file:
+            galaxies = file[magnofit.io.GALAXIES_DATASET][:]
+        galaxy_index = galaxies["id"].copy()
+        galaxies["id"] = next_id + np.arange(len(galaxies))
+        writer.append(galaxies, magnofit.io.GALAXIES_DATASET)
+        for rows in magnofit.io.iter_rows(shard_path):
+            rows["id"] = next_id + np.searchsorted(galaxy_index, rows["id"])
+            writer.append(rows)
+        next_id += len(galaxies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
     # How many galaxies would you like to generate and simulate outflows for?
-    galaxy_collection_size = 50_000
+    parser.add_argument("--galaxies", type=int, default=50_000)
+    parser.add_argument("--shard-size", type=int, default=1000, help="galaxies per shard")
+    parser.add_argument("--shard-directory", type=str, default="./outputs/outflows_shards")
+    # Compression of the final archive, like the shards; "none" writes it uncompressed
+    parser.add_argument(
+        "--compression",
+        type=lambda name: None if name.lower() == "none" else name,
+        default="gzip",
+        help="gzip (default), lzf or none",
+    )
+    # Reuse the results of earlier runs with the same galaxies and arguments
+    parser.add_argument("--cache", type=str, default=None, help="simulation cache directory")
+    parser.add_argument("--cache-size", type=float, default=1.0, help="cache size limit in GB")
+    args = parser.parse_args()
+    cache = ResultCache(args.cache, max_bytes=int(args.cache_size * 1e9)) if args.cache else None
+
+    galaxy_collection_size = args.galaxies
 
     print("Seeding initial galaxy parameters...")
     galaxy_param_collection = generate_initial_parameter_collection_randomised(
@@ -50,66 +125,70 @@ if __name__ == "__main__":
     )
     print(f"Generated {len(galaxy_param_collection)} initial galaxy parameter sets.")
 
+    os.makedirs(args.shard_directory, exist_ok=True)
+    manifest = load_manifest(args.shard_directory, galaxy_collection_size, args.shard_size)
+    missing_shards = [
+        (start, min(start + args.shard_size, galaxy_collection_size))
+        for start in range(0, galaxy_collection_size, args.shard_size)
+        if str(start // args.shard_size) not in manifest["shards"]
+    ]
+    missing_count = sum(stop - start for start, stop in missing_shards)
+    if missing_count < galaxy_collection_size:
+        print(f"Resuming: {galaxy_collection_size - missing_count} galaxies already simulated.")
+
     print()
     print(f"Running simulations...")
     start_time = time.time()
-
-    def worker_wrapper(arg):
-        args, kwargs = arg
-        return run_outflow_simulation(args, **kwargs)
-
-    with multiprocessing.Pool(processes=16) as pool:
-        outflow_properties_collection = list(
-            tqdm(
-                pool.imap(
-                    worker_wrapper,
-                    [
-                        (
-                            g,
-                            {
-                                "rng": np.random.default_rng(i + 1),
-                                "output_array_length": 200,
-                            },
-                        )
-                        for i, g in enumerate(galaxy_param_collection)
-                    ],
-                ),
-                total=galaxy_collection_size,
-            )
-        )
+    # Galaxy columns of the archive, for all galaxies at once
+    galaxy_rows = magnofit.io.galaxy_rows(
+        galaxy_param_collection.to_table(), np.arange(galaxy_collection_size)
+    )
+    missing = np.concatenate(
+        [np.arange(start, stop) for start, stop in missing_shards] or [np.empty(0, dtype=int)]
+    )
+    results = magnofit.parallel.imap_population(
+        galaxy_param_collection[missing],
+        seeds=missing + 1,
+        processes=16,
+        # Long simulations go first, but at most a shard ahead of the shard being written
+        lookahead=args.shard_size,
+        output_array_length=200,
+        cache=cache,
+    )
+    outflow_rows = iter_outflow_rows(results, tqdm(total=missing_count))
+    # Results arrive in galaxy order, so a shard is complete after stop - start galaxies
+    for start, stop in missing_shards:
+        shard_index = start // args.shard_size
+        shard_file = f"shard_{shard_index:05d}.hdf5"
+        shard_path = os.path.join(args.shard_directory, shard_file)
+        # Written under a temporary name, so an interrupted shard leaves no partial file
+        with magnofit.io.OutflowWriter(shard_path + ".tmp") as writer:
+            for i in range(start, stop):
+                rows = next(outflow_rows)
+                if len(rows):
+                    rows["id"] = i
+                    writer.append(galaxy_rows[i : i + 1], magnofit.io.GALAXIES_DATASET)
+                    writer.append(rows)
+            shard_rows = len(writer)
+        if shard_rows:
+            os.replace(shard_path + ".tmp", shard_path)
+        else:
+            os.remove(shard_path + ".tmp")
+            shard_file = None
+        manifest["shards"][str(shard_index)] = {"galaxies": [start, stop], "file": shard_file}
+        save_manifest(args.shard_directory, manifest)
+    results.close()
     end_time = time.time()
     print(f"Simulations took {end_time - start_time:.2f} s.")
 
     print()
-    print(f"Joining and stacking tables...")
-    start_time = time.time()
-    outflow_dataframe = []
-    for galaxy_params, outflow_properties in zip(
-        galaxy_param_collection, outflow_properties_collection
-    ):
-        if outflow_properties is not None:
-            galaxy_params = galaxy_params.to_table().to_pandas()
-            outflow_properties = outflow_properties.to_pandas()
-
-            outflow = outflow_properties.merge(galaxy_params, how="cross")
-            outflow_dataframe.append(outflow)
-
-    for idx, outflow_properties in enumerate(outflow_dataframe):
-        outflow_properties["id"] = idx
-    outflow_dataframe = pd.concat(outflow_dataframe, ignore_index=True, sort=False)
-    outflow_table = astropy.table.Table.from_pandas(outflow_dataframe)
-    end_time = time.time()
-    print(f"Joining and stacking tables took {end_time - start_time:.2f} s.")
-    print()
-    print(f"Saving simulations to disk...")
+    print(f"Joining shards and saving simulations to disk...")
     start_time = time.time()
     os.makedirs("./outputs", exist_ok=True)
-    outflow_table.write(
-        "./outputs/outflows.hdf5",
-        format="hdf5",
-        path="outflow_properties",
-        serialize_meta=True,
-        overwrite=True,
-    )
+    with magnofit.io.OutflowWriter(
+        "./outputs/outflows.hdf5.tmp", compression=args.compression
+    ) as writer:
+        assemble_shards(args.shard_directory, manifest, writer)
+    os.replace("./outputs/outflows.hdf5.tmp", "./outputs/outflows.hdf5")
     end_time = time.time()
-    print(f"Saving took {end_time - start_time:.2f} s.")
+    print(f"Joining and saving took {end_time - start_time:.2f} s.")
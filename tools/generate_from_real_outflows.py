@@ -5,44 +5,50 @@ This script simulates an outflow for a specified number of galaxies with
 randomised parameters, outputs the results as astropy tables, and saves
 them to a hdf5 archive.
 """
+import argparse
 import os
 import time
-import multiprocessing
-import functools
 from tqdm import tqdm
 
 import numpy as np
 import pandas as pd
 
-from magnofit.galaxy import Galaxy
+from magnofit.cache import ResultCache
+from magnofit.galaxy import GalaxyPopulation
 import magnofit.constants as const
-from magnofit.simulation import run_outflow_simulation
+import magnofit.parallel
 import magnofit.calc.luminosity
 
 
 def generate_model_parameters(predicted_outflows, inital_real_outflows):
-    galaxy_param_collection = []
     rng = np.random.default_rng(0)
-    for i in range(len(predicted_outflows)):
-        galaxy_params = Galaxy(
-            virial_mass=None,
-            bulge_gas_fraction=predicted_outflows.bulge_gas_fraction[i],
-            outflow_sphere_angle_ratio=predicted_outflows.outflow_solid_angle_fraction[i],
-            duty_cycle=predicted_outflows.duty_cycle[i],
-            quasar_activity_duration=predicted_outflows.quasar_activity_duration[i]
-            / const.UNIT_YEAR,
-            fade=magnofit.calc.luminosity.LuminosityFadeKing(),
-            bulge_mass=predicted_outflows.bulge_mass[i] / const.UNIT_MSUN,
-            smbh_mass=10 ** inital_real_outflows.smbh_mass_log[i] / const.UNIT_MSUN,
-            name=predicted_outflows.name[i],
-        )
-
-        galaxy_params.generate_stochastic_parameters(rng)
-        galaxy_param_collection.append(galaxy_params)
+    galaxy_param_collection = GalaxyPopulation(
+        virial_mass=None,
+        bulge_gas_fraction=predicted_outflows.bulge_gas_fraction.to_numpy(),
+        outflow_sphere_angle_ratio=predicted_outflows.outflow_solid_angle_fraction.to_numpy(),
+        duty_cycle=predicted_outflows.duty_cycle.to_numpy(),
+        quasar_activity_duration=predicted_outflows.quasar_activity_duration.to_numpy()
+        / const.UNIT_YEAR,
+        fade=magnofit.calc.luminosity.LuminosityFadeKing(),
+        bulge_mass=predicted_outflows.bulge_mass.to_numpy() / const.UNIT_MSUN,
+        smbh_mass=10 ** inital_real_outflows.smbh_mass_log.to_numpy()[: len(predicted_outflows)]
+        / const.UNIT_MSUN,
+        name=predicted_outflows.name.to_numpy(),
+    )
+    galaxy_param_collection.generate_stochastic_parameters(rng)
 
     return galaxy_param_collection
 
 
+parser = argparse.ArgumentParser()
+# Reuse the results of earlier runs with the same galaxies and arguments
+parser.add_argument("--cache", type=str, default=None, help="simulation cache directory")
+parser.add_argument("--cache-size", type=float, default=1.0, help="cache size limit in GB")
+# Simulate in the workers of tools/serve_pool.py instead of starting new ones
+parser.add_argument("--pool", type=str, default=None, help="host:port of tools/serve_pool.py")
+args = parser.parse_args()
+cache = ResultCache(args.cache, max_bytes=int(args.cache_size * 1e9)) if args.cache else None
+
 initial_real_outflows = pd.read_csv("observed_outflows.csv")
 initial_real_outflows = initial_real_outflows[initial_real_outflows.type == "full"]
 initial_real_outflows.reset_index(drop=True, inplace=True)
@@ -55,16 +61,22 @@ generated_model_params = generate_model_parameters(
 print()
 print(f"Running simulations...")
 start_time = time.time()
-with multiprocessing.Pool(processes=16) as pool:
-    outflow_properties_collection = list(
-        tqdm(
-            pool.imap(
-                functools.partial(run_outflow_simulation, rng=None),
-                generated_model_params,
-            ),
-            total=int(len(predicted_real_outflows)),
-        )
+# Without seeds, every row of each outflow is kept, as with rng=None
+if args.pool:
+    host, port = args.pool.rsplit(":", 1)
+    pool = magnofit.parallel.connect_pool(
+        (host, int(port)), os.environ["MAGNOFIT_POOL_AUTHKEY"].encode()
     )
+    outflow_properties_collection = pool.run(generated_model_params, cache=cache).tables()
+else:
+    progress = tqdm(total=len(generated_model_params))
+    outflow_properties_collection = []
+    for result in magnofit.parallel.imap_population(
+        generated_model_params, processes=16, cache=cache
+    ):
+        outflow_properties_collection.extend(result.tables())
+        progress.update(len(result))
+    progress.close()
 end_time = time.time()
 print(f"Simulations took {end_time - start_time:.2f} s.")
 
@@ -1,11 +1,14 @@
 import matplotlib.pyplot as plt
-import astropy.table
 import random
 
-# Read in a file with outflow data
-outflow_data = astropy.table.Table.read("./outputs/outflows.hdf5")
+import magnofit.io
 
-agn_shining = outflow_data[outflow_data["luminosity_AGN"] > 0]
+# Read in the rows with the AGN shining, and only the columns plotted
+agn_shining = magnofit.io.read_outflows(
+    "./outputs/outflows.hdf5",
+    columns=["radius", "dot_radius", "dot_mass", "luminosity_AGN"],
+    where={"luminosity_AGN": lambda luminosity: luminosity > 0},
+)
 subsample = random.sample(range(len(agn_shining)), k=10000)
 shining = agn_shining[subsample]
 
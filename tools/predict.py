@@ -8,21 +8,14 @@ import matplotlib.pyplot as plt
 import tools.utils as utils
 
 
-outflow_properties = utils.load_simulated_outflows()
+# The normalized float32 X is the model input; the ground truth is y as read from the archive
+X, y, ids, train_mask, test_mask, _, y_raw = utils.load_training_data(raw=True)
 
-X = utils.to_numpy(outflow_properties[utils.input_params])
-y = utils.to_numpy(outflow_properties[utils.output_params])
-
-train_mask, test_mask = utils.split_sets_masks(outflow_properties)
-
-X_test, y_test = X[test_mask], y[test_mask]
+X_test = X[test_mask]
 
 
 X_mean, X_stddev, y_mean, y_stddev = utils.load_normalization()
 
-X_test = utils.normalize(X_test, X_mean, X_stddev)
-y_test = utils.normalize(y_test, y_mean, y_stddev)
-
 model = tf.keras.models.load_model("./outputs/model.keras")
 
 y_test_predictions = model.predict(X_test, verbose=1)
@@ -32,9 +25,9 @@ prediction_table = utils.from_numpy(
     y_test_predictions_denorm, column_names=utils.output_params
 )
 
-groundtruth_table = outflow_properties[test_mask]
+groundtruth_table = utils.from_numpy(np.asarray(y_raw[test_mask]), column_names=utils.output_params)
 
-prediction_table["id"] = outflow_properties[test_mask]["id"]
+prediction_table["id"] = ids[test_mask]
 
 utils.output_params.remove("bulge_mass")
 
@@ -15,29 +15,22 @@ args = parser.parse_args()
 
 rng = np.random.default_rng(seed=0)
 
-outflow_properties = utils.load_simulated_outflows()
-
-X = utils.to_numpy(outflow_properties[utils.input_params])
-y = utils.to_numpy(outflow_properties[utils.output_params])
-
-train_ids, test_ids = utils.split_sets_ids(outflow_properties)
-train_mask, test_mask = utils.split_sets_masks(outflow_properties)
+# The normalized float32 X is the model input; the ground truth is as read from the archive
+X, y, ids, train_mask, test_mask, X_raw, y_raw = utils.load_training_data(raw=True)
+X_mean, X_stddev, y_mean, y_stddev = utils.load_normalization()
 
-X_train, y_train = X[train_mask], y[train_mask]
-X_test, y_test = X[test_mask], y[test_mask]
+X_test = X[test_mask]
 
 sample_mask = rng.integers(low=0, high=len(X_test), size=200)
-X_sample, y_sample = X[test_mask][sample_mask], y[test_mask][sample_mask]
+X_sample = X_test[sample_mask]
+y_sample = np.asarray(y_raw[test_mask][sample_mask])
 
 # create args.num_random_instances instances of each point - only X values change
 X_sample_embiggened = X_sample.repeat(args.num_random_instances, axis=0)
 
-weights = 10 ** rng.normal(loc=0, scale=0.15, size=X_sample_embiggened.shape)
-X_sample_embiggened = np.multiply(X_sample_embiggened, weights)
-
-X_mean, X_stddev, y_mean, y_stddev = utils.load_normalization()
-
-X_sample_embiggened = utils.normalize(X_sample_embiggened, X_mean, X_stddev)
+# X is normalized in log10, so multiplying by 10 ** weights shifts it by weights / X_stddev
+weights = rng.normal(loc=0, scale=0.15, size=X_sample_embiggened.shape)
+X_sample_embiggened = X_sample_embiggened + weights / X_stddev
 
 model = tf.keras.models.load_model("./outputs/model.keras")
 
@@ -75,9 +68,9 @@ colnames_pred.extend([s + "_stdev" for s in utils.output_params])
 prediction_table = utils.from_numpy(y_sample_predictions, column_names=colnames_pred)
 groundtruth_table = utils.from_numpy(y_sample, column_names=utils.output_params)
 
-prediction_table["id"] = outflow_properties[test_mask][sample_mask]["id"]
-groundtruth_table["id"] = outflow_properties[test_mask][sample_mask]["id"]
-groundtruth_table["radius"] = outflow_properties[test_mask][sample_mask]["radius"]
+prediction_table["id"] = ids[test_mask][sample_mask]
+groundtruth_table["id"] = ids[test_mask][sample_mask]
+groundtruth_table["radius"] = X_raw[test_mask][sample_mask][:, utils.input_params.index("radius")]
 
 
 utils.output_params.remove("bulge_mass")
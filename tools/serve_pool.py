@@ -0,0 +1,30 @@
+"""
+Brief description
+
+This script keeps a pool of simulation workers running, so that successive
+runs of the generation tools (e.g. tools/generate_from_real_outflows.py with
+--pool) reuse the same started workers instead of starting their own. The
+MAGNOFIT_POOL_AUTHKEY environment variable must hold the same key for the
+server and its clients. Stop it with Ctrl+C.
+"""
+import argparse
+import os
+
+import magnofit.parallel
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", type=str, default="localhost:50000", help="host:port")
+    parser.add_argument("--processes", type=int, default=16)
+    parser.add_argument("--start-method", type=str, default=None, help="forkserver or spawn")
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(":", 1)
+    print(f"Serving {args.processes} workers at {args.address}...")
+    magnofit.parallel.serve_pool(
+        (host, int(port)),
+        os.environ["MAGNOFIT_POOL_AUTHKEY"].encode(),
+        processes=args.processes,
+        start_method=args.start_method,
+    )
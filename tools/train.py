@@ -19,25 +19,36 @@ parser.add_argument("--layers", type=int, default=2)
 parser.add_argument("--batch-size", type=int, default=128)
 parser.add_argument("--activation", type=str, default="elu")
 parser.add_argument("--no-dropout", action="store_false")
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="stream the outflows from the archive instead of loading them",
+)
+parser.add_argument("--shuffle-buffer", type=int, default=2**18, help="rows, with --stream")
 args = parser.parse_args()
 
-outflow_properties = utils.load_simulated_outflows()
-
-X = utils.to_numpy(outflow_properties[utils.input_params])
-y = utils.to_numpy(outflow_properties[utils.output_params])
-
-train_mask, test_mask = utils.split_sets_masks(outflow_properties)
-
-X_train, y_train = X[train_mask], y[train_mask]
-X_test, y_test = X[test_mask], y[test_mask]
-
-X_mean, X_stddev, y_mean, y_stddev = utils.fit_normalization(X_train, y_train)
-
-X_train = utils.normalize(X_train, X_mean, X_stddev)
-y_train = utils.normalize(y_train, y_mean, y_stddev)
-
-X_test = utils.normalize(X_test, X_mean, X_stddev)
-y_test = utils.normalize(y_test, y_mean, y_stddev)
+if args.stream:
+    # Same split by galaxy as split_sets_masks, without reading the outflows
+    train_ids, test_ids = utils.split_ids(utils.simulated_outflow_ids())
+    # Fitted to the training rows, as with load_training_data(fit=True), chunk by chunk
+    normalization = utils.fit_simulated_normalization(train_ids)
+    train_data = utils.training_dataset(
+        train_ids, normalization, batch_size=args.batch_size, shuffle_buffer=args.shuffle_buffer
+    )
+    test_data = utils.training_dataset(test_ids, normalization, batch_size=1024, shuffle_buffer=0)
+    fit_data = {"x": train_data, "validation_data": test_data}
+else:
+    # Normalized with a normalization fitted to the training rows
+    X, y, _, train_mask, test_mask = utils.load_training_data(fit=True)
+
+    X_train, y_train = X[train_mask], y[train_mask]
+    X_test, y_test = X[test_mask], y[test_mask]
+    fit_data = {
+        "x": X_train,
+        "y": y_train,
+        "validation_data": (X_test, y_test),
+        "batch_size": args.batch_size,
+    }
 
 layers = [tf.keras.layers.Input((len(utils.input_params),))]
 
@@ -69,18 +80,19 @@ model.compile(
 
 start_time = time.time()
 model.fit(
-    X_train,
-    y_train,
-    validation_data=(X_test, y_test),
+    **fit_data,
     epochs=12,
-    batch_size=args.batch_size,
     callbacks=tf.keras.callbacks.LearningRateScheduler(step_decay),
     verbose=1,
 )
 end_time = time.time()
 print(f"Training took {end_time - start_time:.2f} s.")
 
-predictions = model.predict(X_test, batch_size=1024, verbose=0)
+if args.stream:
+    predictions = model.predict(test_data, verbose=0)
+    y_test = np.concatenate([y for _, y in test_data.as_numpy_iterator()])
+else:
+    predictions = model.predict(X_test, batch_size=1024, verbose=0)
 
 individual_mses = np.mean((predictions - y_test) ** 2, axis=0)
 overall_mse = np.mean((predictions - y_test) ** 2)
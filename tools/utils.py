@@ -1,9 +1,14 @@
+import hashlib
 import json
+import os
+import shutil
 
 import numpy as np
 import pandas as pd
 import astropy.table
 
+import magnofit.io
+
 
 def to_numpy(outflow_properties):
     return (
@@ -18,8 +23,12 @@ def from_numpy(data, column_names):
 
 
 def split_sets_ids(outflow_properties, flex_point=0.8):
+    return split_ids(np.unique(outflow_properties["id"].data), flex_point=flex_point)
+
+
+def split_ids(all_ids, flex_point=0.8):
     rng = np.random.default_rng(0)
-    all_ids = np.unique(outflow_properties["id"].data)
+    all_ids = np.array(all_ids)
     rng.shuffle(all_ids)
 
     split_point = int(flex_point * len(all_ids))
@@ -50,14 +59,86 @@ def load_real_outflows(path="./observed_outflows.csv"):
     return real_outflows
 
 
-def load_simulated_outflows(path="./outputs/outflows.hdf5"):
-    outflow_properties = astropy.table.Table.read(path)
-    outflow_properties = outflow_properties[outflow_properties["dot_radius"] > 0]
-    outflow_properties = outflow_properties[outflow_properties["luminosity_AGN"] > 0]
+# Simulated outflow rows used for training
+simulated_outflow_filters = {
+    "dot_radius": lambda values: values > 0,
+    "luminosity_AGN": lambda values: values > 0,
+}
+
+
+def load_simulated_outflows(path="./outputs/outflows.hdf5", columns=None):
+    # Rows are selected while reading, before the galaxy columns are joined onto them;
+    # columns optionally limits the columns read, e.g. to input_params + output_params
+    outflow_properties = magnofit.io.read_outflows(path, columns, where=simulated_outflow_filters)
 
     return outflow_properties
 
 
+def simulated_outflow_ids(path="./outputs/outflows.hdf5", chunk_rows=1_000_000):
+    # The ids of load_simulated_outflows, read chunk by chunk
+    ids = [np.empty(0, dtype=np.int64)]
+    for chunk in magnofit.io.iter_outflows(path, ["id"], simulated_outflow_filters, chunk_rows):
+        ids.append(np.unique(chunk["id"].data))
+    return np.unique(np.concatenate(ids))
+
+
+def iter_simulated_outflows(ids, path="./outputs/outflows.hdf5", chunk_rows=131072):
+    """X and y of the simulated outflows of the galaxies in ids, chunk by chunk.
+
+    The rows are those of load_simulated_outflows, in the same order, but only
+    one chunk of chunk_rows stored rows is read at a time. Empty chunks are skipped.
+    """
+    ids = np.asarray(ids)
+    where = {**simulated_outflow_filters, "id": lambda values: np.isin(values, ids)}
+    for chunk in magnofit.io.iter_outflows(path, input_params + output_params, where, chunk_rows):
+        if len(chunk):
+            yield to_numpy(chunk[input_params]), to_numpy(chunk[output_params])
+
+
+def training_dataset(
+    ids,
+    normalization,
+    path="./outputs/outflows.hdf5",
+    batch_size=128,
+    shuffle_buffer=2**18,
+    chunk_rows=131072,
+    seed=0,
+):
+    """tf.data.Dataset of normalized (X, y) batches of the simulated outflows of the galaxies in ids.
+
+    The rows are streamed from the archive with iter_simulated_outflows while
+    earlier batches are consumed, normalized by tf.data threads, chunks in
+    parallel, and shuffled in a buffer of shuffle_buffer rows (not at all if
+    0), so memory use is bounded by the buffer instead of the archive. The rows
+    of a galaxy are stored together, so the buffer should hold those of many
+    galaxies.
+    """
+    import tensorflow as tf
+
+    X_mean, X_stddev, y_mean, y_stddev = normalization
+
+    def normalize_chunk(X, y):
+        return (
+            tf.cast((tf.math.log(X) / np.log(10) - X_mean) / X_stddev, tf.float32),
+            tf.cast((tf.math.log(y) / np.log(10) - y_mean) / y_stddev, tf.float32),
+        )
+
+    dataset = tf.data.Dataset.from_generator(
+        lambda: iter_simulated_outflows(ids, path, chunk_rows),
+        output_signature=(
+            tf.TensorSpec((None, len(input_params)), tf.float64),
+            tf.TensorSpec((None, len(output_params)), tf.float64),
+        ),
+    )
+    # Read ahead, so that reading overlaps the normalization of earlier chunks
+    dataset = dataset.prefetch(2)
+    dataset = dataset.map(normalize_chunk, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.unbatch()
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
 output_params = [
     "duty_cycle",
     "quasar_activity_duration",
@@ -76,22 +157,98 @@ input_params = [
 ]
 
 
-def fit_normalization(X, y, path="./outputs/normalization_parameters.npz"):
-    X_mean = np.mean(np.log10(X), axis=0)
-    X_stddev = np.std(np.log10(X), axis=0)
-
-    y_mean = np.mean(np.log10(y), axis=0)
-    y_stddev = np.std(np.log10(y), axis=0)
-
-    np.savez(
-        path,
-        X_mean=X_mean,
-        X_stddev=X_stddev,
-        y_mean=y_mean,
-        y_stddev=y_stddev,
-    )
-
-    return X_mean, X_stddev, y_mean, y_stddev
+class NormalizationAccumulator:
+    """Means and standard deviations of log10(X) and log10(y), accumulated chunk by chunk.
+
+    Every chunk is reduced to its row count, means and sums of squared
+    deviations, which are combined with the running ones by the pairwise update
+    of Chan, Golub and LeVeque (Welford's algorithm for whole chunks). Only
+    chunk-sized temporaries are needed, and accumulators over separate shards or
+    processes can be merged into one. The result matches np.mean and np.std
+    (population standard deviation) over all rows to rounding, not bit for bit:
+    the sums are taken in a different order, and depend on the chunk boundaries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        # Over the columns of X followed by those of y
+        self.mean = None
+        self.m2 = None
+        self.X_columns = None
+
+    def update(self, X, y):
+        if len(X) == 0:
+            return self
+        logs = np.log10(np.hstack([X, y]))
+        mean = np.mean(logs, axis=0)
+        logs -= mean
+        self.X_columns = X.shape[1]
+        return self._combine(len(logs), mean, np.einsum("ij,ij->j", logs, logs))
+
+    def merge(self, other):
+        if other.count:
+            self.X_columns = other.X_columns
+            self._combine(other.count, other.mean, other.m2)
+        return self
+
+    def parameters(self):
+        """X_mean, X_stddev, y_mean and y_stddev, as fit_normalization returns them."""
+        stddev = np.sqrt(self.m2 / self.count)
+        return (
+            self.mean[: self.X_columns],
+            stddev[: self.X_columns],
+            self.mean[self.X_columns :],
+            stddev[self.X_columns :],
+        )
+
+    def save(self, path="./outputs/normalization_parameters.npz"):
+        X_mean, X_stddev, y_mean, y_stddev = self.parameters()
+        np.savez(
+            path,
+            X_mean=X_mean,
+            X_stddev=X_stddev,
+            y_mean=y_mean,
+            y_stddev=y_stddev,
+        )
+
+        return X_mean, X_stddev, y_mean, y_stddev
+
+    def _combine(self, count, mean, m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta**2 * (self.count * count / total)
+        self.count = total
+        return self
+
+
+def fit_normalization(X, y, path="./outputs/normalization_parameters.npz", mask=None, chunk_rows=1_000_000):
+    # Accumulated in chunks, optionally of the rows in mask only, so that no
+    # full-size copies or log10 temporaries are made
+    accumulator = NormalizationAccumulator()
+    for start in range(0, len(X), chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        if mask is None:
+            accumulator.update(X[rows], y[rows])
+        else:
+            accumulator.update(X[rows][mask[rows]], y[rows][mask[rows]])
+
+    return accumulator.save(path)
+
+
+def fit_simulated_normalization(
+    ids, path="./outputs/outflows.hdf5", normalization_path="./outputs/normalization_parameters.npz"
+):
+    # fit_normalization over the simulated outflows of the galaxies in ids, streamed
+    # from the archive with iter_simulated_outflows
+    accumulator = NormalizationAccumulator()
+    for X, y in iter_simulated_outflows(ids, path):
+        accumulator.update(X, y)
+
+    return accumulator.save(normalization_path)
 
 
 def load_normalization(path="./outputs/normalization_parameters.npz"):
@@ -105,3 +262,101 @@ def normalize(data, mean, stddev):
 
 def denormalize(data, mean, stddev):
     return 10 ** (data * stddev + mean)
+
+
+def _dataset_key(path):
+    # The archive is replaced, never modified in place, by tools/generate.py, so its
+    # size and modification time identify its contents
+    stat = os.stat(path)
+    description = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, input_params, output_params]
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()[:16]
+
+
+def _normalization_key(normalization):
+    digest = hashlib.sha256()
+    for parameters in normalization:
+        digest.update(np.ascontiguousarray(parameters, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _training_matrices(path):
+    outflow_properties = load_simulated_outflows(path, input_params + output_params + ["id"])
+    X = to_numpy(outflow_properties[input_params])
+    y = to_numpy(outflow_properties[output_params])
+    train_mask, test_mask = split_sets_masks(outflow_properties)
+    return X, y, outflow_properties["id"].data, train_mask, test_mask
+
+
+def _write_training_cache(directory, matrices, normalization, chunk_rows=1_000_000):
+    X, y, ids, train_mask, test_mask = matrices
+    X_mean, X_stddev, y_mean, y_stddev = normalization
+    # Written to a temporary directory first, so an interrupted build leaves no entry
+    temporary = directory + ".tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, data, mean, stddev in (("X", X, X_mean, X_stddev), ("y", y, y_mean, y_stddev)):
+        normalized = np.lib.format.open_memmap(
+            os.path.join(temporary, f"{name}.npy"), mode="w+", dtype=np.float32, shape=data.shape
+        )
+        # In chunks, so that no full-size float64 temporaries are needed
+        for start in range(0, len(data), chunk_rows):
+            normalized[start : start + chunk_rows] = normalize(
+                data[start : start + chunk_rows], mean, stddev
+            )
+        normalized.flush()
+        del normalized
+    # The values as read, e.g. as ground truth for predictions
+    np.save(os.path.join(temporary, "X_raw.npy"), X)
+    np.save(os.path.join(temporary, "y_raw.npy"), y)
+    np.save(os.path.join(temporary, "id.npy"), ids)
+    np.save(os.path.join(temporary, "train_mask.npy"), train_mask)
+    np.save(os.path.join(temporary, "test_mask.npy"), test_mask)
+    # Entries written before the raw values were stored are replaced
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary, directory)
+
+
+def load_training_data(
+    path="./outputs/outflows.hdf5",
+    normalization_path="./outputs/normalization_parameters.npz",
+    cache_directory="./outputs/training_cache",
+    fit=False,
+    raw=False,
+):
+    """X and y of the simulated outflows, normalized, with their ids and split masks.
+
+    The matrices are built once per archive and normalization (with
+    load_simulated_outflows, to_numpy, split_sets_masks and normalize), stored
+    as float32 .npy files in cache_directory and memory-mapped from there on
+    later calls. With fit=True, the normalization is first fitted to the
+    training rows and saved to normalization_path, as fit_normalization does;
+    otherwise it is read from there.
+
+    Returns X, y, ids, train_mask and test_mask; with raw=True, followed by X
+    and y as read from the archive (float64, not normalized), e.g. to compare
+    predictions with.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    dataset_key = _dataset_key(path)
+
+    matrices = None
+    if fit:
+        # The fitted normalization depends only on the archive, so it is kept as well
+        fitted_path = os.path.join(cache_directory, f"{dataset_key}_normalization.npz")
+        if not os.path.exists(fitted_path):
+            matrices = _training_matrices(path)
+            X, y, _, train_mask, _ = matrices
+            fit_normalization(X, y, path=fitted_path, mask=train_mask)
+        shutil.copyfile(fitted_path, normalization_path)
+    normalization = load_normalization(normalization_path)
+
+    directory = os.path.join(cache_directory, f"{dataset_key}_{_normalization_key(normalization)}")
+    names = ["X", "y", "id", "train_mask", "test_mask", "X_raw", "y_raw"]
+    if not all(os.path.exists(os.path.join(directory, f"{name}.npy")) for name in names):
+        if matrices is None:
+            matrices = _training_matrices(path)
+        _write_training_cache(directory, matrices, normalization)
+
+    if not raw:
+        names = names[:5]
+    return tuple(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in names)